@@ -632,7 +632,7 @@ class KacheryP2PNode {
             }
             let signedMessages: SignedSubfeedMessage[]
             try {
-                signedMessages = subfeed.getLocalSignedMessages({position, numMessages})
+                signedMessages = await subfeed.getLocalSignedMessages({position, numMessages})
             }
             catch(err) {
                 ret.producer().error(new Error('Problem loading signed messages'))
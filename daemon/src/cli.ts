@@ -152,6 +152,7 @@ function main() {
         const udpSocketPort: number | null = (!noUdp) ? ((argv['udp-port'] ? Number(argv['udp-port']) : httpListenPort) || 14507) : null
         const webSocketListenPort = argv['websocket-port'] ? Number(argv['websocket-port']) : null
         const daemonApiPort = Number(process.env.KACHERY_P2P_API_PORT || 20431)
+        const daemonApiSocketPath: LocalFilePath | null = process.env.KACHERY_P2P_API_SOCKET ? localFilePath(process.env.KACHERY_P2P_API_SOCKET) : null
         const label = nodeLabel(argv.label as string)
         const isBootstrapNode = argv['isbootstrap'] ? true : false
         
@@ -227,6 +228,7 @@ function main() {
             firewalled: false,
             staticConfigPathOrUrl,
             authGroup,
+            daemonApiSocketPath,
             services: {
                 announce: true,
                 discover: true,
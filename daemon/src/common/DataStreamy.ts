@@ -10,6 +10,8 @@ const memoryLeakTest = []
 class DataStreamyProducer {
     #cancelled = false
     #onCancelledCallbacks: (() => void)[] = []
+    #onPausedCallbacks: (() => void)[] = []
+    #onResumedCallbacks: (() => void)[] = []
     #lastUnorderedDataIndex: number = -1
     #unorderedDataChunksByIndex = new Map<number, Buffer>()
     #unorderedEndNumDataChunks: number | null = null
@@ -24,6 +26,13 @@ class DataStreamyProducer {
     isCancelled() {
         return this.#cancelled
     }
+    onPaused(cb: () => void) {
+        // the producer stops delivering data (if it is able to) until resumed
+        this.#onPausedCallbacks.push(cb)
+    }
+    onResumed(cb: () => void) {
+        this.#onResumedCallbacks.push(cb)
+    }
     error(err: Error) {
         if (this.#cancelled) return
         this.dataStream._producer_error(err)
@@ -79,6 +88,12 @@ class DataStreamyProducer {
     setProgress(progress: DataStreamyProgress) {
         this.dataStream._producer_setProgress(progress)
     }
+    _pause() {
+        this.#onPausedCallbacks.forEach(cb => {cb()})
+    }
+    _resume() {
+        this.#onResumedCallbacks.forEach(cb => {cb()})
+    }
     _cancel() {
         if (this.#cancelled) return
         this.#cancelled = true
@@ -170,6 +185,16 @@ export default class DataStreamy {
         if (this.#completed) return
         this.#producer._cancel()
     }
+    pause() {
+        // a hint for the producer to hold back the data (e.g., while it is written to disk),
+        // honored by the sources that support it (http and local files, but not udp)
+        if (this.#completed) return
+        this.#producer._pause()
+    }
+    resume() {
+        if (this.#completed) return
+        this.#producer._resume()
+    }
     isComplete() {
         return this.#completed
     }
@@ -0,0 +1,239 @@
+import { Mutex } from 'async-mutex';
+import fs from 'fs';
+import { Database, open, Statement } from 'sqlite';
+import sqlite3 from 'sqlite3';
+import { LocalFilePath } from '../interfaces/core';
+
+type SqlParams = {[key: string]: string | number | null}
+
+export interface SqliteTransaction {
+    run: (sql: string, params?: SqlParams) => Promise<void>
+    get: <T>(sql: string, params?: SqlParams) => Promise<T | undefined>
+    all: <T>(sql: string, params?: SqlParams) => Promise<T[]>
+}
+
+class SqliteConnection {
+    // A long-lived connection with a cache of prepared statements
+    #statements = new Map<string, Statement>()
+    constructor(private db: Database) {
+    }
+    async statement(sql: string): Promise<Statement> {
+        let s = this.#statements.get(sql)
+        if (!s) {
+            s = await this.db.prepare(sql)
+            this.#statements.set(sql, s)
+        }
+        return s
+    }
+    async run(sql: string, params?: SqlParams): Promise<void> {
+        await (await this.statement(sql)).run(params || {})
+    }
+    async get<T>(sql: string, params?: SqlParams): Promise<T | undefined> {
+        const s = await this.statement(sql)
+        try {
+            return await s.get<T>(params || {})
+        }
+        finally {
+            // get() steps the statement only once, which leaves it active (and, in WAL mode,
+            // keeps its read transaction open on a stale snapshot) until it is reset
+            await s.reset()
+        }
+    }
+    async all<T>(sql: string, params?: SqlParams): Promise<T[]> {
+        return await (await this.statement(sql)).all<T[]>(params || {})
+    }
+    async exec(sql: string): Promise<void> {
+        await this.db.exec(sql)
+    }
+    async close() {
+        for (let s of this.#statements.values()) {
+            await s.finalize()
+        }
+        this.#statements.clear()
+        await this.db.close()
+    }
+}
+
+interface PendingWrite {
+    fn: (tx: SqliteTransaction) => Promise<any>
+    resolve: (x: any) => void
+    reject: (err: Error) => void
+}
+
+class SqliteConnectionManager {
+    // Long-lived connections to a SQLite database in WAL mode:
+    // one writer connection plus a few read-only connections, so that reads
+    // can proceed concurrently with each other and with the writer.
+    //
+    // Writes that are requested while a transaction is in progress are grouped
+    // into the next transaction (each in its own savepoint, so that a failing
+    // write does not affect the others) and committed together.
+    #writer: SqliteConnection | null = null
+    #readers: SqliteConnection[] = []
+    #nextReaderIndex = 0
+    #initializeMutex = new Mutex()
+    #writeMutex = new Mutex()
+    #pendingWrites: PendingWrite[] = []
+    #closed = false
+    constructor(private databasePath: LocalFilePath, private opts: {createTables: (tx: SqliteTransaction) => Promise<void>, numReaders?: number}) {
+    }
+    async _initialize() {
+        if (this.#writer) return
+        const release = await this.#initializeMutex.acquire()
+        try {
+            if (this.#writer) return
+            if (this.#closed) throw Error('Unexpected: sqlite connection manager is closed')
+            const writer = new SqliteConnection(await this._open(sqlite3.OPEN_READWRITE | sqlite3.OPEN_CREATE))
+            const readers: SqliteConnection[] = []
+            try {
+                await writer.exec(`PRAGMA journal_mode = WAL`)
+                // in WAL mode, NORMAL is still safe against corruption (the most recent commits may be lost on power failure)
+                await writer.exec(`PRAGMA synchronous = NORMAL`)
+                await writer.exec(`PRAGMA foreign_keys = ON`)
+                await writer.exec('BEGIN TRANSACTION')
+                try {
+                    await this.opts.createTables(writer)
+                    await writer.exec('COMMIT')
+                }
+                catch(err) {
+                    /* istanbul ignore next */
+                    {
+                        await writer.exec('ROLLBACK')
+                        throw err
+                    }
+                }
+                fs.chmodSync(this.databasePath.toString(), fs.constants.S_IRUSR | fs.constants.S_IWUSR)
+                const numReaders = this.opts.numReaders !== undefined ? this.opts.numReaders : 4
+                for (let i = 0; i < numReaders; i++) {
+                    readers.push(new SqliteConnection(await this._open(sqlite3.OPEN_READONLY)))
+                }
+            }
+            catch(err) {
+                /* istanbul ignore next */
+                {
+                    for (let r of readers) await r.close()
+                    await writer.close()
+                    throw err
+                }
+            }
+            this.#readers = readers
+            this.#writer = writer
+        }
+        finally {
+            release()
+        }
+    }
+    async _open(mode: number): Promise<Database> {
+        const db = await open({filename: this.databasePath.toString(), driver: sqlite3.Database, mode})
+        // another process (e.g., the python client) may hold a lock briefly
+        db.configure('busyTimeout', 5000)
+        return db
+    }
+    async read<T>(fn: (tx: SqliteTransaction) => Promise<T>): Promise<T> {
+        await this._initialize()
+        if (this.#readers.length === 0) {
+            // no dedicated readers, so read through the writer (between write transactions)
+            const release = await this.#writeMutex.acquire()
+            try {
+                return await fn(this._writer())
+            }
+            finally {
+                release()
+                // writes requested meanwhile were deferred to the holder of the lock
+                if (this.#pendingWrites.length > 0) this._processPendingWrites()
+            }
+        }
+        const reader = this.#readers[this.#nextReaderIndex]
+        this.#nextReaderIndex = (this.#nextReaderIndex + 1) % this.#readers.length
+        return await fn(reader)
+    }
+    async write<T>(fn: (tx: SqliteTransaction) => Promise<T>): Promise<T> {
+        await this._initialize()
+        if (this.#closed) throw Error('Unexpected: sqlite connection manager is closed')
+        return new Promise<T>((resolve, reject) => {
+            this.#pendingWrites.push({fn, resolve, reject})
+            this._processPendingWrites()
+        })
+    }
+    async _processPendingWrites() {
+        if (this.#writeMutex.isLocked()) return // picked up when the current transaction completes
+        const release = await this.#writeMutex.acquire()
+        try {
+            while (this.#pendingWrites.length > 0) {
+                const batch = this.#pendingWrites
+                this.#pendingWrites = []
+                await this._runWriteBatch(batch)
+            }
+        }
+        finally {
+            release()
+        }
+    }
+    async _runWriteBatch(batch: PendingWrite[]) {
+        const writer = this._writer()
+        const results: {ok: boolean, value?: any, error?: Error}[] = []
+        try {
+            await writer.exec('BEGIN IMMEDIATE TRANSACTION')
+            for (let w of batch) {
+                await writer.exec('SAVEPOINT batch_item')
+                try {
+                    const value = await w.fn(writer)
+                    await writer.exec('RELEASE batch_item')
+                    results.push({ok: true, value})
+                }
+                catch(err) {
+                    await writer.exec('ROLLBACK TO batch_item')
+                    await writer.exec('RELEASE batch_item')
+                    results.push({ok: false, error: err})
+                }
+            }
+            await writer.exec('COMMIT')
+        }
+        catch(err) {
+            /* istanbul ignore next */
+            {
+                try {
+                    await writer.exec('ROLLBACK')
+                }
+                catch(err2) {
+                }
+                batch.forEach(w => w.reject(err))
+                return
+            }
+        }
+        batch.forEach((w, i) => {
+            const r = results[i]
+            if (r.ok) w.resolve(r.value)
+            else w.reject(r.error as Error)
+        })
+    }
+    _writer(): SqliteConnection {
+        if (!this.#writer) throw Error('Unexpected: sqlite writer connection is null')
+        return this.#writer
+    }
+    async close() {
+        this.#closed = true
+        const release = await this.#writeMutex.acquire()
+        try {
+            // complete the writes that were queued before closing
+            while (this.#pendingWrites.length > 0) {
+                const batch = this.#pendingWrites
+                this.#pendingWrites = []
+                await this._runWriteBatch(batch)
+            }
+            for (let r of this.#readers) {
+                await r.close()
+            }
+            this.#readers = []
+            if (this.#writer) {
+                await this.#writer.close()
+                this.#writer = null
+            }
+        }
+        finally {
+            release()
+        }
+    }
+}
+
+export default SqliteConnectionManager
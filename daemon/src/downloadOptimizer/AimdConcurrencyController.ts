@@ -0,0 +1,175 @@
+import { randomAlphaString } from "../common/util";
+import { ByteCount, byteCount, byteCountPerSecToNumber, byteCountToNumber, durationMsecToNumber, elapsedSince, nowTimestamp, scaledDurationMsec, Timestamp } from "../interfaces/core";
+import RateEstimator from "./RateEstimator";
+
+// Tunes a limit on the number of simultaneous downloads from the observed throughput
+// and error rate (additive increase, multiplicative decrease):
+//
+// - if too many downloads failed during the last interval, the limit is halved
+// - otherwise, if the limit was reached during the last interval, it is increased by one,
+//   unless the previous increase did not improve the throughput, in which case it is undone
+//
+// The throughput is the aggregate rate of all of the downloads, from a RateEstimator.
+// The limit applies to the active tasks of all callers together (e.g., the chunk downloads of all files).
+
+// the limit is adjusted at most once per interval (on the order of the time constant of the rate estimator)
+const ADJUSTMENT_INTERVAL_MSEC = 10000
+// the fraction of failed downloads in an interval that causes a decrease
+const MAX_ERROR_FRACTION = 0.1
+// the relative improvement in throughput that justifies an increase
+const MIN_RATE_IMPROVEMENT = 0.05
+const DECREASE_FACTOR = 0.5
+
+export interface AimdConcurrencyControllerTask {
+    reportBytesLoaded: (bytesLoaded: ByteCount) => void // cumulative
+    finish: (o: {error: boolean}) => void
+}
+
+export interface AimdConcurrencyControllerStats {
+    limit: number
+    numActive: number
+    estimatedRateBps: number
+    numSucceeded: number
+    numFailed: number
+}
+
+class AimdConcurrencyController {
+    #limit: number
+    #numActive = 0
+    #rateEstimator = new RateEstimator()
+    #intervalTimestamp: Timestamp = nowTimestamp()
+    #intervalNumSucceeded = 0
+    #intervalNumFailed = 0
+    #intervalSaturated = false
+    #previousRateBps: number | null = null
+    #lastIncreased = false
+    #numSucceeded = 0
+    #numFailed = 0
+    #onLimitChangedCallbacks: (() => void)[] = []
+    #onAvailableCallbacks = new Map<string, () => void>()
+    #notifyAvailableScheduled = false
+    constructor(private opts: {initialLimit: number, minLimit: number, maxLimit: number}) {
+        this.#limit = opts.initialLimit
+    }
+    limit() {
+        this._adjustIfDue()
+        return this.#limit
+    }
+    onLimitChanged(callback: () => void) {
+        this.#onLimitChangedCallbacks.push(callback)
+    }
+    numActive() {
+        return this.#numActive
+    }
+    onAvailable(callback: () => void): () => void {
+        // called (asynchronously) when a task finishes or the limit changes, so that more tasks may be started
+        // returns a function that removes the callback
+        const id = randomAlphaString(10)
+        this.#onAvailableCallbacks.set(id, callback)
+        return () => {
+            this.#onAvailableCallbacks.delete(id)
+        }
+    }
+    startTask(): AimdConcurrencyControllerTask {
+        if (this.#numActive === 0) {
+            this.#rateEstimator.reportStart()
+        }
+        this.#numActive ++
+        if (this.#numActive >= this.#limit) this.#intervalSaturated = true
+        let bytesReported = 0
+        let finished = false
+        return {
+            reportBytesLoaded: (bytesLoaded: ByteCount) => {
+                if (finished) return
+                const delta = byteCountToNumber(bytesLoaded) - bytesReported
+                if (delta <= 0) return
+                bytesReported += delta
+                this.#rateEstimator.reportBytes(byteCount(delta))
+            },
+            finish: (o: {error: boolean}) => {
+                if (finished) return
+                finished = true
+                if (o.error) {
+                    this.#intervalNumFailed ++
+                    this.#numFailed ++
+                }
+                else {
+                    this.#intervalNumSucceeded ++
+                    this.#numSucceeded ++
+                }
+                this.#numActive --
+                if (this.#numActive === 0) {
+                    this.#rateEstimator.reportStop()
+                }
+                this._adjustIfDue()
+                this._scheduleNotifyAvailable()
+            }
+        }
+    }
+    async startTaskWhenAvailable(): Promise<AimdConcurrencyControllerTask> {
+        // waits until the number of active tasks is below the limit
+        while (this.#numActive >= this.limit()) {
+            // the demand exceeds the limit
+            this.#intervalSaturated = true
+            await new Promise<void>((resolve) => {
+                const remove = this.onAvailable(() => {
+                    remove()
+                    resolve()
+                })
+            })
+        }
+        return this.startTask()
+    }
+    getStats(): AimdConcurrencyControllerStats {
+        return {
+            limit: this.limit(),
+            numActive: this.#numActive,
+            estimatedRateBps: byteCountPerSecToNumber(this.#rateEstimator.estimatedRateBps()),
+            numSucceeded: this.#numSucceeded,
+            numFailed: this.#numFailed
+        }
+    }
+    _adjustIfDue() {
+        if (elapsedSince(this.#intervalTimestamp) < durationMsecToNumber(scaledDurationMsec(ADJUSTMENT_INTERVAL_MSEC))) return
+        const rateBps = byteCountPerSecToNumber(this.#rateEstimator.estimatedRateBps())
+        const numFinished = this.#intervalNumSucceeded + this.#intervalNumFailed
+        const previousLimit = this.#limit
+        if ((numFinished > 0) && (this.#intervalNumFailed / numFinished > MAX_ERROR_FRACTION)) {
+            this.#limit = Math.max(this.opts.minLimit, Math.floor(this.#limit * DECREASE_FACTOR))
+            this.#lastIncreased = false
+        }
+        else if (this.#intervalSaturated) {
+            if ((this.#lastIncreased) && (this.#previousRateBps !== null) && (rateBps < this.#previousRateBps * (1 + MIN_RATE_IMPROVEMENT))) {
+                // the previous increase did not help
+                this.#limit = Math.max(this.opts.minLimit, this.#limit - 1)
+                this.#lastIncreased = false
+            }
+            else {
+                this.#limit = Math.min(this.opts.maxLimit, this.#limit + 1)
+                this.#lastIncreased = this.#limit > previousLimit
+            }
+        }
+        else {
+            this.#lastIncreased = false
+        }
+        this.#previousRateBps = rateBps
+        this.#intervalTimestamp = nowTimestamp()
+        this.#intervalNumSucceeded = 0
+        this.#intervalNumFailed = 0
+        this.#intervalSaturated = this.#numActive >= this.#limit
+        if (this.#limit !== previousLimit) {
+            this.#onLimitChangedCallbacks.forEach(cb => {cb()})
+            this._scheduleNotifyAvailable()
+        }
+    }
+    _scheduleNotifyAvailable() {
+        if (this.#notifyAvailableScheduled) return
+        this.#notifyAvailableScheduled = true
+        setTimeout(() => {
+            this.#notifyAvailableScheduled = false
+            Array.from(this.#onAvailableCallbacks.values()).forEach(cb => {cb()})
+        }, 1)
+    }
+}
+
+export default AimdConcurrencyController
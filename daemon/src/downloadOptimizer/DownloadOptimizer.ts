@@ -4,7 +4,9 @@ import GarbageMap from "../common/GarbageMap";
 import { randomAlphaString } from "../common/util";
 import { ByteCount, FileKey, fileKeyHash, FileKeyHash, NodeId, scaledDurationMsec } from "../interfaces/core";
 import KacheryP2PNode from "../KacheryP2PNode";
-import createDownloader from "./createDownloader";
+import { KacheryStorageFileWriter } from "../external/ExternalInterface";
+import AimdConcurrencyController, { AimdConcurrencyControllerStats, AimdConcurrencyControllerTask } from "./AimdConcurrencyController";
+import createDownloader, { FileWriterOpts } from "./createDownloader";
 import DownloadOptimizerJob from "./DownloadOptimizerJob";
 import DownloadOptimizerProviderNode from "./DownloadOptimizerProviderNode";
 
@@ -18,20 +20,37 @@ interface DownloadOptimizerTask {
 }
 
 export type FindProvidersFunction = (onFound: (providerNode: DownloadOptimizerProviderNode) => void, onFinished: () => void) => void
-export type CreateDownloaderFunction = (providerNode: DownloadOptimizerProviderNode, fileSize: ByteCount | null, label: string) => Downloader
+export type CreateDownloaderFunction = (providerNode: DownloadOptimizerProviderNode, fileSize: ByteCount | null, label: string, writerOpts: FileWriterOpts) => Downloader
 
 export default class DownloadOptimizer {
     #jobs = new GarbageMap<FileKeyHash, DownloadOptimizerJob>(scaledDurationMsec(60 * 1000 * 60))
     #tasks = new GarbageMap<FileKeyHash, Map<string, DownloadOptimizerTask>>(scaledDurationMsec(60 * 1000 * 60))
     #providerNodes = new GarbageMap<NodeId, DownloadOptimizerProviderNode>(scaledDurationMsec(60 * 1000 * 60))
-    #maxNumSimultaneousFileDownloads = 5
+    // the limits on the number of simultaneous file downloads, and on the number of
+    // simultaneous chunk downloads (for all files with a manifest together), are tuned to the observed throughput
+    #fileConcurrency = new AimdConcurrencyController({initialLimit: 5, minLimit: 1, maxLimit: 50})
+    #chunkConcurrency = new AimdConcurrencyController({initialLimit: 5, minLimit: 1, maxLimit: 40})
+    #concurrencyTasks = new Map<DownloadOptimizerJob, AimdConcurrencyControllerTask>()
+    #manifestDownloads = new Map<FileKeyHash, {dataStream: Promise<DataStreamy>, numTasks: number}>()
     #updateScheduled = false
     #onReadyListeners = new Map<string, () => void>()
     constructor(private node: KacheryP2PNode) {
+        this.#fileConcurrency.onLimitChanged(() => {
+            this._scheduleUpdate()
+        })
+    }
+    chunkConcurrency() {
+        return this.#chunkConcurrency
+    }
+    getConcurrencyStats(): {files: AimdConcurrencyControllerStats, chunks: AimdConcurrencyControllerStats} {
+        return {
+            files: this.#fileConcurrency.getStats(),
+            chunks: this.#chunkConcurrency.getStats()
+        }
     }
     async waitForReady() {
         let numActiveFileDownloads = Array.from(this.#jobs.values()).filter(file => (file.isDownloading())).length
-        if (numActiveFileDownloads < this.#maxNumSimultaneousFileDownloads) return
+        if (numActiveFileDownloads < this.#fileConcurrency.limit()) return
         return new Promise<void>((resolve) => {
             const id = randomAlphaString(10)
             this.#onReadyListeners.set(id, () => {
@@ -41,7 +60,7 @@ export default class DownloadOptimizer {
             })
         })
     }
-    createTask(fileKey: FileKey, fileSize: ByteCount | null, label: string, opts: {fromNode: NodeId | null, numRetries: number}): DataStreamy {
+    createTask(fileKey: FileKey, fileSize: ByteCount | null, label: string, opts: {fromNode: NodeId | null, numRetries: number, storeFile?: boolean, createWriter?: () => KacheryStorageFileWriter}): DataStreamy {
         const taskId = randomAlphaString(10)
         const fkh = fileKeyHash(fileKey)
         const t: DownloadOptimizerTask = {
@@ -71,12 +90,13 @@ export default class DownloadOptimizer {
                     })
                 }
             }
-            const createDownloader0: CreateDownloaderFunction = (providerNode: DownloadOptimizerProviderNode, fileSize: ByteCount, label: string) => {
-                return createDownloader(this.node, fileKey, providerNode, fileSize, label)
+            const createDownloader0: CreateDownloaderFunction = (providerNode: DownloadOptimizerProviderNode, fileSize: ByteCount, label: string, writerOpts: FileWriterOpts) => {
+                return createDownloader(this.node, fileKey, providerNode, fileSize, label, writerOpts)
             }
             j = new DownloadOptimizerJob(fileKey, fileSize, label, findProviders, createDownloader0, {numRetries: opts.numRetries})
             this.#jobs.set(fkh, j)
         }
+        j.addFileWriter(taskId, {storeFile: opts.storeFile !== false, createWriter: opts.createWriter || null})
         j.getProgressStream().onStarted((byteCount: ByteCount) => {
             t.progressStream.producer().start(byteCount)
         })
@@ -103,21 +123,97 @@ export default class DownloadOptimizer {
         this._scheduleUpdate()
         return t.progressStream
     }
+    async createManifestTask(fileKey: FileKey, startDownload: () => Promise<DataStreamy>): Promise<DataStreamy> {
+        // Concurrent requests for the same file with a manifest share a single download of its chunks,
+        // which is cancelled once all of the requests are cancelled
+        // todo: as for the jobs, the options of the first request apply
+        const fkh = fileKeyHash(fileKey)
+        let d = this.#manifestDownloads.get(fkh)
+        if (!d) {
+            const d0 = {dataStream: startDownload(), numTasks: 0}
+            const _remove = () => {
+                if (this.#manifestDownloads.get(fkh) === d0) this.#manifestDownloads.delete(fkh)
+            }
+            d0.dataStream.then((ds: DataStreamy) => {
+                ds.onFinished(_remove)
+                ds.onError(_remove)
+            }).catch(_remove)
+            this.#manifestDownloads.set(fkh, d0)
+            d = d0
+        }
+        const d1 = d
+        d1.numTasks ++
+        let ds: DataStreamy
+        try {
+            ds = await d1.dataStream
+        }
+        catch(err) {
+            d1.numTasks --
+            throw err
+        }
+        const ret = new DataStreamy()
+        ds.onStarted((size: ByteCount | null) => {
+            ret.producer().start(size)
+        })
+        ds.onProgress((progress: DataStreamyProgress) => {
+            ret.producer().setProgress(progress)
+        })
+        ds.onError((err: Error) => {
+            ret.producer().error(err)
+        })
+        ds.onFinished(() => {
+            ret.producer().end()
+        })
+        ret.producer().onCancelled(() => {
+            d1.numTasks --
+            if (d1.numTasks === 0) ds.cancel()
+        })
+        return ret
+    }
     _deleteTask(fileKeyHash: FileKeyHash, taskId: string) {
         const tasks = this.#tasks.get(fileKeyHash)
         if (!tasks) return
         const t = tasks.get(taskId)
         if (!t) return
         tasks.delete(taskId)
+        const j = this.#jobs.get(fileKeyHash)
+        if (j) j.removeFileWriter(taskId)
         if (tasks.size === 0) {
-            const j = this.#jobs.get(fileKeyHash)
             if (j) {
                 j.cancel()
+                this._finishJob(j, {error: false})
                 this.#jobs.delete(fileKeyHash)
             }
         }
         this._scheduleUpdate()
     }
+    getProviderNode(nodeId: NodeId): DownloadOptimizerProviderNode {
+        // provider nodes (with their rate estimates) are shared by all downloads
+        return this._getProviderNode(nodeId)
+    }
+    _startJob(job: DownloadOptimizerJob) {
+        const t = this.#fileConcurrency.startTask()
+        this.#concurrencyTasks.set(job, t)
+        let started = false
+        job.getProgressStream().onProgress((progress: DataStreamyProgress) => {
+            started = true
+            t.reportBytesLoaded(progress.bytesLoaded)
+        })
+        job.getProgressStream().onError(() => {
+            // a file that is not found is not a sign of congestion
+            this._finishJob(job, {error: started})
+        })
+        job.getProgressStream().onFinished(() => {
+            this._finishJob(job, {error: false})
+        })
+        job.start()
+    }
+    _finishJob(job: DownloadOptimizerJob, o: {error: boolean}) {
+        const t = this.#concurrencyTasks.get(job)
+        if (!t) return
+        this.#concurrencyTasks.delete(job)
+        t.finish(o)
+    }
     _getProviderNode(nodeId: NodeId): DownloadOptimizerProviderNode {
         let p = this.#providerNodes.get(nodeId)
         if (p) return p
@@ -161,19 +257,20 @@ export default class DownloadOptimizer {
             }
         }
 
+        const maxNumSimultaneousFileDownloads = this.#fileConcurrency.limit()
         let numActiveFileDownloads = this.#jobs.values().filter(j => (j.isRunning())).length;
         for (let fkh of this.#jobs.keys()) {
-            if (numActiveFileDownloads < this.#maxNumSimultaneousFileDownloads) {
+            if (numActiveFileDownloads < maxNumSimultaneousFileDownloads) {
                 const job = this.#jobs.get(fkh)
                 /* istanbul ignore next */
                 if (!job) throw Error('Unexpected in _update')
                 if ((!job.isRunning()) && (!job.isComplete())) {
-                    job.start()
+                    this._startJob(job)
                     numActiveFileDownloads ++
                 }
             }
         }
-        if (numActiveFileDownloads < this.#maxNumSimultaneousFileDownloads) {
+        if (numActiveFileDownloads < maxNumSimultaneousFileDownloads) {
             this.#onReadyListeners.forEach(listener => {
                 // will self-destruct
                 listener()
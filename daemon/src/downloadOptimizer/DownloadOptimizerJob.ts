@@ -1,8 +1,10 @@
 import DataStreamy, { DataStreamyProgress } from "../common/DataStreamy";
 import GarbageMap from "../common/GarbageMap";
 import { ByteCount, byteCount, durationMsecToNumber, elapsedSince, FileKey, NodeId, nowTimestamp, scaledDurationMsec } from "../interfaces/core";
+import { KacheryStorageFileWriter } from "../external/ExternalInterface";
+import { FileWriterOpts } from "./createDownloader";
 import { CreateDownloaderFunction, Downloader, FindProvidersFunction } from "./DownloadOptimizer";
-import DownloadOptimizerProviderNode from "./DownloadOptimizerProviderNode";
+import DownloadOptimizerProviderNode, { MAX_NUM_ACTIVE_DOWNLOADS_PER_PROVIDER } from "./DownloadOptimizerProviderNode";
 
 export default class DownloadOptimizerJob {
     #currentDownloader: {start: () => Promise<DataStreamy>, stop: () => void} | null = null
@@ -10,6 +12,7 @@ export default class DownloadOptimizerJob {
     #progressStream: DataStreamy = new DataStreamy()
     #isRunning = false
     #isComplete = false
+    #fileWriters = new Map<string, {storeFile: boolean, createWriter: (() => KacheryStorageFileWriter) | null}>() // by task ID
     constructor(private fileKey_: FileKey, private fileSize_: ByteCount | null, private label_: string, private findProviders: FindProvidersFunction, private createDownloader: CreateDownloaderFunction, private opts: {numRetries: number}) {
     }
     fileKey() {
@@ -21,6 +24,50 @@ export default class DownloadOptimizerJob {
     label() {
         return this.label_
     }
+    addFileWriter(taskId: string, o: {storeFile: boolean, createWriter: (() => KacheryStorageFileWriter) | null}) {
+        // takes effect for the next download attempt
+        this.#fileWriters.set(taskId, o)
+    }
+    removeFileWriter(taskId: string) {
+        // the task was cancelled or failed: its writer is not created for the next attempts,
+        // and the writer of the current attempt is dropped
+        this.#fileWriters.delete(taskId)
+    }
+    _writerOpts(): FileWriterOpts {
+        const writerOpts: FileWriterOpts = {storeFile: false, createWriters: []}
+        this.#fileWriters.forEach((o, taskId) => {
+            if (o.storeFile) writerOpts.storeFile = true
+            const createWriter = o.createWriter
+            if (createWriter) writerOpts.createWriters.push(() => (this._createTaskFileWriter(taskId, createWriter)))
+        })
+        return writerOpts
+    }
+    _createTaskFileWriter(taskId: string, createWriter: () => KacheryStorageFileWriter): KacheryStorageFileWriter {
+        // once the task is removed, the data no longer goes to its writer, so that the download
+        // can still succeed for the other tasks
+        const w = createWriter()
+        const _isRemoved = () => (!this.#fileWriters.has(taskId))
+        return {
+            write: (buf: Buffer) => {
+                if (_isRemoved()) return true
+                return w.write(buf)
+            },
+            drained: async () => {
+                if (_isRemoved()) return
+                await w.drained()
+            },
+            end: async () => {
+                if (_isRemoved()) {
+                    w.cancel()
+                    return
+                }
+                await w.end()
+            },
+            cancel: () => {
+                w.cancel()
+            }
+        }
+    }
     isDownloading() {
         return this.#currentDownloader ? true : false;
     }
@@ -106,7 +153,7 @@ export default class DownloadOptimizerJob {
                         return
                     }
                     // choose the best non-busy provider node
-                    const nonBusyCandidates = providerCandidates.values().filter(pn => (!pn.isDownloading()))
+                    const nonBusyCandidates = providerCandidates.values().filter(pn => (pn.numActiveDownloads() < MAX_NUM_ACTIVE_DOWNLOADS_PER_PROVIDER))
                     if (nonBusyCandidates.length === 0) {
                         // they are all busy, come back in a second
                         setTimeout(() => {
@@ -117,7 +164,7 @@ export default class DownloadOptimizerJob {
                     const pn = chooseFastestProviderNode(nonBusyCandidates)
                     if (!pn) throw Error('Unexpected, pn is null in update')
                     providerCandidates.delete(pn.nodeId())
-                    currentDownloader = this.createDownloader(pn, this.fileSize(), this.label())
+                    currentDownloader = this.createDownloader(pn, this.fileSize(), this.label(), this._writerOpts())
                     currentDownloader.start().then((ds: DataStreamy) => {
                         ds.onError((err: Error) => {
                             // error downloading
@@ -1,9 +1,13 @@
 import { ByteCount, NodeId } from "../interfaces/core";
 import RateEstimator from "./RateEstimator";
 
+// the maximum number of simultaneous downloads from a single provider node
+export const MAX_NUM_ACTIVE_DOWNLOADS_PER_PROVIDER = 5
+
 class DownloadOptimizerProviderNode {
     #nodeId: NodeId
     #rateEstimator = new RateEstimator();
+    #numActiveDownloads = 0
     constructor(nodeId: NodeId) {
         this.#nodeId = nodeId
     }
@@ -11,20 +15,34 @@ class DownloadOptimizerProviderNode {
         return this.#nodeId
     }
     estimatedRateBps() {
+        // the aggregate rate over all of the active downloads from this node
         return this.#rateEstimator.estimatedRateBps()
     }
     isDownloading() {
-        return this.#rateEstimator.isRunning()
+        return this.#numActiveDownloads > 0
+    }
+    numActiveDownloads() {
+        return this.#numActiveDownloads
     }
     reportStart = () => {
-        this.#rateEstimator.reportStart()
+        if (this.#numActiveDownloads === 0) {
+            this.#rateEstimator.reportStart()
+        }
+        this.#numActiveDownloads ++
     }
     reportStop = () => {
-        this.#rateEstimator.reportStop()
+        if (this.#numActiveDownloads === 0) {
+            /* istanbul ignore next */
+            throw Error('Unexpected: reportStop called with no active downloads')
+        }
+        this.#numActiveDownloads --
+        if (this.#numActiveDownloads === 0) {
+            this.#rateEstimator.reportStop()
+        }
     }
     reportBytes = (n: ByteCount) => {
         this.#rateEstimator.reportBytes(n)
     }
 }
 
-export default DownloadOptimizerProviderNode;
\ No newline at end of file
+export default DownloadOptimizerProviderNode;
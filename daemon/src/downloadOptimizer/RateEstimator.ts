@@ -1,5 +1,4 @@
-import { ByteCount, byteCount, byteCountToNumber, elapsedSince, nowTimestamp, Timestamp } from "../interfaces/core";
-import { byteCountPerSec, ByteCountPerSec, byteCountPerSecToNumber } from "../udp/UdpCongestionManager";
+import { ByteCount, byteCount, byteCountPerSec, ByteCountPerSec, byteCountPerSecToNumber, byteCountToNumber, elapsedSince, nowTimestamp, Timestamp } from "../interfaces/core";
 
 const FILTER_TIME_CONSTANT_SEC = 10;
 
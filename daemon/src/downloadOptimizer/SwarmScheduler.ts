@@ -0,0 +1,313 @@
+import DataStreamy from "../common/DataStreamy";
+import { ByteCount, byteCount, byteCountPerSecToNumber, byteCountToNumber, durationMsecToNumber, elapsedSince, NodeId, nowTimestamp, scaledDurationMsec, Timestamp } from "../interfaces/core";
+import AimdConcurrencyController, { AimdConcurrencyControllerTask } from "./AimdConcurrencyController";
+import { Downloader } from "./DownloadOptimizer";
+import DownloadOptimizerProviderNode, { MAX_NUM_ACTIVE_DOWNLOADS_PER_PROVIDER } from "./DownloadOptimizerProviderNode";
+
+// Schedules the download of the chunks of a file across all of the providers of the file.
+//
+// - Each chunk is assigned to the provider with the best expected throughput for one more
+//   download (its estimated rate divided by its number of active downloads, plus one),
+//   so faster providers take on proportionally more chunks.
+// - Once there are no more unassigned chunks, a provider with a free slot takes over
+//   (re-issues) a chunk in progress elsewhere if it is expected to finish that chunk
+//   substantially sooner. This steals work from slow providers and re-issues stragglers
+//   (including stalled downloads) near the end. Whichever attempt finishes first wins,
+//   and the others are stopped.
+
+// the maximum number of simultaneous chunk downloads for the file
+// (a concurrency controller, if given, also limits the chunk downloads of all files together)
+const MAX_NUM_ACTIVE_CHUNKS = 40
+// a chunk is re-issued to another provider if that is expected to finish it this many times sooner
+const STEAL_FACTOR = 1.5
+// an attempt with no progress for this long is considered stalled
+const STALL_DURATION_MSEC = 10000
+// the chunks in progress are re-examined (for stragglers) at this interval
+const UPDATE_INTERVAL_MSEC = 1000
+// a provider that fails this many times is dropped
+const MAX_NUM_PROVIDER_FAILURES = 3
+// a chunk that fails this many times results in an error
+// (more than the above, so that a single bad provider cannot cause the download to fail)
+const MAX_NUM_CHUNK_FAILURES = 5
+
+export interface SwarmChunk {
+    size: ByteCount
+}
+
+interface SwarmAttempt {
+    chunkIndex: number
+    providerNode: DownloadOptimizerProviderNode
+    downloader: Downloader
+    dataStream: DataStreamy | null
+    lastProgressTimestamp: Timestamp
+    stopped: boolean
+    concurrencyTask: AimdConcurrencyControllerTask | null
+}
+
+export type SwarmDownloadChunkFunction = (chunkIndex: number, providerNode: DownloadOptimizerProviderNode) => Downloader
+export type SwarmCompleteChunkFunction = (chunkIndex: number) => Promise<void>
+
+class SwarmScheduler {
+    #providerNodes = new Map<NodeId, DownloadOptimizerProviderNode>()
+    #providerNumFailures = new Map<NodeId, number>()
+    #pendingChunkIndices: number[] = [] // not yet assigned, in order
+    #attempts = new Map<number, SwarmAttempt[]>() // active attempts, by chunk index
+    #numAttemptsByProviderNode = new Map<NodeId, number>()
+    #chunkNumFailures = new Map<number, number>()
+    #completeChunkIndices = new Set<number>()
+    #numBytesComplete = 0
+    #findFinished = false
+    #running = false
+    #complete = false
+    #updateTimer: NodeJS.Timeout | null = null
+    #removeOnAvailable: (() => void) | null = null
+    #resolve: (() => void) | null = null
+    #reject: ((err: Error) => void) | null = null
+    #onProgressCallbacks: ((bytesLoaded: ByteCount) => void)[] = []
+    constructor(private chunks: SwarmChunk[], private downloadChunk: SwarmDownloadChunkFunction, private completeChunk: SwarmCompleteChunkFunction, private concurrency: AimdConcurrencyController | null = null) {
+        this.#pendingChunkIndices = chunks.map((c, i) => i)
+    }
+    run(): Promise<void> {
+        return new Promise<void>((resolve, reject) => {
+            this.#resolve = resolve
+            this.#reject = reject
+            this.#running = true
+            this.#updateTimer = setInterval(() => {
+                this._update()
+            }, durationMsecToNumber(scaledDurationMsec(UPDATE_INTERVAL_MSEC)))
+            if (this.concurrency) {
+                // a chunk download of another file may have finished
+                this.#removeOnAvailable = this.concurrency.onAvailable(() => {
+                    this._update()
+                })
+            }
+            this._update()
+        })
+    }
+    addProviderNode(providerNode: DownloadOptimizerProviderNode) {
+        if (this.#providerNodes.has(providerNode.nodeId())) return
+        if ((this.#providerNumFailures.get(providerNode.nodeId()) || 0) >= MAX_NUM_PROVIDER_FAILURES) return
+        this.#providerNodes.set(providerNode.nodeId(), providerNode)
+        this._update()
+    }
+    setFindFinished() {
+        this.#findFinished = true
+        this._update()
+    }
+    numProviderNodes() {
+        return this.#providerNodes.size
+    }
+    onProgress(callback: (bytesLoaded: ByteCount) => void) {
+        this.#onProgressCallbacks.push(callback)
+    }
+    bytesLoaded(): ByteCount {
+        // complete chunks, plus the most advanced attempt for each chunk in progress
+        let ret = this.#numBytesComplete
+        this.#attempts.forEach((attempts) => {
+            let x = 0
+            attempts.forEach(a => {
+                if (a.dataStream) x = Math.max(x, byteCountToNumber(a.dataStream.bytesLoaded()))
+            })
+            ret += x
+        })
+        return byteCount(ret)
+    }
+    cancel() {
+        this._finish(Error('Cancelled'))
+    }
+    _update() {
+        if ((!this.#running) || (this.#complete)) return
+        if (this.#completeChunkIndices.size === this.chunks.length) {
+            this._finish(null)
+            return
+        }
+        if ((this.#findFinished) && (this.#providerNodes.size === 0)) {
+            this._finish(Error('No providers available for file'))
+            return
+        }
+        while (this._canStartAttempt()) {
+            const providerNodes = this._availableProviderNodes()
+            if (providerNodes.length === 0) break
+            if (this.#pendingChunkIndices.length > 0) {
+                const chunkIndex = this.#pendingChunkIndices.shift() as number
+                this._startAttempt(chunkIndex, providerNodes[0])
+                continue
+            }
+            let started = false
+            for (let pn of providerNodes) {
+                const chunkIndex = this._chooseChunkToReissue(pn)
+                if (chunkIndex !== null) {
+                    this._startAttempt(chunkIndex, pn)
+                    started = true
+                    break
+                }
+            }
+            if (!started) break
+        }
+    }
+    _canStartAttempt() {
+        if (this._numActiveAttempts() >= MAX_NUM_ACTIVE_CHUNKS) return false
+        // the limit of the concurrency controller applies to its active tasks for all files
+        if ((this.concurrency) && (this.concurrency.numActive() >= this.concurrency.limit())) return false
+        return true
+    }
+    _availableProviderNodes(): DownloadOptimizerProviderNode[] {
+        // the providers with a free slot, in order of expected throughput for one additional download
+        const ret: {pn: DownloadOptimizerProviderNode, score: number}[] = []
+        for (let pn of this.#providerNodes.values()) {
+            const n = this._numAttemptsForProviderNode(pn)
+            if (n >= MAX_NUM_ACTIVE_DOWNLOADS_PER_PROVIDER) continue
+            ret.push({pn, score: byteCountPerSecToNumber(pn.estimatedRateBps()) / (n + 1)})
+        }
+        return ret.sort((a, b) => (b.score - a.score)).map(x => x.pn)
+    }
+    _chooseChunkToReissue(pn: DownloadOptimizerProviderNode): number | null {
+        // the chunk in progress (on another provider) with the longest expected remaining time,
+        // provided that pn is expected to download it substantially sooner
+        let ret: number | null = null
+        let longestRemainingSec = 0
+        for (let [chunkIndex, attempts] of this.#attempts.entries()) {
+            if (attempts.length !== 1) continue // at most one duplicate per chunk
+            const a = attempts[0]
+            if (a.providerNode.nodeId() === pn.nodeId()) continue
+            const size = byteCountToNumber(this.chunks[chunkIndex].size)
+            const remainingBytes = size - (a.dataStream ? byteCountToNumber(a.dataStream.bytesLoaded()) : 0)
+            const stalled = elapsedSince(a.lastProgressTimestamp) > durationMsecToNumber(scaledDurationMsec(STALL_DURATION_MSEC))
+            const theirRate = byteCountPerSecToNumber(a.providerNode.estimatedRateBps()) / Math.max(1, this._numAttemptsForProviderNode(a.providerNode))
+            const remainingSec = stalled ? Infinity : remainingBytes / Math.max(theirRate, 1)
+            const myRate = byteCountPerSecToNumber(pn.estimatedRateBps()) / (this._numAttemptsForProviderNode(pn) + 1)
+            const mySec = size / Math.max(myRate, 1)
+            if ((mySec * STEAL_FACTOR < remainingSec) && (remainingSec > longestRemainingSec)) {
+                ret = chunkIndex
+                longestRemainingSec = remainingSec
+            }
+        }
+        return ret
+    }
+    _numAttemptsForProviderNode(pn: DownloadOptimizerProviderNode) {
+        return this.#numAttemptsByProviderNode.get(pn.nodeId()) || 0
+    }
+    _numActiveAttempts() {
+        let ret = 0
+        this.#attempts.forEach(attempts => {ret += attempts.length})
+        return ret
+    }
+    _startAttempt(chunkIndex: number, providerNode: DownloadOptimizerProviderNode) {
+        const attempt: SwarmAttempt = {
+            chunkIndex,
+            providerNode,
+            downloader: this.downloadChunk(chunkIndex, providerNode),
+            dataStream: null,
+            lastProgressTimestamp: nowTimestamp(),
+            stopped: false,
+            concurrencyTask: this.concurrency ? this.concurrency.startTask() : null
+        }
+        const attempts = this.#attempts.get(chunkIndex) || []
+        attempts.push(attempt)
+        this.#attempts.set(chunkIndex, attempts)
+        this.#numAttemptsByProviderNode.set(providerNode.nodeId(), this._numAttemptsForProviderNode(providerNode) + 1)
+        attempt.downloader.start().then((ds: DataStreamy) => {
+            attempt.dataStream = ds
+            ds.onProgress(() => {
+                attempt.lastProgressTimestamp = nowTimestamp()
+                if (attempt.concurrencyTask) attempt.concurrencyTask.reportBytesLoaded(ds.bytesLoaded())
+                this._reportProgress()
+            })
+            ds.onError((err: Error) => {
+                this._handleAttemptError(attempt, err)
+            })
+            ds.onFinished(() => {
+                if (attempt.stopped) return
+                this.completeChunk(chunkIndex).then(() => {
+                    this._handleAttemptFinished(attempt)
+                }).catch((err: Error) => {
+                    this._handleAttemptError(attempt, err)
+                })
+            })
+        }).catch((err: Error) => {
+            this._handleAttemptError(attempt, err)
+        })
+    }
+    _removeAttempt(attempt: SwarmAttempt, o: {error: boolean} = {error: false}) {
+        if (attempt.concurrencyTask) attempt.concurrencyTask.finish(o)
+        const n = this._numAttemptsForProviderNode(attempt.providerNode)
+        if (n <= 1) this.#numAttemptsByProviderNode.delete(attempt.providerNode.nodeId())
+        else this.#numAttemptsByProviderNode.set(attempt.providerNode.nodeId(), n - 1)
+        const attempts = (this.#attempts.get(attempt.chunkIndex) || []).filter(a => (a !== attempt))
+        if (attempts.length > 0) this.#attempts.set(attempt.chunkIndex, attempts)
+        else this.#attempts.delete(attempt.chunkIndex)
+    }
+    _handleAttemptFinished(attempt: SwarmAttempt) {
+        if ((this.#complete) || (attempt.stopped)) return
+        this._removeAttempt(attempt)
+        if (!this.#completeChunkIndices.has(attempt.chunkIndex)) {
+            this.#completeChunkIndices.add(attempt.chunkIndex)
+            this.#numBytesComplete += byteCountToNumber(this.chunks[attempt.chunkIndex].size)
+        }
+        // stop the other attempts for this chunk
+        const others = this.#attempts.get(attempt.chunkIndex) || []
+        others.forEach(a => {
+            a.stopped = true
+            this._removeAttempt(a)
+            a.downloader.stop()
+        })
+        this._reportProgress()
+        this._update()
+    }
+    _handleAttemptError(attempt: SwarmAttempt, err: Error) {
+        if ((this.#complete) || (attempt.stopped)) return
+        attempt.stopped = true
+        this._removeAttempt(attempt, {error: true})
+        if (this.#completeChunkIndices.has(attempt.chunkIndex)) return
+        const nodeId = attempt.providerNode.nodeId()
+        const numProviderFailures = (this.#providerNumFailures.get(nodeId) || 0) + 1
+        this.#providerNumFailures.set(nodeId, numProviderFailures)
+        if (numProviderFailures >= MAX_NUM_PROVIDER_FAILURES) {
+            console.warn(`Dropping provider ${nodeId.slice(0, 6)} from swarm download: ${err.message}`)
+            this.#providerNodes.delete(nodeId)
+        }
+        const numChunkFailures = (this.#chunkNumFailures.get(attempt.chunkIndex) || 0) + 1
+        this.#chunkNumFailures.set(attempt.chunkIndex, numChunkFailures)
+        if (numChunkFailures >= MAX_NUM_CHUNK_FAILURES) {
+            this._finish(err)
+            return
+        }
+        if (!this.#attempts.has(attempt.chunkIndex)) {
+            // no other attempt in progress for this chunk, so it goes back to the front of the queue
+            this.#pendingChunkIndices.unshift(attempt.chunkIndex)
+        }
+        this._update()
+    }
+    _reportProgress() {
+        const bytesLoaded = this.bytesLoaded()
+        this.#onProgressCallbacks.forEach(cb => {cb(bytesLoaded)})
+    }
+    _finish(err: Error | null) {
+        if (this.#complete) return
+        this.#complete = true
+        if (this.#updateTimer) {
+            clearInterval(this.#updateTimer)
+            this.#updateTimer = null
+        }
+        if (this.#removeOnAvailable) {
+            this.#removeOnAvailable()
+            this.#removeOnAvailable = null
+        }
+        this.#attempts.forEach(attempts => {
+            attempts.forEach(a => {
+                a.stopped = true
+                if (a.concurrencyTask) a.concurrencyTask.finish({error: false})
+                a.downloader.stop()
+            })
+        })
+        this.#attempts.clear()
+        if (err) {
+            this.#reject && this.#reject(err)
+        }
+        else {
+            this.#resolve && this.#resolve()
+        }
+    }
+}
+
+export default SwarmScheduler
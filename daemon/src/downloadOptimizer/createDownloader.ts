@@ -1,5 +1,6 @@
 import { TIMEOUTS } from "../common/constants"
 import DataStreamy from "../common/DataStreamy"
+import { KacheryStorageFileWriter } from "../external/ExternalInterface"
 import { ByteCount, byteCount, byteCountToNumber, elapsedSince, FileKey, nowTimestamp } from "../interfaces/core"
 import { DownloadFileDataRequestData, isDownloadFileDataResponseData } from "../interfaces/NodeToNodeRequest"
 import KacheryP2PNode from "../KacheryP2PNode"
@@ -7,7 +8,12 @@ import { DownloadFileDataMethod } from "../methodOptimizers/DownloadFileDataMeth
 import { Downloader } from "./DownloadOptimizer"
 import DownloadOptimizerProviderNode from "./DownloadOptimizerProviderNode"
 
-const createDownloader = (node: KacheryP2PNode, fileKey: FileKey, providerNode: DownloadOptimizerProviderNode, fileSize: ByteCount, label: string): Downloader => {
+export type FileWriterOpts = {
+    storeFile: boolean, // whether to store the downloaded file in the kachery storage
+    createWriters: (() => KacheryStorageFileWriter)[] // additional destinations of the downloaded data
+}
+
+const createDownloader = (node: KacheryP2PNode, fileKey: FileKey, providerNode: DownloadOptimizerProviderNode, fileSize: ByteCount, label: string, writerOpts: FileWriterOpts): Downloader => {
     let _cancelled = false
     const nodeId = providerNode.nodeId()
     let o: {dataStream: DataStreamy, method: DownloadFileDataMethod} | null = null
@@ -27,7 +33,6 @@ const createDownloader = (node: KacheryP2PNode, fileKey: FileKey, providerNode:
             ret.producer().end()
             return ret
         }
-        const _data: Buffer[] = []
         const n = node.remoteNodeManager().getRemoteNode(nodeId)
         /* istanbul ignore next */
         if (!n) {
@@ -67,11 +72,27 @@ const createDownloader = (node: KacheryP2PNode, fileKey: FileKey, providerNode:
             throw Error('Unexpected: no stream ID')
         }        
         o = await n.downloadFileData(responseData.streamId, {method: 'default'})
+        // the data goes directly to a temporary file in the storage (verified against the sha1 when finished)
+        // and/or to the other writers (e.g., at the offset of a chunk in a file being assembled)
+        const writers: KacheryStorageFileWriter[] = []
+        if (writerOpts.storeFile) writers.push(node.kacheryStorageManager().createFileWriter(fileKey.sha1))
+        writerOpts.createWriters.forEach(createWriter => {writers.push(createWriter())})
+        const writer = combineFileWriters(writers)
+        // report to the provider node, for its rate estimate
+        providerNode.reportStart()
+        let reportedStop = false
+        const _reportStop = () => {
+            if (reportedStop) return
+            reportedStop = true
+            providerNode.reportStop()
+        }
         o.dataStream.onError(err => {
             if (!o) throw Error('Unexpected in onError of createDownloader')
             const bytesLoaded = ret.bytesLoaded()
             const elapsedSec = elapsedSince(timestamp) / 1000
             console.log(`Error downloading file data. Downloaded ${formatByteCount(ret.bytesLoaded())} bytes in ${elapsedSec} sec from ${nodeId.slice(0, 6)} using ${o.method}`)
+            _reportStop()
+            writer.cancel()
             ret.producer().error(err)
         })
         o.dataStream.onFinished(() => {
@@ -80,24 +101,37 @@ const createDownloader = (node: KacheryP2PNode, fileKey: FileKey, providerNode:
             const elapsedSec = elapsedSince(timestamp) / 1000
             const rate = (byteCountToNumber(bytesLoaded) / 1e6) / elapsedSec
             console.info(`${label}: Downloaded ${formatByteCount(ret.bytesLoaded())} in ${elapsedSec} sec [${rate.toFixed(3)} MiB/sec] from ${nodeId.slice(0, 6)} using ${o.method}`)
-            const data = Buffer.concat(_data)
-            node.kacheryStorageManager().storeFile(fileKey.sha1, data).then(() => {
+            _reportStop()
+            writer.end().then(() => {
                 ret.producer().end()
             }).catch((err: Error) => {
                 ret.producer().error(err)
             })
-            
         })
         o.dataStream.onStarted((size: ByteCount) => {
             ret.producer().start(size)
         })
+        let paused = false
         o.dataStream.onData((buf: Buffer) => {
-            _data.push(buf)
+            if (!o) throw Error('Unexpected in onData of createDownloader')
+            providerNode.reportBytes(byteCount(buf.length))
+            if ((!writer.write(buf)) && (!paused)) {
+                // the data arrives faster than it is written to disk, so we hold back the incoming
+                // stream (where the transfer method supports it) until the writers catch up
+                paused = true
+                const dataStream = o.dataStream
+                dataStream.pause()
+                writer.drained().then(() => {
+                    paused = false
+                    dataStream.resume()
+                })
+            }
             ret.producer().data(buf)
         })
         ret.producer().onCancelled(() => {
             if (!o) throw Error('Unexpected in onCancelled of createDownloader')
             o.dataStream.cancel()
+            writer.cancel()
         })
         return ret
     }
@@ -111,6 +145,27 @@ const createDownloader = (node: KacheryP2PNode, fileKey: FileKey, providerNode:
     }
 }
 
+const combineFileWriters = (writers: KacheryStorageFileWriter[]): KacheryStorageFileWriter => {
+    return {
+        write: (buf: Buffer) => {
+            let ok = true
+            writers.forEach(w => {
+                if (!w.write(buf)) ok = false
+            })
+            return ok
+        },
+        drained: async () => {
+            await Promise.all(writers.map(w => w.drained()))
+        },
+        end: async () => {
+            await Promise.all(writers.map(w => w.end()))
+        },
+        cancel: () => {
+            writers.forEach(w => {w.cancel()})
+        }
+    }
+}
+
 export const formatByteCount = (n: ByteCount) => {
     const a = byteCountToNumber(n)
     if (a < 10000) {
@@ -1,5 +1,5 @@
 import DataStreamy from "../common/DataStreamy"
-import { Address, ByteCount, DurationMsec, FeedId, FeedName, FileKey, JSONObject, LocalFilePath, NodeId, Port, PrivateKey, Sha1Hash, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, UrlPath } from "../interfaces/core"
+import { Address, ByteCount, DurationMsec, FeedId, FeedName, FileKey, FileManifest, JSONObject, LocalFilePath, MessageCount, NodeId, Port, PrivateKey, Sha1Hash, Signature, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, UrlPath } from "../interfaces/core"
 import MutableManager from "../mutables/MutableManager"
 import NodeStats from "../NodeStats"
 
@@ -41,11 +41,29 @@ export type StartWebSocketServerFunction = (port: Port, nodeId: NodeId) => Promi
 
 export type CreateWebSocketFunction = (url: string, opts: {timeoutMsec: DurationMsec}) => WebSocketInterface
 
+export interface KacheryStorageFileWriter {
+    // incrementally writes the content of a file with a known sha1 to the storage
+    write: (buf: Buffer) => boolean // false if the data is buffered beyond the limit (wait for drained() before writing more)
+    drained: () => Promise<void> // resolves once the buffered data is below the limit
+    end: () => Promise<void> // verifies the sha1 and moves the file into place
+    cancel: () => void
+}
+
+export interface KacheryStorageFileAssembler {
+    // assembles a file from the chunks of its manifest, each written at its offset as it arrives (in any order)
+    createChunkWriter: (chunkIndex: number) => KacheryStorageFileWriter // end() verifies the sha1 of the chunk
+    isChunkComplete: (chunkIndex: number) => boolean
+    finalize: () => Promise<void> // verifies the sha1 of the entire file and moves it into place
+    cancel: () => void
+}
+
 export interface KacheryStorageManagerInterface {
     hasLocalFile: (fileKey: FileKey) => Promise<boolean>
     findFile: (fileKey: FileKey) => Promise<{found: boolean, size: ByteCount, localFilePath: LocalFilePath | null}>
     getFileReadStream: (fileKey: FileKey, startByte?: ByteCount, endByte?: ByteCount) => Promise<DataStreamy>
     storeFile: (sha1: Sha1Hash, data: Buffer) => Promise<void>
+    createFileWriter: (sha1: Sha1Hash) => KacheryStorageFileWriter
+    createFileAssembler: (manifest: FileManifest) => Promise<KacheryStorageFileAssembler>
     storeLocalFile: (localFilePath: LocalFilePath) => Promise<{sha1: Sha1Hash, manifestSha1: Sha1Hash | null}>
     linkLocalFile: (localFilePath: LocalFilePath, o: {size: number, mtime: number}) => Promise<{sha1: Sha1Hash, manifestSha1: Sha1Hash | null}>
     storeFileFromStream: (stream: DataStreamy, fileSize: ByteCount, o: {calculateHashOnly: boolean}) => Promise<{sha1: Sha1Hash, manifestSha1: Sha1Hash | null}>
@@ -63,8 +81,13 @@ export interface LocalFeedManagerInterface {
     getPrivateKeyForFeed: (feedId: FeedId) => Promise<PrivateKey | null>
     feedExistsLocally: (feedId: FeedId) => Promise<boolean>
     getSignedSubfeedMessages: (feedId: FeedId, subfeedHash: SubfeedHash) => Promise<SignedSubfeedMessage[]>
+    getSignedSubfeedMessagesRange: (feedId: FeedId, subfeedHash: SubfeedHash, start: number, end: number | null) => Promise<SignedSubfeedMessage[]>
+    getNumSignedSubfeedMessages: (feedId: FeedId, subfeedHash: SubfeedHash) => Promise<MessageCount>
+    getSubfeedVerificationCheckpoint: (feedId: FeedId, subfeedHash: SubfeedHash) => Promise<{numVerifiedMessages: MessageCount, lastSignature: Signature} | null>
+    setSubfeedVerificationCheckpoint: (feedId: FeedId, subfeedHash: SubfeedHash, numVerifiedMessages: MessageCount, lastSignature: Signature) => Promise<void>
     getSubfeedAccessRules: (feedId: FeedId, subfeedHash: SubfeedHash) => Promise<SubfeedAccessRules | null>
-    appendSignedMessagesToSubfeed: (feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[]) => Promise<void> // synchronous???!!!
+    // verified: the messages have been verified, so the verification checkpoint is advanced in the same write
+    appendSignedMessagesToSubfeed: (feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[], opts?: {verified: boolean}) => Promise<void> // synchronous???!!!
     setSubfeedAccessRules: (feedId: FeedId, subfeedHash: SubfeedHash, accessRules: SubfeedAccessRules) => Promise<void> // synchronous???!!!
 }
 
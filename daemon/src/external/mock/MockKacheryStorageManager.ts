@@ -1,6 +1,7 @@
 import crypto from 'crypto'
 import DataStreamy from "../../common/DataStreamy"
 import { byteCount, ByteCount, byteCountToNumber, FileKey, FileManifest, FileManifestChunk, localFilePath, LocalFilePath, Sha1Hash } from "../../interfaces/core"
+import { KacheryStorageFileAssembler, KacheryStorageFileWriter } from '../ExternalInterface'
 import { MockNodeDefects } from './MockNodeDaemon'
 
 export default class MockKacheryStorageManager {
@@ -59,6 +60,67 @@ export default class MockKacheryStorageManager {
             throw Error(`Unexpected hash for storing file: ${fileKey.sha1} <> ${sha1}`)
         }
     }
+    createFileWriter(sha1: Sha1Hash): KacheryStorageFileWriter {
+        let buffers: Buffer[] = []
+        return {
+            write: (buf: Buffer) => {
+                buffers.push(buf)
+                return true
+            },
+            drained: async () => {
+            },
+            end: async () => {
+                const data = Buffer.concat(buffers)
+                buffers = []
+                await this.storeFile(sha1, data)
+            },
+            cancel: () => {
+                buffers = []
+            }
+        }
+    }
+    async createFileAssembler(manifest: FileManifest): Promise<KacheryStorageFileAssembler> {
+        const chunkContents = new Map<number, Buffer>()
+        return {
+            createChunkWriter: (chunkIndex: number) => {
+                let buffers: Buffer[] = []
+                return {
+                    write: (buf: Buffer) => {
+                        buffers.push(buf)
+                        return true
+                    },
+                    drained: async () => {
+                    },
+                    end: async () => {
+                        const content = Buffer.concat(buffers)
+                        const chunkSha1 = crypto.createHash('sha1').update(content).digest('hex') as any as Sha1Hash
+                        if (chunkSha1 !== manifest.chunks[chunkIndex].sha1) {
+                            throw Error(`Unexpected hash for chunk: ${chunkSha1} <> ${manifest.chunks[chunkIndex].sha1}`)
+                        }
+                        chunkContents.set(chunkIndex, content)
+                    },
+                    cancel: () => {
+                        buffers = []
+                    }
+                }
+            },
+            isChunkComplete: (chunkIndex: number) => {
+                return chunkContents.has(chunkIndex)
+            },
+            finalize: async () => {
+                const chunks: Buffer[] = []
+                manifest.chunks.forEach((c, i) => {
+                    const content = chunkContents.get(i)
+                    if (!content) throw Error('Missing chunk in mock file assembler')
+                    chunks.push(content)
+                })
+                await this.storeFile(manifest.sha1, Buffer.concat(chunks))
+            },
+            cancel: () => {
+                chunkContents.clear()
+            }
+        }
+    }
     async storeLocalFile(localFilePath: LocalFilePath): Promise<{sha1: Sha1Hash, manifestSha1: Sha1Hash | null}> {
         throw Error('Not implemented in MockKacheryStorageManager')
     }
@@ -1,5 +1,5 @@
 import { createKeyPair, publicKeyHexToFeedId, publicKeyToHex } from '../../common/crypto_util';
-import { FeedId, FeedName, PrivateKey, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash } from '../../interfaces/core';
+import { FeedId, FeedName, messageCount, MessageCount, PrivateKey, Signature, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash } from '../../interfaces/core';
 
 export default class MockLocalFeedManager {
     #feeds = new Map<FeedId, MockFeed>()
@@ -40,18 +40,40 @@ export default class MockLocalFeedManager {
         if (!f) return []
         return await f.getSignedSubfeedMessages(subfeedHash)
     }
+    async getSignedSubfeedMessagesRange(feedId: FeedId, subfeedHash: SubfeedHash, start: number, end: number | null): Promise<SignedSubfeedMessage[]> {
+        const messages = await this.getSignedSubfeedMessages(feedId, subfeedHash)
+        return messages.slice(start, end !== null ? end : undefined)
+    }
+    async getNumSignedSubfeedMessages(feedId: FeedId, subfeedHash: SubfeedHash): Promise<MessageCount> {
+        const messages = await this.getSignedSubfeedMessages(feedId, subfeedHash)
+        return messageCount(messages.length)
+    }
+    async getSubfeedVerificationCheckpoint(feedId: FeedId, subfeedHash: SubfeedHash): Promise<{numVerifiedMessages: MessageCount, lastSignature: Signature} | null> {
+        const f = this.#feeds.get(feedId)
+        if (!f) return null
+        return f.getSubfeedVerificationCheckpoint(subfeedHash)
+    }
+    async setSubfeedVerificationCheckpoint(feedId: FeedId, subfeedHash: SubfeedHash, numVerifiedMessages: MessageCount, lastSignature: Signature): Promise<void> {
+        const f = this.#feeds.get(feedId)
+        if (!f) return
+        f.setSubfeedVerificationCheckpoint(subfeedHash, {numVerifiedMessages, lastSignature})
+    }
     async getSubfeedAccessRules(feedId: FeedId, subfeedHash: SubfeedHash): Promise<SubfeedAccessRules | null> {
         const f = this.#feeds.get(feedId)
         if (!f) return null
         return await f.getSubfeedAccessRules(subfeedHash)
     }
-    async appendSignedMessagesToSubfeed(feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[]) {
+    async appendSignedMessagesToSubfeed(feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[], opts: {verified: boolean} = {verified: false}) {
         let f = this.#feeds.get(feedId)
         if (!f) {
             f = new MockFeed(feedId)
             this.#feeds.set(feedId, f)
         }
         await f.appendSignedMessagesToSubfeed(subfeedHash, messages)
+        if ((opts.verified) && (messages.length > 0)) {
+            const lastMessage = messages[messages.length - 1]
+            f.setSubfeedVerificationCheckpoint(subfeedHash, {numVerifiedMessages: messageCount(lastMessage.body.messageNumber + 1), lastSignature: lastMessage.signature})
+        }
     }
     async setSubfeedAccessRules(feedId: FeedId, subfeedHash: SubfeedHash, accessRules: SubfeedAccessRules): Promise<void> {
         const f = this.#feeds.get(feedId)
@@ -69,6 +91,7 @@ class MockFeed {
     #feedId: FeedId
     #privateKey: PrivateKey | null = null
     #subfeeds = new Map<SubfeedHash, MockSubfeed>()
+    #verificationCheckpoints = new Map<SubfeedHash, {numVerifiedMessages: MessageCount, lastSignature: Signature}>()
     constructor(feedId: FeedId | null) {
         if (feedId !== null) {
             this.#feedId = feedId
@@ -93,6 +116,12 @@ class MockFeed {
         if (!s) return []
         return await s.getSignedSubfeedMessages()
     }
+    getSubfeedVerificationCheckpoint(subfeedHash: SubfeedHash): {numVerifiedMessages: MessageCount, lastSignature: Signature} | null {
+        return this.#verificationCheckpoints.get(subfeedHash) || null
+    }
+    setSubfeedVerificationCheckpoint(subfeedHash: SubfeedHash, checkpoint: {numVerifiedMessages: MessageCount, lastSignature: Signature}) {
+        this.#verificationCheckpoints.set(subfeedHash, checkpoint)
+    }
     async getSubfeedAccessRules(subfeedHash: SubfeedHash): Promise<SubfeedAccessRules | null> {
         const s = this.#subfeeds.get(subfeedHash)
         if (!s) return null
@@ -2,7 +2,7 @@ import fs from 'fs';
 import { createKeyPair, hexToPrivateKey, JSONStringifyDeterministic, privateKeyToHex, publicKeyHexToFeedId, publicKeyToHex } from '../../common/crypto_util';
 import GarbageMap from '../../common/GarbageMap';
 import { isReadableByOthers } from '../../common/util';
-import { FeedId, FeedName, isFeedId, isJSONObject, isPrivateKeyHex, JSONValue, localFilePath, LocalFilePath, PrivateKey, PrivateKeyHex, scaledDurationMsec, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, _validateObject } from '../../interfaces/core';
+import { FeedId, FeedName, isFeedId, isJSONObject, isPrivateKeyHex, JSONValue, localFilePath, LocalFilePath, MessageCount, PrivateKey, PrivateKeyHex, scaledDurationMsec, Signature, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, _validateObject } from '../../interfaces/core';
 import MutableManager from '../../mutables/MutableManager';
 import LocalFeedsDatabase from './LocalFeedsDatabase';
 
@@ -310,11 +310,23 @@ export default class LocalFeedManager {
         // Read the messages file
         return await this.#localFeedsDatabase.getSignedSubfeedMessages(feedId, subfeedHash)
     }
+    async getSignedSubfeedMessagesRange(feedId: FeedId, subfeedHash: SubfeedHash, start: number, end: number | null): Promise<SignedSubfeedMessage[]> {
+        return await this.#localFeedsDatabase.getSignedSubfeedMessagesRange(feedId, subfeedHash, start, end)
+    }
+    async getNumSignedSubfeedMessages(feedId: FeedId, subfeedHash: SubfeedHash): Promise<MessageCount> {
+        return await this.#localFeedsDatabase.getNumSignedSubfeedMessages(feedId, subfeedHash)
+    }
+    async getSubfeedVerificationCheckpoint(feedId: FeedId, subfeedHash: SubfeedHash): Promise<{numVerifiedMessages: MessageCount, lastSignature: Signature} | null> {
+        return await this.#localFeedsDatabase.getSubfeedVerificationCheckpoint(feedId, subfeedHash)
+    }
+    async setSubfeedVerificationCheckpoint(feedId: FeedId, subfeedHash: SubfeedHash, numVerifiedMessages: MessageCount, lastSignature: Signature): Promise<void> {
+        await this.#localFeedsDatabase.setSubfeedVerificationCheckpoint(feedId, subfeedHash, numVerifiedMessages, lastSignature)
+    }
     async getSubfeedAccessRules(feedId: FeedId, subfeedHash: SubfeedHash): Promise<SubfeedAccessRules | null> {
         return await this.#localFeedsDatabase.getSubfeedAccessRules(feedId, subfeedHash)
     }
-    async appendSignedMessagesToSubfeed(feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[]) {
-        await this.#localFeedsDatabase.appendSignedMessagesToSubfeed(feedId, subfeedHash, messages)
+    async appendSignedMessagesToSubfeed(feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[], opts: {verified: boolean} = {verified: false}) {
+        await this.#localFeedsDatabase.appendSignedMessagesToSubfeed(feedId, subfeedHash, messages, opts)
     }
     async setSubfeedAccessRules(feedId: FeedId, subfeedHash: SubfeedHash, accessRules: SubfeedAccessRules): Promise<void> {
         await this.#localFeedsDatabase.setSubfeedAccessRules(feedId, subfeedHash, accessRules)
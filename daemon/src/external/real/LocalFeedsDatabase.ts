@@ -1,139 +1,82 @@
-import { Database, open } from 'sqlite';
-import sqlite3 from 'sqlite3';
 import { JSONStringifyDeterministic } from '../../common/crypto_util';
-import { sleepMsec } from '../../common/util';
-import { FeedId, isJSONObject, isSignedSubfeedMessage, isString, isSubfeedAccessRules, LocalFilePath, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, unscaledDurationMsec } from "../../interfaces/core";
-import fs from 'fs'
+import SqliteConnectionManager, { SqliteTransaction } from '../../common/SqliteConnectionManager';
+import { FeedId, isJSONObject, isSignature, isSignedSubfeedMessage, isString, isSubfeedAccessRules, LocalFilePath, messageCount, MessageCount, messageCountToNumber, Signature, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash } from "../../interfaces/core";
+
+const createTables = async (tx: SqliteTransaction) => {
+    await tx.run(`
+        CREATE TABLE IF NOT EXISTS feeds (
+            feedId TEXT PRIMARY KEY NOT NULL
+        ) WITHOUT ROWID;
+    `)
+    await tx.run(`
+        CREATE TABLE IF NOT EXISTS subfeeds (
+            feedId TEXT NOT NULL,
+            subfeedHash TEXT NOT NULL,
+            accessRules TEXT,
+            PRIMARY KEY(feedId, subfeedHash),
+            FOREIGN KEY (feedId)
+            REFERENCES feeds (feedId) 
+                ON UPDATE CASCADE
+                ON DELETE CASCADE
+        ) WITHOUT ROWID;
+    `)
+    await tx.run(`
+        CREATE TABLE IF NOT EXISTS subfeedMessages (
+            feedId TEXT NOT NULL,
+            subfeedHash TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            message TEXT,
+            PRIMARY KEY(feedId, subfeedHash, position),
+            FOREIGN KEY (feedId, subfeedHash)
+                REFERENCES subfeeds (feedId, subfeedHash) 
+                    ON UPDATE CASCADE
+                    ON DELETE CASCADE
+        ) WITHOUT ROWID;
+    `)
+    await tx.run(`
+        CREATE TABLE IF NOT EXISTS subfeedVerification (
+            feedId TEXT NOT NULL,
+            subfeedHash TEXT NOT NULL,
+            numVerifiedMessages INTEGER NOT NULL,
+            lastSignature TEXT NOT NULL,
+            PRIMARY KEY(feedId, subfeedHash),
+            FOREIGN KEY (feedId, subfeedHash)
+                REFERENCES subfeeds (feedId, subfeedHash) 
+                    ON UPDATE CASCADE
+                    ON DELETE CASCADE
+        ) WITHOUT ROWID;
+    `)
+}
 
 class LocalFeedsDatabase {
-    #db: Database | null = null
-    #initializing = false
-    #initialized = false
-    #databaseLocked = false
-    #onDatabaseLockReleasedCallbacks: (() => void)[] = []
+    #connections: SqliteConnectionManager
     constructor(private databasePath: LocalFilePath) {
+        this.#connections = new SqliteConnectionManager(databasePath, {createTables})
     }
-    async _initialize() {
-        if (this.#initialized) return
-        while (this.#initializing) {
-            await sleepMsec(unscaledDurationMsec(100))
-        }
-        if (this.#initialized) return
-        this.#initializing = true
-        const createTables = async (db: Database) => {
-            await db.run(`
-                CREATE TABLE IF NOT EXISTS feeds (
-                    feedId TEXT PRIMARY KEY NOT NULL
-                ) WITHOUT ROWID;
-            `)
-            await db.run(`
-                CREATE TABLE IF NOT EXISTS subfeeds (
-                    feedId TEXT NOT NULL,
-                    subfeedHash TEXT NOT NULL,
-                    accessRules TEXT,
-                    PRIMARY KEY(feedId, subfeedHash),
-                    FOREIGN KEY (feedId)
-                    REFERENCES feeds (feedId) 
-                        ON UPDATE CASCADE
-                        ON DELETE CASCADE
-                ) WITHOUT ROWID;
-            `)
-            await db.run(`
-                CREATE TABLE IF NOT EXISTS subfeedMessages (
-                    feedId TEXT NOT NULL,
-                    subfeedHash TEXT NOT NULL,
-                    position INTEGER NOT NULL,
-                    message TEXT,
-                    PRIMARY KEY(feedId, subfeedHash, position),
-                    FOREIGN KEY (feedId, subfeedHash)
-                        REFERENCES subfeeds (feedId, subfeedHash) 
-                            ON UPDATE CASCADE
-                            ON DELETE CASCADE
-                ) WITHOUT ROWID;
-            `)
-        }
-        const db = await this._openDatabase()
-        try {
-            await db.run(`PRAGMA foreign_keys = ON`)
-            await createTables(db)
-        }
-        finally {
-            await this._closeDatabase()
-        }
-        fs.chmodSync(this.databasePath.toString(), fs.constants.S_IRUSR | fs.constants.S_IWUSR)
-        this.#initialized = true
-        this.#initializing = false
-    }
-    async _acquireDatabaseLock() {
-        if (!this.#databaseLocked) {
-            this.#databaseLocked = true
-            return
-        }
-        await new Promise<void>((resolve) => {
-            this.#onDatabaseLockReleasedCallbacks.push(() => {
-                this.#databaseLocked = true
-                resolve()
-            })
-        })
-    }
-    _releaseDatabaseLock() {
-        if (!this.#databaseLocked) {
-            throw Error('Unexpected: cannot release database lock when it is not locked')
-        }
-        this.#databaseLocked = false
-        if (this.#onDatabaseLockReleasedCallbacks.length > 0) {
-            const cb = this.#onDatabaseLockReleasedCallbacks[0]
-            this.#onDatabaseLockReleasedCallbacks = this.#onDatabaseLockReleasedCallbacks.slice(1)
-            cb()
-        }
-    }
-    async _openDatabase() {
-        await this._acquireDatabaseLock()
-        this.#db = await open({filename: this.databasePath.toString(), driver: sqlite3.Database})
-        return this.#db
-    }
-    async _closeDatabase() {
-        if (!this.#db) throw Error('Unexpected in closeDatabase: database is null')
-        await this.#db.close()
-        this._releaseDatabaseLock()
+    async close() {
+        await this.#connections.close()
     }
     async addFeed(feedId: FeedId) {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            await db.run('BEGIN TRANSACTION')
-            await db.run(`
+        await this.#connections.write(async (tx) => {
+            await tx.run(`
                 INSERT INTO feeds (feedId) VALUES ($feedId)
             `, {
                 '$feedId': feedId.toString()
             })
-            await db.run('COMMIT')
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
     }
     async deleteFeed(feedId: FeedId) {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            await db.run('BEGIN TRANSACTION')
-            await db.run(`
+        await this.#connections.write(async (tx) => {
+            await tx.run(`
                 DELETE FROM feeds WHERE feedId = $feedId
             `, {
                 '$feedId': feedId.toString()
             })
-            await db.run('COMMIT')
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
     }
     async hasFeed(feedId: FeedId): Promise<boolean> {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            const row = await db.get(`
+        return await this.#connections.read(async (tx) => {
+            const row = await tx.get<{feedId: string}>(`
                 SELECT feedId FROM feeds WHERE feedId = $feedId
             `, {
                 '$feedId': feedId.toString()
@@ -150,20 +93,21 @@ class LocalFeedsDatabase {
             else {
                 return false
             }
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
     }
     async getSignedSubfeedMessages(feedId: FeedId, subfeedHash: SubfeedHash): Promise<SignedSubfeedMessage[]> {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            const rows: {message: string, position: number}[] = await db.all(`
-                SELECT message, position FROM subfeedMessages WHERE feedId = $feedId AND subfeedHash = $subfeedHash ORDER BY position ASC
+        return await this.getSignedSubfeedMessagesRange(feedId, subfeedHash, 0, null)
+    }
+    async getSignedSubfeedMessagesRange(feedId: FeedId, subfeedHash: SubfeedHash, start: number, end: number | null): Promise<SignedSubfeedMessage[]> {
+        // Messages at positions start <= position < end (or all messages from start if end is null)
+        return await this.#connections.read(async (tx) => {
+            const rows = await tx.all<{message: string, position: number}>(`
+                SELECT message, position FROM subfeedMessages WHERE feedId = $feedId AND subfeedHash = $subfeedHash AND position >= $start AND position < $end ORDER BY position ASC
             `, {
                 '$feedId': feedId.toString(),
-                '$subfeedHash': subfeedHash.toString()
+                '$subfeedHash': subfeedHash.toString(),
+                '$start': start,
+                '$end': end !== null ? end : Number.MAX_SAFE_INTEGER
             })
             if (!rows) {
                 throw Error('Unexpected: rows undefined')
@@ -171,10 +115,10 @@ class LocalFeedsDatabase {
             const ret: SignedSubfeedMessage[] = []
             for (let i = 0; i < rows.length; i ++) {
                 const row = rows[i]
-                if (row.position !== i) {
+                if (row.position !== start + i) {
                     // this enforces that feed messages are unreadable if they have gaps,
                     // but the way feed message numbers are assigned in FeedManager should keep that from ever happening.
-                    throw Error(`Unexpected position in signed subfeed message: ${feedId} ${subfeedHash} ${i} <> ${row.position}`)
+                    throw Error(`Unexpected position in signed subfeed message: ${feedId} ${subfeedHash} ${start + i} <> ${row.position}`)
                 }
                 let m
                 try {
@@ -184,24 +128,53 @@ class LocalFeedsDatabase {
                     throw err
                 }
                 if (!isSignedSubfeedMessage(m)) {
-                    throw Error(`Problem in signed subfeed message from database: ${feedId} ${subfeedHash} ${i}`)
+                    throw Error(`Problem in signed subfeed message from database: ${feedId} ${subfeedHash} ${start + i}`)
                 }
-                if (m.body.messageNumber !== i) {
-                    throw Error(`Unexpected message number in signed subfeed message: ${feedId} ${subfeedHash} ${i} <> ${m.body.messageNumber}`)
+                if (m.body.messageNumber !== start + i) {
+                    throw Error(`Unexpected message number in signed subfeed message: ${feedId} ${subfeedHash} ${start + i} <> ${m.body.messageNumber}`)
                 }
                 ret.push(m)
             }
             return ret
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
+    }
+    async getNumSignedSubfeedMessages(feedId: FeedId, subfeedHash: SubfeedHash): Promise<MessageCount> {
+        // positions are contiguous from zero, so this is one more than the max position (a lookup on the primary key)
+        return await this.#connections.read(async (tx) => {
+            const row = await tx.get<{maxPosition: number | null}>(`
+                SELECT MAX(position) AS maxPosition FROM subfeedMessages WHERE feedId = $feedId AND subfeedHash = $subfeedHash
+            `, {
+                '$feedId': feedId.toString(),
+                '$subfeedHash': subfeedHash.toString()
+            })
+            if ((!row) || (row.maxPosition === null)) return messageCount(0)
+            return messageCount(row.maxPosition + 1)
+        })
+    }
+    async getSubfeedVerificationCheckpoint(feedId: FeedId, subfeedHash: SubfeedHash): Promise<{numVerifiedMessages: MessageCount, lastSignature: Signature} | null> {
+        return await this.#connections.read(async (tx) => {
+            const row = await tx.get<{numVerifiedMessages: number, lastSignature: string}>(`
+                SELECT numVerifiedMessages, lastSignature FROM subfeedVerification WHERE feedId = $feedId AND subfeedHash = $subfeedHash
+            `, {
+                '$feedId': feedId.toString(),
+                '$subfeedHash': subfeedHash.toString()
+            })
+            if (!row) return null
+            if (!isSignature(row.lastSignature)) {
+                throw Error(`Problem in verification checkpoint of subfeed: ${feedId} ${subfeedHash}`)
+            }
+            return {numVerifiedMessages: messageCount(row.numVerifiedMessages), lastSignature: row.lastSignature}
+        })
+    }
+    async setSubfeedVerificationCheckpoint(feedId: FeedId, subfeedHash: SubfeedHash, numVerifiedMessages: MessageCount, lastSignature: Signature): Promise<void> {
+        await this.#connections.write(async (tx) => {
+            await this._createSubfeedRowIfNeeded(tx, feedId, subfeedHash)
+            await this._setSubfeedVerificationCheckpoint(tx, feedId, subfeedHash, numVerifiedMessages, lastSignature)
+        })
     }
     async getSubfeedAccessRules(feedId: FeedId, subfeedHash: SubfeedHash): Promise<SubfeedAccessRules | null> {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            const row = await db.get(`
+        return await this.#connections.read(async (tx) => {
+            const row = await tx.get<{accessRules: string | null}>(`
                 SELECT accessRules FROM subfeeds WHERE feedId = $feedId AND subfeedHash = $subfeedHash
             `, {
                 '$feedId': feedId.toString(),
@@ -231,72 +204,66 @@ class LocalFeedsDatabase {
             else {
                 return null
             }
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
     }
     async setSubfeedAccessRules(feedId: FeedId, subfeedHash: SubfeedHash, accessRules: SubfeedAccessRules): Promise<void> {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            await this._createFeedRowIfNeeded(db, feedId)
-            await db.run('BEGIN TRANSACTION')
-            await db.run(`
-                INSERT OR REPLACE INTO subfeeds (feedId, subfeedHash, accessRules) VALUES ($feedId, $subfeedHash, $accessRules)
+        await this.#connections.write(async (tx) => {
+            await this._createFeedRowIfNeeded(tx, feedId)
+            // not INSERT OR REPLACE: with foreign keys on, replacing the row would delete the messages of the subfeed (cascade)
+            await tx.run(`
+                INSERT INTO subfeeds (feedId, subfeedHash, accessRules) VALUES ($feedId, $subfeedHash, $accessRules)
+                    ON CONFLICT(feedId, subfeedHash) DO UPDATE SET accessRules = excluded.accessRules
             `, {
                 '$feedId': feedId.toString(),
                 '$subfeedHash': subfeedHash.toString(),
                 '$accessRules': JSONStringifyDeterministic(accessRules)
             })
-            await db.run('COMMIT')
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
     }
-    async appendSignedMessagesToSubfeed(feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[]) {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            if (messages.length === 0) return
+    async appendSignedMessagesToSubfeed(feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[], opts: {verified: boolean} = {verified: false}) {
+        if (messages.length === 0) return
+        // concurrent appends (e.g., to different subfeeds) are committed together in a single transaction
+        await this.#connections.write(async (tx) => {
             // CHAIN:append_messages:step(7)
-            await this._createSubfeedRowIfNeeded(db, feedId, subfeedHash)
-            const data = messages.map(m => ({
-                feedId,
-                subfeedHash,
-                position: m.body.messageNumber,
-                message: JSONStringifyDeterministic(m)
-            }))
-            await db.run('BEGIN TRANSACTION')
-            for (let d of data) {
-                // await fs.promises.appendFile(this.databasePath + '.debug', JSON.stringify({feedId: d.feedId, subfeedHash: d.subfeedHash, position: d.position, message: d.message}) + '\n')
-                await db.run(`
+            await this._createSubfeedRowIfNeeded(tx, feedId, subfeedHash)
+            for (let m of messages) {
+                await tx.run(`
                     INSERT INTO subfeedMessages (feedId, subfeedHash, position, message) VALUES ($feedId, $subfeedHash, $position, $message)
                 `, {
-                    '$feedId': d.feedId,
-                    '$subfeedHash': d.subfeedHash,
-                    '$position': d.position,
-                    '$message': d.message
+                    '$feedId': feedId.toString(),
+                    '$subfeedHash': subfeedHash.toString(),
+                    '$position': m.body.messageNumber,
+                    '$message': JSONStringifyDeterministic(m)
                 })
             }
-            await db.run('COMMIT')
-        }
-        finally {
-            await this._closeDatabase()
-            // CHAIN:append_messages:step(8)
-        }
+            if (opts.verified) {
+                // the checkpoint is advanced in the same transaction, so it is consistent with the messages
+                const lastMessage = messages[messages.length - 1]
+                await this._setSubfeedVerificationCheckpoint(tx, feedId, subfeedHash, messageCount(lastMessage.body.messageNumber + 1), lastMessage.signature)
+            }
+        })
+        // CHAIN:append_messages:step(8)
+    }
+    async _setSubfeedVerificationCheckpoint(tx: SqliteTransaction, feedId: FeedId, subfeedHash: SubfeedHash, numVerifiedMessages: MessageCount, lastSignature: Signature) {
+        await tx.run(`
+            INSERT OR REPLACE INTO subfeedVerification (feedId, subfeedHash, numVerifiedMessages, lastSignature) VALUES ($feedId, $subfeedHash, $numVerifiedMessages, $lastSignature)
+        `, {
+            '$feedId': feedId.toString(),
+            '$subfeedHash': subfeedHash.toString(),
+            '$numVerifiedMessages': messageCountToNumber(numVerifiedMessages),
+            '$lastSignature': lastSignature.toString()
+        })
     }
-    async _createFeedRowIfNeeded(db: Database, feedId: FeedId) {
-        await db.run(`
+    async _createFeedRowIfNeeded(tx: SqliteTransaction, feedId: FeedId) {
+        await tx.run(`
             INSERT OR IGNORE INTO feeds (feedId) VALUES ($feedId)
         `, {
             '$feedId': feedId.toString()
         })
     }
-    async _createSubfeedRowIfNeeded(db: Database, feedId: FeedId, subfeedHash: SubfeedHash) {
-        await this._createFeedRowIfNeeded(db, feedId)
-        await db.run(`
+    async _createSubfeedRowIfNeeded(tx: SqliteTransaction, feedId: FeedId, subfeedHash: SubfeedHash) {
+        await this._createFeedRowIfNeeded(tx, feedId)
+        await tx.run(`
             INSERT OR IGNORE INTO subfeeds (feedId, subfeedHash) VALUES ($feedId, $subfeedHash)
         `, {
             '$feedId': feedId.toString(),
@@ -53,6 +53,12 @@ export const httpGetDownload = async (address: Address, path: UrlPath, stats: No
         // todo: is this the right way to close it?
         req.abort()
     })
+    ret.producer().onPaused(() => {
+        stream.pause()
+    })
+    ret.producer().onResumed(() => {
+        stream.resume()
+    })
     stream.on('data', (data: Buffer) => {
         if (complete) return
         stats.reportBytesReceived('http', opts.fromNodeId, byteCount(data.length))
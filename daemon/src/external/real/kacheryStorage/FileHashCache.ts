@@ -0,0 +1,120 @@
+import fs from 'fs';
+import SqliteConnectionManager, { SqliteTransaction } from '../../../common/SqliteConnectionManager';
+import { LocalFilePath, Sha1Hash } from '../../../interfaces/core';
+
+// Maps the absolute path of a local file, together with its stat tuple
+// (size, mtime_ns, inode, device), to the sha1 of the file and of its manifest.
+// The database is shared with the python client (see _hash_cache.py),
+// so the stat values are stored as decimal strings.
+// The cache is best-effort: errors result in a cache miss.
+
+// least-recently used entries are evicted beyond this number of entries
+const MAX_NUM_ENTRIES = 200000
+// fraction of inserts that trigger the LRU eviction
+const EVICTION_PROBABILITY = 0.01
+
+const statKey = (stat: fs.BigIntStats) => ({
+    size: stat.size.toString(),
+    mtimeNs: stat.mtimeNs.toString(),
+    ino: stat.ino.toString(),
+    dev: stat.dev.toString()
+})
+
+const statKeysMatch = (a: ReturnType<typeof statKey>, b: ReturnType<typeof statKey>) => (
+    (a.size === b.size) && (a.mtimeNs === b.mtimeNs) && (a.ino === b.ino) && (a.dev === b.dev)
+)
+
+const createTables = async (tx: SqliteTransaction) => {
+    await tx.run(`
+        CREATE TABLE IF NOT EXISTS file_hashes (
+            path TEXT PRIMARY KEY NOT NULL,
+            size TEXT NOT NULL,
+            mtime_ns TEXT NOT NULL,
+            ino TEXT NOT NULL,
+            dev TEXT NOT NULL,
+            sha1 TEXT NOT NULL,
+            manifest_sha1 TEXT,
+            last_access REAL NOT NULL
+        )
+    `)
+    await tx.run(`CREATE INDEX IF NOT EXISTS file_hashes_last_access ON file_hashes (last_access)`)
+}
+
+class FileHashCache {
+    #connections: SqliteConnectionManager
+    constructor(private databasePath: LocalFilePath) {
+        // lookups also update the last access time, so there is no need for read-only connections
+        this.#connections = new SqliteConnectionManager(databasePath, {createTables, numReaders: 0})
+    }
+    async get(path: LocalFilePath, stat: fs.BigIntStats): Promise<{sha1: Sha1Hash, manifestSha1: Sha1Hash | null} | null> {
+        try {
+            return await this.#connections.write(async (tx) => {
+                const row = await tx.get<{size: string, mtime_ns: string, ino: string, dev: string, sha1: string, manifest_sha1: string | null}>(`
+                    SELECT size, mtime_ns, ino, dev, sha1, manifest_sha1 FROM file_hashes WHERE path = $path
+                `, {
+                    '$path': path.toString()
+                })
+                if (!row) return null
+                if (!statKeysMatch({size: row.size, mtimeNs: row.mtime_ns, ino: row.ino, dev: row.dev}, statKey(stat))) {
+                    // the file has changed since it was hashed
+                    await tx.run(`DELETE FROM file_hashes WHERE path = $path`, {'$path': path.toString()})
+                    return null
+                }
+                await tx.run(`UPDATE file_hashes SET last_access = $lastAccess WHERE path = $path`, {
+                    '$lastAccess': Date.now() / 1000,
+                    '$path': path.toString()
+                })
+                return {sha1: row.sha1 as any as Sha1Hash, manifestSha1: row.manifest_sha1 as any as (Sha1Hash | null)}
+            })
+        }
+        catch(err) {
+            /* istanbul ignore next */
+            return null
+        }
+    }
+    async set(path: LocalFilePath, statBeforeHashing: fs.BigIntStats, sha1: Sha1Hash, manifestSha1: Sha1Hash | null) {
+        try {
+            // do not record a hash for a file that changed while it was being hashed
+            const stat = await fs.promises.stat(path.toString(), {bigint: true})
+            if (!statKeysMatch(statKey(stat), statKey(statBeforeHashing))) return
+            const k = statKey(stat)
+            await this.#connections.write(async (tx) => {
+                // a null manifestSha1 keeps the manifest hash already recorded for the same content
+                await tx.run(`
+                    INSERT INTO file_hashes (path, size, mtime_ns, ino, dev, sha1, manifest_sha1, last_access)
+                    VALUES ($path, $size, $mtimeNs, $ino, $dev, $sha1, $manifestSha1, $lastAccess)
+                    ON CONFLICT (path) DO UPDATE SET
+                        size = excluded.size,
+                        mtime_ns = excluded.mtime_ns,
+                        ino = excluded.ino,
+                        dev = excluded.dev,
+                        sha1 = excluded.sha1,
+                        manifest_sha1 = COALESCE(excluded.manifest_sha1, CASE WHEN file_hashes.sha1 = excluded.sha1 THEN file_hashes.manifest_sha1 END),
+                        last_access = excluded.last_access
+                `, {
+                    '$path': path.toString(),
+                    '$size': k.size,
+                    '$mtimeNs': k.mtimeNs,
+                    '$ino': k.ino,
+                    '$dev': k.dev,
+                    '$sha1': sha1.toString(),
+                    '$manifestSha1': manifestSha1 ? manifestSha1.toString() : null,
+                    '$lastAccess': Date.now() / 1000
+                })
+                if (Math.random() < EVICTION_PROBABILITY) {
+                    await tx.run(`
+                        DELETE FROM file_hashes WHERE path IN (SELECT path FROM file_hashes ORDER BY last_access DESC LIMIT -1 OFFSET $maxNumEntries)
+                    `, {
+                        '$maxNumEntries': MAX_NUM_ENTRIES
+                    })
+                }
+            })
+        }
+        catch(err) {
+            /* istanbul ignore next */
+            return
+        }
+    }
+}
+
+export default FileHashCache
@@ -3,16 +3,27 @@ import fs from 'fs';
 import { time } from 'node:console';
 import { JSONStringifyDeterministic } from '../../../common/crypto_util';
 import DataStreamy from '../../../common/DataStreamy';
+import { KacheryStorageFileAssembler, KacheryStorageFileWriter } from '../../ExternalInterface';
 import { randomAlphaString, sleepMsec } from '../../../common/util';
 import { byteCount, ByteCount, byteCountToNumber, elapsedSince, FileKey, FileManifest, FileManifestChunk, isBuffer, localFilePath, LocalFilePath, nowTimestamp, scaledDurationMsec, Sha1Hash } from '../../../interfaces/core';
+import FileHashCache from './FileHashCache';
+
+// size of the chunks listed in file manifests
+const MANIFEST_CHUNK_SIZE = 20 * 1000 * 1000
+// a chunk writer of a file assembler asks for the incoming data to be paused beyond this many bytes waiting to be written
+const MAX_CHUNK_WRITER_BUFFERED_BYTES = 4 * 1000 * 1000
+// the buffer size for copying a chunk from its scratch file into place
+const SCRATCH_COPY_BUFFER_SIZE = 4 * 1000 * 1000
 
 export class KacheryStorageManager {
     #storageDir: LocalFilePath
+    #fileHashCache: FileHashCache
     constructor(storageDir: LocalFilePath) {
         if (!fs.existsSync(storageDir.toString())) {
             throw Error(`Kachery storage directory does not exist: ${storageDir}`)
         }
         this.#storageDir = storageDir
+        this.#fileHashCache = new FileHashCache(localFilePath(storageDir.toString() + '/file-hashes.db'))
     }
     async findFile(fileKey: FileKey): Promise<{ found: boolean, size: ByteCount, localFilePath: LocalFilePath | null }> {
         if (fileKey.sha1) {
@@ -50,6 +61,133 @@ export class KacheryStorageManager {
         }
         await renameAndCheck(destPathTmp, destPath, data.length)
     }
+    createFileWriter(sha1: Sha1Hash): KacheryStorageFileWriter {
+        // The data is written to a temporary file as it arrives, and the sha1 is computed incrementally,
+        // so the content never needs to be held in memory. The file is moved into place only once verified.
+        const s = sha1;
+        const destParentPath = `${this.#storageDir}/sha1/${s[0]}${s[1]}/${s[2]}${s[3]}/${s[4]}${s[5]}`
+        const destPath = `${destParentPath}/${s}`
+        const tmpPath = createTemporaryFilePath({storageDir: this.#storageDir, prefix: 'kachery-p2p-download-'})
+        const writeStream = fs.createWriteStream(tmpPath)
+        const shasum = crypto.createHash('sha1')
+        let numBytesWritten = 0
+        let writeError: Error | null = null
+        let complete = false
+        let closed = false
+        let needDrain = false
+        let drainCallbacks: (() => void)[] = []
+        const _drained = () => {
+            needDrain = false
+            const callbacks = drainCallbacks
+            drainCallbacks = []
+            callbacks.forEach(cb => {cb()})
+        }
+        writeStream.on('error', (err: Error) => {
+            writeError = err
+            _drained()
+        })
+        writeStream.on('drain', () => {
+            _drained()
+        })
+        writeStream.on('close', () => {
+            closed = true
+            _drained()
+        })
+        const _cleanup = () => {
+            try {
+                fs.unlinkSync(tmpPath)
+            }
+            catch(e) {
+            }
+        }
+        const _cleanupWhenClosed = () => {
+            // the stream may still be opening the file, in which case removing it now would leave
+            // the file that is then created behind
+            if (closed) _cleanup()
+            else writeStream.once('close', _cleanup)
+        }
+        return {
+            write: (buf: Buffer) => {
+                if (complete) return true
+                shasum.update(buf)
+                numBytesWritten += buf.length
+                if (!writeStream.write(buf)) {
+                    needDrain = true
+                }
+                return !needDrain
+            },
+            drained: async () => {
+                if ((!needDrain) || (complete) || (writeError) || (closed)) return
+                await new Promise<void>((resolve) => {
+                    drainCallbacks.push(resolve)
+                })
+            },
+            end: async () => {
+                if (complete) throw Error('Unexpected: file writer is already complete')
+                complete = true
+                try {
+                    // the callback of end() is not called on error in older versions of node,
+                    // so we wait for either of the events
+                    await new Promise<void>((resolve, reject) => {
+                        if (writeError) {
+                            reject(writeError)
+                            return
+                        }
+                        writeStream.once('finish', () => {
+                            resolve()
+                        })
+                        writeStream.once('error', (err: Error) => {
+                            reject(err)
+                        })
+                        writeStream.end()
+                    })
+                    const sha1Computed = shasum.digest('hex') as any as Sha1Hash
+                    if (sha1Computed !== sha1) {
+                        throw Error(`Unexpected SHA-1 of downloaded file: ${sha1Computed} <> ${sha1}`)
+                    }
+                    if (fs.existsSync(destPath)) {
+                        // we already have the file
+                        _cleanupWhenClosed()
+                        return
+                    }
+                    fs.mkdirSync(destParentPath, {recursive: true});
+                    await renameAndCheck(tmpPath, destPath, numBytesWritten)
+                }
+                catch(err) {
+                    writeStream.destroy()
+                    _cleanupWhenClosed()
+                    throw err
+                }
+            },
+            cancel: () => {
+                if (complete) return
+                complete = true
+                writeStream.destroy()
+                _cleanupWhenClosed()
+                _drained()
+            }
+        }
+    }
+    async createFileAssembler(manifest: FileManifest): Promise<KacheryStorageFileAssembler> {
+        const s = manifest.sha1;
+        const destParentPath = `${this.#storageDir}/sha1/${s[0]}${s[1]}/${s[2]}${s[3]}/${s[4]}${s[5]}`
+        const destPath = `${destParentPath}/${s}`
+        const tmpPath = createTemporaryFilePath({storageDir: this.#storageDir, prefix: 'kachery-p2p-assemble-'})
+        const fileHandle = await fs.promises.open(tmpPath, 'w')
+        try {
+            // preallocate the file to its final size (node does not expose fallocate, so this is a sparse file on most systems)
+            await fileHandle.truncate(byteCountToNumber(manifest.size))
+        }
+        catch(err) {
+            /* istanbul ignore next */
+            {
+                await fileHandle.close()
+                fs.unlinkSync(tmpPath)
+                throw err
+            }
+        }
+        return new FileAssembler(manifest, fileHandle, tmpPath, destParentPath, destPath)
+    }
     async storeFileFromStream(ds: DataStreamy, fileSize: ByteCount, o: {calculateHashOnly: boolean}): Promise<{sha1: Sha1Hash, manifestSha1: Sha1Hash | null}> {
         const tmpDestPath = !o.calculateHashOnly ? `${this.#storageDir}/store.file.${randomAlphaString(10)}.tmp` : null
         const writeStream = tmpDestPath ? fs.createWriteStream(tmpDestPath) : null
@@ -61,7 +199,7 @@ export class KacheryStorageManager {
             byte2: number
         } = {buffers: [], byte1: 0, byte2: 0}
         let complete = false
-        const chunkSize = 20 * 1000 * 1000
+        const chunkSize = MANIFEST_CHUNK_SIZE
         const _updateManifestChunks = ({final}: {final: boolean}) => {
             if ((manifestData.byte2 - manifestData.byte1 >= chunkSize) || ((final) && (manifestData.byte2 > manifestData.byte1))) {
                 const d = Buffer.concat(manifestData.buffers)
@@ -162,23 +300,22 @@ export class KacheryStorageManager {
         return await this.storeFileFromStream(ds, fileSize, {calculateHashOnly: false})
     }
     async linkLocalFile(localFilePath: LocalFilePath, o: {size: number, mtime: number}): Promise<{sha1: Sha1Hash, manifestSha1: Sha1Hash | null}> {
-        let stat0: fs.Stats
+        let stat0: fs.BigIntStats
         try {
-            stat0 = await fs.promises.stat(localFilePath.toString())
+            stat0 = await fs.promises.stat(localFilePath.toString(), {bigint: true})
         }
         catch (err) {
             throw Error(`Unable to stat file. Perhaps the kachery-p2p daemon does not have permission to read this file: ${localFilePath}`)
         }
-        const fileSize = byteCount(stat0.size)
+        const fileSize = byteCount(Number(stat0.size))
         if (byteCountToNumber(fileSize) !== o.size) {
             throw Error(`Mismatch of file size in linkLocalFile: ${localFilePath} ${fileSize} <> ${o.size}`)
         }
-        const mtime = Number(stat0.mtime) / 1000 // in seconds
+        const mtime = Number(stat0.mtimeMs) / 1000 // in seconds
         if (Math.abs(mtime - o.mtime) > 0.002) { // allow tolerance because python gives mtime with greater precision
             throw Error(`Mismatch of file mtime in linkLocalFile: ${localFilePath} ${mtime} <> ${o.mtime}`)
         }
-        const ds = createDataStreamForFile(localFilePath, byteCount(0), fileSize)
-        const {sha1, manifestSha1} = await this.storeFileFromStream(ds, fileSize, {calculateHashOnly: true})
+        const {sha1, manifestSha1} = await this._computeLocalFileHashes(localFilePath, stat0)
         const s = sha1
         const destParentPath = `${this.#storageDir}/sha1/${s[0]}${s[1]}/${s[2]}${s[3]}/${s[4]}${s[5]}`
         if (!fs.existsSync(destParentPath)) {
@@ -201,6 +338,20 @@ export class KacheryStorageManager {
         }
         return {sha1, manifestSha1}
     }
+    async _computeLocalFileHashes(localFilePath: LocalFilePath, stat0: fs.BigIntStats): Promise<{sha1: Sha1Hash, manifestSha1: Sha1Hash | null}> {
+        const fileSize = byteCount(Number(stat0.size))
+        const cached = await this.#fileHashCache.get(localFilePath, stat0)
+        if (cached) {
+            // files larger than one manifest chunk need their manifest to still be in the storage
+            const needsManifest = byteCountToNumber(fileSize) > MANIFEST_CHUNK_SIZE
+            if (!needsManifest) return cached
+            if ((cached.manifestSha1) && ((await this._getLocalFileInfo(cached.manifestSha1)).path)) return cached
+        }
+        const ds = createDataStreamForFile(localFilePath, byteCount(0), fileSize)
+        const {sha1, manifestSha1} = await this.storeFileFromStream(ds, fileSize, {calculateHashOnly: true})
+        await this.#fileHashCache.set(localFilePath, stat0, sha1, manifestSha1)
+        return {sha1, manifestSha1}
+    }
     async concatenateChunksAndStoreResult(sha1: Sha1Hash, chunkSha1s: Sha1Hash[]): Promise<void> {
         const s = sha1
         const destParentPath = `${this.#storageDir}/sha1/${s[0]}${s[1]}/${s[2]}${s[3]}/${s[4]}${s[5]}`
@@ -322,6 +473,269 @@ export class KacheryStorageManager {
     }
 }
 
+interface ChunkOwner {
+    superseded: boolean // another writer completed the chunk, so the remaining writes of the owner are dropped
+}
+
+class FileAssembler {
+    #fileHandle: fs.promises.FileHandle | null
+    #completeChunks = new Set<number>()
+    #chunkOwners = new Map<number, ChunkOwner>() // the writer of each chunk that writes directly into the file
+    #chunkWrites = new Map<number, Promise<void>>() // the last write into the region of each chunk (they are made in order)
+    #pendingWrites = new Set<Promise<void>>()
+    #complete = false
+    constructor(private manifest: FileManifest, fileHandle: fs.promises.FileHandle, private tmpPath: string, private destParentPath: string, private destPath: string) {
+        this.#fileHandle = fileHandle
+    }
+    createChunkWriter(chunkIndex: number): KacheryStorageFileWriter {
+        // Only one writer of a chunk (the owner) writes directly into the file. Another writer of the
+        // same chunk (e.g., a re-issued download) writes to a scratch file, which is copied into place
+        // if it completes the chunk first. So the data in the region of a chunk is always that of a
+        // verified writer, or else of the current owner (verified when it ends).
+        const chunk = this.manifest.chunks[chunkIndex]
+        if (!chunk) throw Error(`Invalid chunk index: ${chunkIndex}`)
+        const chunkStart = byteCountToNumber(chunk.start)
+        const chunkEnd = byteCountToNumber(chunk.end)
+        const shasum = crypto.createHash('sha1')
+        let position = chunkStart
+        const owner: ChunkOwner | null = ((!this.#chunkOwners.has(chunkIndex)) && (!this.#completeChunks.has(chunkIndex))) ? {superseded: false} : null
+        if (owner) this.#chunkOwners.set(chunkIndex, owner)
+        const scratchPath = owner ? null : `${this.tmpPath}.chunk${chunkIndex}.${randomAlphaString(6)}`
+        let scratchHandle: fs.promises.FileHandle | null = null
+        let scratchCleanup: Promise<void> | null = null
+        // writes are issued in order, one at a time, each at its own offset
+        let pendingWrites: Promise<void> = Promise.resolve()
+        let numBufferedBytes = 0
+        let drainCallbacks: (() => void)[] = []
+        let writeError: Error | null = null
+        let complete = false
+        let cancelled = false
+        const _drained = () => {
+            const callbacks = drainCallbacks
+            drainCallbacks = []
+            callbacks.forEach(cb => {cb()})
+        }
+        const _releaseOwnership = () => {
+            if ((owner) && (this.#chunkOwners.get(chunkIndex) === owner)) this.#chunkOwners.delete(chunkIndex)
+        }
+        const _cleanupScratch = () => {
+            if (!scratchCleanup) {
+                scratchCleanup = (async () => {
+                    await pendingWrites
+                    const fh = scratchHandle
+                    scratchHandle = null
+                    if (fh) {
+                        try {
+                            await fh.close()
+                            fs.unlinkSync(scratchPath as string)
+                        }
+                        catch(err) {
+                        }
+                    }
+                })()
+            }
+            return scratchCleanup
+        }
+        const _writeScratch = async (buf: Buffer, p: number) => {
+            if (!scratchHandle) scratchHandle = await fs.promises.open(scratchPath as string, 'w')
+            await writeAllAt(scratchHandle, buf, p - chunkStart)
+        }
+        return {
+            write: (buf: Buffer) => {
+                if (complete) return true
+                if (position + buf.length > chunkEnd) {
+                    writeError = Error(`Too much data for chunk ${chunkIndex}: ${position + buf.length} > ${chunkEnd}`)
+                    return true
+                }
+                shasum.update(buf)
+                const p = position
+                position += buf.length
+                numBufferedBytes += buf.length
+                // the writes of the owner are ordered with any other writes into the region of the chunk
+                const previous = owner ? (this.#chunkWrites.get(chunkIndex) || Promise.resolve()) : pendingWrites
+                pendingWrites = previous.then(async () => {
+                    // a cancelled writer (e.g., a failed download attempt) does not write any further data
+                    if (cancelled) return
+                    if (owner) {
+                        if (!owner.superseded) await this._writeAt(buf, p)
+                    }
+                    else {
+                        await _writeScratch(buf, p)
+                    }
+                }).catch((err: Error) => {
+                    writeError = err
+                }).then(() => {
+                    numBufferedBytes -= buf.length
+                    if (numBufferedBytes < MAX_CHUNK_WRITER_BUFFERED_BYTES) _drained()
+                })
+                if (owner) this.#chunkWrites.set(chunkIndex, pendingWrites)
+                return numBufferedBytes < MAX_CHUNK_WRITER_BUFFERED_BYTES
+            },
+            drained: async () => {
+                if ((numBufferedBytes < MAX_CHUNK_WRITER_BUFFERED_BYTES) || (cancelled)) return
+                await new Promise<void>((resolve) => {
+                    drainCallbacks.push(resolve)
+                })
+            },
+            end: async () => {
+                if (complete) throw Error('Unexpected: chunk writer is already complete')
+                complete = true
+                try {
+                    await pendingWrites
+                    // the chunk was completed by another writer (the data of this one was not needed)
+                    if ((owner) && (owner.superseded)) return
+                    if (writeError) throw writeError
+                    if (position !== chunkEnd) {
+                        throw Error(`Unexpected amount of data for chunk ${chunkIndex}: ${position} <> ${chunkEnd}`)
+                    }
+                    const sha1Computed = shasum.digest('hex') as any as Sha1Hash
+                    if (sha1Computed !== chunk.sha1) {
+                        throw Error(`Unexpected SHA-1 of chunk ${chunkIndex}: ${sha1Computed} <> ${chunk.sha1}`)
+                    }
+                    if (!owner) {
+                        // take over the region of the chunk from its owner (if any), after its writes in progress
+                        const currentOwner = this.#chunkOwners.get(chunkIndex)
+                        if (currentOwner) {
+                            currentOwner.superseded = true
+                            this.#chunkOwners.delete(chunkIndex)
+                        }
+                        const copy = (this.#chunkWrites.get(chunkIndex) || Promise.resolve()).then(async () => {
+                            if (this.#completeChunks.has(chunkIndex)) return
+                            await this._copyIntoPlace(scratchHandle, chunkStart, chunkEnd - chunkStart)
+                        })
+                        this.#chunkWrites.set(chunkIndex, copy.catch(() => {}))
+                        await copy
+                    }
+                    this.#completeChunks.add(chunkIndex)
+                }
+                finally {
+                    _releaseOwnership()
+                    if (scratchPath) await _cleanupScratch()
+                }
+            },
+            cancel: () => {
+                const ending = complete
+                complete = true
+                cancelled = true
+                _drained()
+                _releaseOwnership()
+                // (if end() was called, it cleans up the scratch file)
+                if ((scratchPath) && (!ending)) _cleanupScratch()
+            }
+        }
+    }
+    isChunkComplete(chunkIndex: number) {
+        return this.#completeChunks.has(chunkIndex)
+    }
+    async _writeAt(buf: Buffer, position: number) {
+        const p = this._writeAt2(buf, position)
+        this.#pendingWrites.add(p)
+        try {
+            await p
+        }
+        finally {
+            this.#pendingWrites.delete(p)
+        }
+    }
+    async _writeAt2(buf: Buffer, position: number) {
+        if (!this.#fileHandle) throw Error('File assembler is closed')
+        await writeAllAt(this.#fileHandle, buf, position)
+    }
+    async _copyIntoPlace(scratchHandle: fs.promises.FileHandle | null, position: number, size: number) {
+        // copy the data of a chunk from its scratch file into the region of the chunk
+        for (let offset = 0; offset < size; offset += SCRATCH_COPY_BUFFER_SIZE) {
+            if (!scratchHandle) throw Error('Unexpected: no scratch file')
+            const buf = Buffer.alloc(Math.min(SCRATCH_COPY_BUFFER_SIZE, size - offset))
+            const {bytesRead} = await scratchHandle.read(buf, 0, buf.length, offset)
+            if (bytesRead !== buf.length) throw Error(`Unexpected number of bytes read from scratch file: ${bytesRead} <> ${buf.length}`)
+            await this._writeAt(buf, position + offset)
+        }
+    }
+    async finalize() {
+        if (this.#complete) throw Error('Unexpected: file assembler is already complete')
+        this.#complete = true
+        try {
+            for (let i = 0; i < this.manifest.chunks.length; i++) {
+                if (!this.#completeChunks.has(i)) {
+                    throw Error(`Cannot finalize assembled file. Missing chunk: ${i}`)
+                }
+            }
+            // wait for any writes still in progress (from cancelled chunk writers)
+            await Promise.all(Array.from(this.#pendingWrites).map(p => p.catch(() => {})))
+            await this._closeFile()
+            // the chunks were verified individually, but we also verify the entire file in a single streaming pass
+            const sha1Computed = await computeSha1OfFile(this.tmpPath)
+            if (sha1Computed !== this.manifest.sha1) {
+                throw Error(`Unexpected SHA-1 of assembled file: ${sha1Computed} <> ${this.manifest.sha1}`)
+            }
+            if (fs.existsSync(this.destPath)) {
+                // already exists
+                /* istanbul ignore next */
+                {
+                    this._cleanup()
+                    return
+                }
+            }
+            fs.mkdirSync(this.destParentPath, {recursive: true});
+            await renameAndCheck(this.tmpPath, this.destPath, byteCountToNumber(this.manifest.size))
+        }
+        catch(err) {
+            await this._closeFile()
+            this._cleanup()
+            throw err
+        }
+    }
+    cancel() {
+        if (this.#complete) return
+        this.#complete = true
+        this._closeFile().then(() => {
+            this._cleanup()
+        })
+    }
+    async _closeFile() {
+        const fh = this.#fileHandle
+        this.#fileHandle = null
+        if (fh) {
+            try {
+                await fh.close()
+            }
+            catch(err) {
+            }
+        }
+    }
+    _cleanup() {
+        try {
+            fs.unlinkSync(this.tmpPath)
+        }
+        catch(e) {
+        }
+    }
+}
+
+const writeAllAt = async (fh: fs.promises.FileHandle, buf: Buffer, position: number) => {
+    let offset = 0
+    while (offset < buf.length) {
+        const {bytesWritten} = await fh.write(buf, offset, buf.length - offset, position + offset)
+        offset += bytesWritten
+    }
+}
+
+const computeSha1OfFile = async (path: string): Promise<Sha1Hash> => {
+    const shasum = crypto.createHash('sha1')
+    return new Promise<Sha1Hash>((resolve, reject) => {
+        const readStream = fs.createReadStream(path)
+        readStream.on('data', (chunk: any) => {
+            shasum.update(chunk)
+        })
+        readStream.on('end', () => {
+            resolve(shasum.digest('hex') as any as Sha1Hash)
+        })
+        readStream.on('error', (err: Error) => {
+            reject(err)
+        })
+    })
+}
+
 const computeSha1OfBufferSync = (buf: Buffer) => {
     const shasum = crypto.createHash('sha1')
     shasum.update(buf)
@@ -348,6 +762,12 @@ const createDataStreamForFile = (path: LocalFilePath, offset: ByteCount, size: B
     ret.producer().onCancelled(() => {
         readStream.close()
     })
+    ret.producer().onPaused(() => {
+        readStream.pause()
+    })
+    ret.producer().onResumed(() => {
+        readStream.resume()
+    })
     return ret
 }
 
@@ -16,6 +16,8 @@ class FeedManager {
     #remoteFeedManager: RemoteFeedManager // Manages the interaction with feeds on remote nodes
     #incomingSubfeedSubscriptionManager: NewIncomingSubfeedSubscriptionManager
     #outgoingSubfeedSubscriptionManager: NewOutgoingSubfeedSubscriptionManager
+    #pendingAppends = new Map<FeedSubfeedId, {messages: SubfeedMessage[], resolve: () => void, reject: (err: Error) => void}[]>() // appendMessages requests waiting for the subfeed
+    #appendingSubfeeds = new Set<FeedSubfeedId>()
     constructor(node: KacheryP2PNode, localFeedManager: LocalFeedManagerInterface) {
         this.#node = node
         this.#localFeedManager = localFeedManager
@@ -49,32 +51,81 @@ class FeedManager {
             throw Error(`Subfeed is not writeable: ${args.feedId} ${args.subfeedHash}`);
         }
 
+        // Concurrent requests for the same subfeed are combined, so that their messages
+        // are signed and stored together (a single database transaction)
+        const k = feedSubfeedId(args.feedId, args.subfeedHash)
+        return new Promise<void>((resolve, reject) => {
+            let pending = this.#pendingAppends.get(k)
+            if (!pending) {
+                pending = []
+                this.#pendingAppends.set(k, pending)
+            }
+            pending.push({messages: args.messages, resolve, reject})
+            this._processPendingAppends(k, subfeed)
+        })
+    }
+    async _processPendingAppends(k: FeedSubfeedId, subfeed: Subfeed) {
+        if (this.#appendingSubfeeds.has(k)) return // picked up when the current batch completes
+        this.#appendingSubfeeds.add(k)
         const release = await subfeed.acquireLock()
         try {
-            // Append the messages
-            // CHAIN:append_messages:step(3)
-            await subfeed.appendMessages(args.messages, {metaData: undefined});
+            while (true) {
+                const batch = this.#pendingAppends.get(k) || []
+                this.#pendingAppends.delete(k)
+                if (batch.length === 0) break
+                const messages: SubfeedMessage[] = []
+                batch.forEach(a => {
+                    for (let m of a.messages) messages.push(m)
+                })
+                try {
+                    // Append the messages
+                    // CHAIN:append_messages:step(3)
+                    await subfeed.appendMessages(messages, {metaData: undefined});
+                }
+                catch(err) {
+                    if (batch.length === 1) {
+                        batch[0].reject(err)
+                        continue
+                    }
+                    // nothing was appended, so we retry each request separately
+                    // (one invalid request should not fail the others)
+                    for (let a of batch) {
+                        try {
+                            await subfeed.appendMessages(a.messages, {metaData: undefined})
+                        }
+                        catch(err2) {
+                            a.reject(err2)
+                            continue
+                        }
+                        a.resolve()
+                    }
+                    continue
+                }
+                batch.forEach(a => {a.resolve()})
+            }
         }
         finally {
             release()
+            this.#appendingSubfeeds.delete(k)
         }
     }
-    async submitMessage({ feedId, subfeedHash, message, timeoutMsec }: { feedId: FeedId, subfeedHash: SubfeedHash, message: SubmittedSubfeedMessage, timeoutMsec: DurationMsec}) {
+    async submitMessages({ feedId, subfeedHash, messages, timeoutMsec }: { feedId: FeedId, subfeedHash: SubfeedHash, messages: SubmittedSubfeedMessage[], timeoutMsec: DurationMsec}) {
         // Same as appendMessages, except if we don't have a writeable feed, we submit it to the p2p network
         // and then, on success, it will append the messages on the node where the feed is writeable
+        if (messages.length === 0) return
         const subfeed = await this._loadSubfeed(feedId, subfeedHash);
         if (!subfeed) {
             /* istanbul ignore next */
             throw Error(`Unable to load subfeed: ${feedId} ${subfeedHash}`);
         }
         if (subfeed.isWriteable()) {
-            // If writeable, let's just append the messages
-            await this.appendMessages({feedId, subfeedHash, messages: [submittedSubfeedMessageToSubfeedMessage(message)]})
+            // If writeable, let's just append the messages (in a single batch)
+            await this.appendMessages({feedId, subfeedHash, messages: messages.map(m => (submittedSubfeedMessageToSubfeedMessage(m)))})
             return
             // throw Error(`Cannot submit messages. Subfeed is writeable: ${feedId} ${subfeedHash}`);
         }
         // Submit the messages to the p2p network
-        await this.#remoteFeedManager.submitMessage({feedId, subfeedHash, message, timeoutMsec});
+        await this.#remoteFeedManager.submitMessages({feedId, subfeedHash, messages, timeoutMsec});
     }
     async getNumLocalMessages({ feedId, subfeedHash }: {feedId: FeedId, subfeedHash: SubfeedHash}): Promise<MessageCount> {
         // Get the total number of messages in the local feed only
@@ -95,7 +146,7 @@ class FeedManager {
         // important to do it this way so we can load new messages into memory (if available)
         const numMessages = Number(subfeed.getNumLocalMessages())
         const position = subfeedPosition(Math.max(0, numMessages - 1))
-        const messages = subfeed.getLocalSignedMessages({position, numMessages: messageCount(1)})
+        const messages = await subfeed.getLocalSignedMessages({position, numMessages: messageCount(1)})
 
         if (messages.length > 0) {
             return messages[messages.length - 1].body.message
@@ -192,7 +243,7 @@ class FeedManager {
                 if (messageCountToNumber(maxNumMessages) > 0) {
                     numMessages = Math.min(messageCountToNumber(maxNumMessages), numMessages)
                 }
-                let messages0 = subfeed.getLocalSignedMessages({position: w.position, numMessages: messageCount(numMessages) })
+                let messages0 = await subfeed.getLocalSignedMessages({position: w.position, numMessages: messageCount(numMessages) })
                 if (signed) {
                     messages.set(watchName, messages0)
                 }
@@ -253,6 +304,84 @@ class FeedManager {
             }, durationMsecToNumber(waitMsec));
         });
     }
+    subscribeToMessages({
+        subfeedWatches,
+        signed,
+        onMessages
+    }: {
+        subfeedWatches: SubfeedWatchesRAM,
+        signed: boolean,
+        onMessages: (watchName: SubfeedWatchName, messages: SubfeedMessage[] | SignedSubfeedMessage[]) => void
+    }): () => void {
+        // Push messages to onMessages as soon as they are appended to the watched subfeeds,
+        // starting with any messages already available beyond the watch positions.
+        // Returns a function that cancels the subscription.
+        let cancelled = false
+        const renewers: (() => Promise<void>)[] = []
+        const removers: (() => void)[] = []
+        subfeedWatches.forEach((w: SubfeedWatch, watchName: SubfeedWatchName) => {
+            let position = subfeedPositionToNumber(w.position)
+            let subfeed: Subfeed | null = null
+            let removeListener: (() => void) | null = null
+            let sending: Promise<void> = Promise.resolve()
+            const doSendNewMessages = async () => {
+                if ((cancelled) || (!subfeed)) return
+                const numLocalMessages = messageCountToNumber(subfeed.getNumLocalMessages())
+                if (numLocalMessages <= position) return
+                const messages0 = await subfeed.getLocalSignedMessages({position: subfeedPosition(position), numMessages: messageCount(numLocalMessages - position)})
+                if (cancelled) return
+                position = numLocalMessages
+                if (signed) {
+                    onMessages(watchName, messages0)
+                }
+                else {
+                    onMessages(watchName, messages0.map(m => m.body.message))
+                }
+            }
+            const sendNewMessages = () => {
+                // the messages are loaded asynchronously, so we send them one batch at a time to preserve the order
+                sending = sending.then(doSendNewMessages).catch((err: Error) => {
+                    /* istanbul ignore next */
+                    console.warn(`Problem sending subfeed messages: ${err.message}`)
+                })
+            }
+            const renew = async () => {
+                const s = await this._loadSubfeed(w.feedId, w.subfeedHash)
+                if (cancelled) return
+                if (s !== subfeed) {
+                    // the in-memory subfeed instance is replaced after it is garbage collected
+                    if (removeListener) removeListener()
+                    subfeed = s
+                    removeListener = s.addNewMessageListener(sendNewMessages)
+                }
+                sendNewMessages()
+                if (!s.isWriteable()) {
+                    // keep receiving the messages of a remote subfeed
+                    await this.#remoteFeedManager.subscribeToRemoteSubfeed(w.feedId, w.subfeedHash)
+                }
+            }
+            renewers.push(renew)
+            removers.push(() => {
+                if (removeListener) removeListener()
+            })
+        })
+        const renewAll = () => {
+            renewers.forEach(renew => {
+                renew().catch((err: Error) => {
+                    /* istanbul ignore next */
+                    console.warn(`Problem renewing subfeed subscription: ${err.message}`)
+                })
+            })
+        }
+        renewAll()
+        // the outgoing subscriptions to remote subfeeds last for one minute
+        const renewTimer = setInterval(renewAll, durationMsecToNumber(scaledDurationMsec(30 * 1000)))
+        return () => {
+            cancelled = true
+            clearInterval(renewTimer)
+            removers.forEach(remove => remove())
+        }
+    }
     async renewIncomingSubfeedSubscription(fromNodeId: NodeId, feedId: FeedId, subfeedHash: SubfeedHash): Promise<MessageCount> {
         const subfeed = await this._loadSubfeed(feedId, subfeedHash)
         if (!subfeed.isWriteable()) {
@@ -1,84 +1,176 @@
 import { verifySignatureJson } from '../common/crypto_util';
 import { LocalFeedManagerInterface } from '../external/ExternalInterface';
-import { FeedId, JSONObject, messageCount, PublicKey, Signature, SignedSubfeedMessage, SubfeedHash } from '../interfaces/core';
+import { FeedId, JSONObject, messageCount, messageCountToNumber, PublicKey, Signature, SignedSubfeedMessage, SubfeedHash } from '../interfaces/core';
+
+// Messages are loaded from the local database in pages of this many messages (keyed by position)
+const PAGE_SIZE = 1000
+// Least-recently used pages are dropped from memory beyond this number of pages
+const MAX_NUM_CACHED_PAGES = 20
 
 class LocalSubfeedSignedMessagesManager {
-    #signedMessages: SignedSubfeedMessage[] | null = null // in-memory cache
+    // Only the number of messages and the signature of the final message are kept in memory,
+    // together with a bounded cache of pages of messages
+    #numMessages: number | null = null
+    #lastSignature: Signature | null = null
+    #pages = new Map<number, SignedSubfeedMessage[]>() // by page index, in order of last use
     #appending = false
     constructor(private localFeedManager: LocalFeedManagerInterface, private feedId: FeedId, private subfeedHash: SubfeedHash, private publicKey: PublicKey) {
 
     }
     async initializeFromLocal() {
-        const messages = await this.localFeedManager.getSignedSubfeedMessages(this.feedId, this.subfeedHash)
+        const numMessages = messageCountToNumber(await this.localFeedManager.getNumSignedSubfeedMessages(this.feedId, this.subfeedHash))
 
         // Verify the integrity of the messages
-        // The first message has a previousSignature of null
-        let previousSignature: Signature | null = null
-        let previousMessageNumber: number = -1
-        for (let msg of messages) {
-            if (!verifySignatureJson(msg.body as any as JSONObject, msg.signature, this.publicKey)) {
-                /* istanbul ignore next */
-                throw Error(`Unable to verify signature of message in feed: ${msg.signature}`)
+        // The messages up to the verification checkpoint were verified when the subfeed was previously opened or appended to,
+        // so we only need to verify the messages after that (continuing the signature chain from the checkpoint)
+        let numVerifiedMessages = 0
+        let previousSignature: Signature | null = null // The first message has a previousSignature of null
+        const checkpoint = await this.localFeedManager.getSubfeedVerificationCheckpoint(this.feedId, this.subfeedHash)
+        if ((checkpoint) && (messageCountToNumber(checkpoint.numVerifiedMessages) > 0) && (messageCountToNumber(checkpoint.numVerifiedMessages) <= numMessages)) {
+            const n = messageCountToNumber(checkpoint.numVerifiedMessages)
+            const lastVerifiedMessages = await this.localFeedManager.getSignedSubfeedMessagesRange(this.feedId, this.subfeedHash, n - 1, n)
+            // if the checkpoint does not match the stored messages, we verify everything
+            if ((lastVerifiedMessages.length === 1) && (lastVerifiedMessages[0].signature === checkpoint.lastSignature)) {
+                numVerifiedMessages = n
+                previousSignature = checkpoint.lastSignature
             }
-            if (previousSignature !== (msg.body.previousSignature || null)) {
+        }
+        for (let start = numVerifiedMessages; start < numMessages; start += PAGE_SIZE) {
+            const end = Math.min(start + PAGE_SIZE, numMessages)
+            const messages = await this.localFeedManager.getSignedSubfeedMessagesRange(this.feedId, this.subfeedHash, start, end)
+            if (messages.length !== end - start) {
                 /* istanbul ignore next */
-                throw Error(`Inconsistent previousSignature of message in feed when reading messages from file: ${previousSignature} ${msg.body.previousSignature}`)
+                throw Error(`Unexpected number of messages in feed when reading messages from database: ${messages.length} <> ${end - start}`)
             }
-            if (previousMessageNumber + 1 !== msg.body.messageNumber) {
-                /* istanbul ignore next */
-                throw Error(`Incorrect message number for message in feed when reading messages from file: ${previousMessageNumber + 1} ${msg.body.messageNumber}`)
+            let previousMessageNumber = start - 1
+            for (let msg of messages) {
+                if (!verifySignatureJson(msg.body as any as JSONObject, msg.signature, this.publicKey)) {
+                    /* istanbul ignore next */
+                    throw Error(`Unable to verify signature of message in feed: ${msg.signature}`)
+                }
+                if (previousSignature !== (msg.body.previousSignature || null)) {
+                    /* istanbul ignore next */
+                    throw Error(`Inconsistent previousSignature of message in feed when reading messages from file: ${previousSignature} ${msg.body.previousSignature}`)
+                }
+                if (previousMessageNumber + 1 !== msg.body.messageNumber) {
+                    /* istanbul ignore next */
+                    throw Error(`Incorrect message number for message in feed when reading messages from file: ${previousMessageNumber + 1} ${msg.body.messageNumber}`)
+                }
+                previousSignature = msg.signature
+                previousMessageNumber = msg.body.messageNumber
             }
-            previousSignature = msg.signature
-            previousMessageNumber = msg.body.messageNumber
+        }
+        if ((previousSignature !== null) && (numVerifiedMessages < numMessages)) {
+            await this.localFeedManager.setSubfeedVerificationCheckpoint(this.feedId, this.subfeedHash, messageCount(numMessages), previousSignature)
         }
 
-        // store in memory
-        this.#signedMessages = messages
+        this.#pages.clear()
+        this.#numMessages = numMessages
+        this.#lastSignature = previousSignature
     }
     initializeEmptyMessageList() {
-        this.#signedMessages = []
+        this.#pages.clear()
+        this.#numMessages = 0
+        this.#lastSignature = null
     }
     isInitialized = () => {
-        return this.#signedMessages !== null
+        return this.#numMessages !== null
     }
     getNumMessages() {
-        if (this.#signedMessages === null) {
+        if (this.#numMessages === null) {
             /* istanbul ignore next */
-            throw Error('#signedMessages is null. Perhaps getNumMessages was called before subfeed was initialized.');
+            throw Error('#numMessages is null. Perhaps getNumMessages was called before subfeed was initialized.');
         }
-        return messageCount(this.#signedMessages.length)
+        return messageCount(this.#numMessages)
     }
-    getSignedMessage(i: number) {
-        if (this.#signedMessages === null) {
+    getLastSignature(): Signature | null {
+        // The signature of the final message (or null if there are no messages)
+        if (this.#numMessages === null) {
+            /* istanbul ignore next */
+            throw Error('#numMessages is null. Perhaps getLastSignature was called before subfeed was initialized.');
+        }
+        return this.#lastSignature
+    }
+    async getSignedMessages(start: number, end: number): Promise<SignedSubfeedMessage[]> {
+        // Messages at positions start <= position < end, loaded page by page
+        if (this.#numMessages === null) {
+            /* istanbul ignore next */
+            throw Error('#numMessages is null. Perhaps getSignedMessages was called before subfeed was initialized.');
+        }
+        if ((start < 0) || (end > this.#numMessages) || (start > end)) {
+            /* istanbul ignore next */
+            throw Error(`Invalid range in getSignedMessages: ${start} ${end} (${this.#numMessages})`)
+        }
+        const ret: SignedSubfeedMessage[] = []
+        for (let pageIndex = Math.floor(start / PAGE_SIZE); pageIndex * PAGE_SIZE < end; pageIndex++) {
+            const page = await this._getPage(pageIndex)
+            const pageStart = pageIndex * PAGE_SIZE
+            for (let i = Math.max(start, pageStart); i < Math.min(end, pageStart + page.length); i++) {
+                ret.push(page[i - pageStart])
+            }
+        }
+        if (ret.length !== end - start) {
             /* istanbul ignore next */
-            throw Error('#signedMessages is null. Perhaps getSignedMessage was called before subfeed was initialized.');
+            throw Error(`Unexpected number of messages in getSignedMessages: ${ret.length} <> ${end - start}`)
         }
-        return this.#signedMessages[i]
+        return ret
+    }
+    async _getPage(pageIndex: number): Promise<SignedSubfeedMessage[]> {
+        const numMessages = this.getNumMessages()
+        const pageStart = pageIndex * PAGE_SIZE
+        const pageEnd = Math.min(pageStart + PAGE_SIZE, messageCountToNumber(numMessages))
+        let page = this.#pages.get(pageIndex)
+        if ((page) && (page.length >= pageEnd - pageStart)) {
+            // mark as most recently used
+            this.#pages.delete(pageIndex)
+            this.#pages.set(pageIndex, page)
+            return page
+        }
+        page = await this.localFeedManager.getSignedSubfeedMessagesRange(this.feedId, this.subfeedHash, pageStart, pageStart + PAGE_SIZE)
+        // a concurrent load or append may have already cached a page with at least as many messages
+        const existing = this.#pages.get(pageIndex)
+        if ((existing) && (existing.length >= page.length)) {
+            page = existing
+        }
+        this.#pages.delete(pageIndex)
+        this.#pages.set(pageIndex, page)
+        while (this.#pages.size > MAX_NUM_CACHED_PAGES) {
+            const oldest = this.#pages.keys().next().value
+            this.#pages.delete(oldest)
+        }
+        return page
     }
     async appendSignedMessages(signedMessagesToAppend: SignedSubfeedMessage[]) {
-        if (this.#signedMessages === null) {
+        if (this.#numMessages === null) {
             /* istanbul ignore next */
-            throw Error('#signedMessages is null. Perhaps appendSignedMessages was called before subfeed was initialized.');
+            throw Error('#numMessages is null. Perhaps appendSignedMessages was called before subfeed was initialized.');
         }
         const firstAppendMessageNumber = signedMessagesToAppend.length === 0 ? null : signedMessagesToAppend[0].body.messageNumber
-        const lastExistingMessageNumber = this.#signedMessages.length === 0 ? null : this.#signedMessages[this.#signedMessages.length - 1].body.messageNumber
         if (firstAppendMessageNumber !== null) {
-            if (lastExistingMessageNumber === null) {       
-                if (firstAppendMessageNumber !== 0) throw Error('Unexpected in appendSignedMessages: first message number to append does not equal zero')
-            }
-            else {
-                if (firstAppendMessageNumber !== lastExistingMessageNumber + 1) throw Error(`Unexpected in appendSignedMessages: unexpcted first message number for appending ${firstAppendMessageNumber} <> ${lastExistingMessageNumber + 1}`)
-            }
+            if (firstAppendMessageNumber !== this.#numMessages) throw Error(`Unexpected in appendSignedMessages: unexpcted first message number for appending ${firstAppendMessageNumber} <> ${this.#numMessages}`)
         }
+        if (signedMessagesToAppend.length === 0) return
         if (this.#appending) throw Error('Cannot append messages while messages are being appended.')
         this.#appending = true
-        // CHAIN:append_messages:step(6)
-        await this.localFeedManager.appendSignedMessagesToSubfeed(this.feedId, this.subfeedHash, signedMessagesToAppend)
-        for (let sm of signedMessagesToAppend) {
-            this.#signedMessages.push(sm)
+        try {
+            // CHAIN:append_messages:step(6)
+            // the appended messages were verified by the subfeed, so the checkpoint is advanced with them
+            await this.localFeedManager.appendSignedMessagesToSubfeed(this.feedId, this.subfeedHash, signedMessagesToAppend, {verified: true})
+            for (let sm of signedMessagesToAppend) {
+                // extend the cached page, if it is loaded and up to date
+                const position = sm.body.messageNumber
+                const page = this.#pages.get(Math.floor(position / PAGE_SIZE))
+                if ((page) && (page.length === position % PAGE_SIZE)) {
+                    page.push(sm)
+                }
+                this.#numMessages = position + 1
+                this.#lastSignature = sm.signature
+            }
+        }
+        finally {
+            this.#appending = false
         }
-        this.#appending = false
     }
 }
 
-export default LocalSubfeedSignedMessagesManager
\ No newline at end of file
+export default LocalSubfeedSignedMessagesManager
@@ -37,8 +37,8 @@ class RemoteFeedManager {
         await this.outgoingSubfeedSubscriptionManager.createOrRenewOutgoingSubscription(remoteNodeId, feedId, subfeedHash)
         return true
     }
-    async submitMessage(args: {feedId: FeedId, subfeedHash: SubfeedHash, message: SubmittedSubfeedMessage, timeoutMsec: DurationMsec}) {
-        const {feedId, subfeedHash, message, timeoutMsec} = args;
+    async submitMessages(args: {feedId: FeedId, subfeedHash: SubfeedHash, messages: SubmittedSubfeedMessage[], timeoutMsec: DurationMsec}) {
+        const {feedId, subfeedHash, messages, timeoutMsec} = args;
 
         // Submit messages to a subfeed on a remote node
         // This requires write permissions
@@ -69,13 +69,17 @@ class RemoteFeedManager {
         }
 
         // Now that we know the channel and nodeId, we can submit the messages via the swarm
-        await this.node.submitMessageToRemoteLiveFeed({
-            nodeId: liveFeedInfo.nodeId,
-            feedId,
-            subfeedHash,
-            message,
-            timeoutMsec
-        });
+        // The node-to-node request carries a single message, so the messages are submitted
+        // one at a time, in order (the live feed is only looked up once)
+        for (let message of messages) {
+            await this.node.submitMessageToRemoteLiveFeed({
+                nodeId: liveFeedInfo.nodeId,
+                feedId,
+                subfeedHash,
+                message,
+                timeoutMsec
+            });
+        }
     }
     async findLiveFeedInfo({feedId, timeoutMsec}: {feedId: FeedId, timeoutMsec: DurationMsec}): Promise<FindLiveFeedResult> {
         // Find the channel and nodeId for a feed that is owned by a remote node on the p2p network
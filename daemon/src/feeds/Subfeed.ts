@@ -123,17 +123,17 @@ class Subfeed {
         return this.#isWriteable
     }
     async waitForSignedMessages({position, maxNumMessages, waitMsec}: {position: SubfeedPosition, maxNumMessages: MessageCount, waitMsec: DurationMsec}): Promise<SignedSubfeedMessage[]> {
-        const check = () => {
+        const check = async () => {
             if (subfeedPositionToNumber(position) < messageCountToNumber(this.getNumLocalMessages())) {
                 let numMessages = messageCount(messageCountToNumber(this.getNumLocalMessages()) - subfeedPositionToNumber(position))
                 if (messageCountToNumber(maxNumMessages) > 0) {
                     numMessages = messageCount(Math.min(messageCountToNumber(maxNumMessages), messageCountToNumber(numMessages)))
                 }
-                return this.getLocalSignedMessages({position, numMessages})
+                return await this.getLocalSignedMessages({position, numMessages})
             }
             else return []
         }
-        const messages = check()
+        const messages = await check()
         if (messages.length > 0) return messages
         if (durationMsecToNumber(waitMsec) > 0) {
             const success = this.remoteFeedManager.subscribeToRemoteSubfeed(this.feedId, this.subfeedHash)
@@ -145,12 +145,20 @@ class Subfeed {
                 let completed = false
                 this.#newMessageListeners.set(listenerId, () => {
                     if (completed) return
-                    const msgs = check()
-                    if (msgs.length > 0) {
+                    check().then((msgs) => {
+                        if (completed) return
+                        if (msgs.length > 0) {
+                            completed = true
+                            this.#newMessageListeners.delete(listenerId)
+                            resolve(msgs)    
+                        }
+                    }).catch((err: Error) => {
+                        /* istanbul ignore next */
+                        if (completed) return
                         completed = true
                         this.#newMessageListeners.delete(listenerId)
-                        resolve(msgs)    
-                    }
+                        reject(err)
+                    })
                 })
                 setTimeout(() => {
                     if (completed) return
@@ -164,19 +172,15 @@ class Subfeed {
             return []
         }
     }
-    getLocalSignedMessages({position, numMessages}: {position: SubfeedPosition, numMessages: MessageCount}): SignedSubfeedMessage[] {
+    async getLocalSignedMessages({position, numMessages}: {position: SubfeedPosition, numMessages: MessageCount}): Promise<SignedSubfeedMessage[]> {
         // Get some signed messages starting at position
         if (!this.#localSubfeedSignedMessagesManager.isInitialized()) {
             /* istanbul ignore next */
             throw Error('signed messages not initialized. Perhaps getLocalSignedMessages was called before subfeed was initialized.');
         }
         if (subfeedPositionToNumber(position) + messageCountToNumber(numMessages) <= Number(this.#localSubfeedSignedMessagesManager.getNumMessages())) {
-            // If we have some messages loaded into memory, let's return those!
-            let signedMessages: SignedSubfeedMessage[] = [];
-            for (let i = subfeedPositionToNumber(position); i < subfeedPositionToNumber(position) + messageCountToNumber(numMessages); i++) {
-                signedMessages.push(this.#localSubfeedSignedMessagesManager.getSignedMessage(i));
-            }
-            return signedMessages
+            // The messages are loaded from the local database page by page (recently used pages are cached in memory)
+            return await this.#localSubfeedSignedMessagesManager.getSignedMessages(subfeedPositionToNumber(position), subfeedPositionToNumber(position) + messageCountToNumber(numMessages))
         }
         else {
             throw Error(`Cannot get local signed messages (position=${position}, numMessages=${numMessages}, getNumMessages=${this.#localSubfeedSignedMessagesManager.getNumMessages()})`)
@@ -193,10 +197,7 @@ class Subfeed {
             throw Error(`Cannot write to feed without private key: ${this.#privateKey}`)
         }
         const signedMessagesToAppend: SignedSubfeedMessage[] = []
-        let previousSignature;
-        if (Number(this.#localSubfeedSignedMessagesManager.getNumMessages()) > 0) {
-            previousSignature = this.#localSubfeedSignedMessagesManager.getSignedMessage(Number(this.#localSubfeedSignedMessagesManager.getNumMessages()) - 1).signature;
-        }
+        let previousSignature = this.#localSubfeedSignedMessagesManager.getLastSignature() || undefined;
         let messageNumber = Number(this.#localSubfeedSignedMessagesManager.getNumMessages());
         for (let msg of messages) {
             let body = {
@@ -210,17 +211,21 @@ class Subfeed {
                 body,
                 signature: getSignatureJson(body as any as JSONObject, {publicKey: this.#publicKey, privateKey: this.#privateKey})
             }
-            if (!verifySignatureJson(body as any as JSONObject, getSignatureJson(body as any as JSONObject, {publicKey: this.#publicKey, privateKey: this.#privateKey}), this.#publicKey)) {
-                throw Error('Error verifying signature')
+            if (signedMessagesToAppend.length === 0) {
+                // all messages are signed with the same key, so verifying the first signature is enough to check the key
+                if (!verifySignatureJson(body as any as JSONObject, signedMessage.signature, this.#publicKey)) {
+                    throw Error('Error verifying signature')
+                }
             }
             signedMessagesToAppend.push(signedMessage)
             previousSignature = signedMessage.signature
             messageNumber ++;
         }
         // CHAIN:append_messages:step(4)
-        await this.appendSignedMessages(signedMessagesToAppend)
+        await this.appendSignedMessages(signedMessagesToAppend, {verified: true})
     }
-    async appendSignedMessages(signedMessages: SignedSubfeedMessage[]) {
+    async appendSignedMessages(signedMessages: SignedSubfeedMessage[], {verified}: {verified: boolean} = {verified: false}) {
+        // verified means the signatures were created (and checked) on this node, so they are not verified again
         if (!this.#localSubfeedSignedMessagesManager.isInitialized()) {
             /* istanbul ignore next */
             throw Error('signed messages not initialized. Perhaps appendSignedMessages was called before subfeed was initialized.');
@@ -234,15 +239,12 @@ class Subfeed {
         if (signedMessages.length === 0)
             return;
         const signedMessagesToAppend: SignedSubfeedMessage[] = []
-        let previousSignature;
-        if (Number(this.#localSubfeedSignedMessagesManager.getNumMessages()) > 0) {
-            previousSignature = this.#localSubfeedSignedMessagesManager.getSignedMessage(Number(this.#localSubfeedSignedMessagesManager.getNumMessages()) - 1).signature;
-        }
+        let previousSignature = this.#localSubfeedSignedMessagesManager.getLastSignature() || undefined;
         let messageNumber = Number(this.#localSubfeedSignedMessagesManager.getNumMessages());
         for (let signedMessage of signedMessages) {
             const body = signedMessage.body;
             const signature = signedMessage.signature;
-            if (!verifySignatureJson(body as any as JSONObject, signature, this.#publicKey)) {
+            if ((!verified) && (!verifySignatureJson(body as any as JSONObject, signature, this.#publicKey))) {
                 throw Error(`Error verifying signature when appending signed message for: ${this.feedId} ${this.subfeedHash} ${signature}`);
             }
             if ((body.previousSignature || null) !== (previousSignature || null)) {
@@ -283,6 +285,14 @@ class Subfeed {
     onMessagesAdded(callback: () => void) {
         this.#onMessagesAddedCallbacks.push(callback)
     }
+    addNewMessageListener(listener: () => void): () => void {
+        // Register a listener that is called whenever messages are appended. Returns a function that removes the listener.
+        const listenerId = createListenerId()
+        this.#newMessageListeners.set(listenerId, listener)
+        return () => {
+            this.#newMessageListeners.delete(listenerId)
+        }
+    }
     reportNumRemoteMessages(remoteNodeId: NodeId, numRemoteMessages: MessageCount) {
         this.#remoteSubfeedMessageDownloader.reportNumRemoteMessages(remoteNodeId, numRemoteMessages)
     }
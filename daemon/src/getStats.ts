@@ -1,4 +1,5 @@
 import { ByteCount, isEqualTo, isOneOf, JSONObject, NodeId, optional, _validateObject } from "./interfaces/core";
+import { AimdConcurrencyControllerStats } from "./downloadOptimizer/AimdConcurrencyController";
 import KacheryP2PNode from "./KacheryP2PNode";
 import { RemoteNodeStats } from './RemoteNode';
 import { JoinedChannelConfig } from "./services/ConfigUpdateService";
@@ -21,6 +22,10 @@ export interface NodeStatsInterface {
         http: ByteCount,
         webSocket: ByteCount
     },
+    downloadConcurrency: {
+        files: AimdConcurrencyControllerStats, // simultaneous file downloads
+        chunks: AimdConcurrencyControllerStats // simultaneous chunk downloads for each file with a manifest
+    },
     html?: string
 }
 
@@ -40,6 +45,7 @@ export const getStats = (node: KacheryP2PNode, o: GetStatsOpts): NodeStatsInterf
         joinedChannels: node.joinedChannels(),
         totalBytesSent: node.stats().totalBytesSent(),
         totalBytesReceived: node.stats().totalBytesReceived(),
+        downloadConcurrency: node.downloadOptimizer().getConcurrencyStats(),
         remoteNodes: []
     }
     node.remoteNodeManager().getAllRemoteNodes({includeOffline: true}).forEach(rn => {
@@ -913,6 +913,22 @@ export const addByteCount = (n1: ByteCount, n2: ByteCount) => {
 }
 export const exampleByteCount = byteCount(4000)
 
+export interface ByteCountPerSec extends Number {
+    __byteCountPerSec__: never
+}
+export const isByteCountPerSec = (x: any) : x is ByteCountPerSec => {
+    if (!isNumber(x)) return false
+    if (x < 0) return false
+    return true
+}
+export const byteCountPerSecToNumber = (x: ByteCountPerSec): number => {
+    return x as any as number;
+}
+export const byteCountPerSec = (n: number) => {
+    return n as any as ByteCountPerSec
+}
+export const exampleByteCountPerSec = byteCountPerSec(400)
+
 export interface LocalFilePath extends String {
     __localFilePath__: never // phantom
 }
@@ -1,7 +1,11 @@
+import { TIMEOUTS } from './common/constants'
 import DataStreamy, { DataStreamyProgress } from './common/DataStreamy'
 import { sha1MatchesFileKey } from './common/util'
-import { formatByteCount } from './downloadOptimizer/createDownloader'
-import { byteCount, ByteCount, byteCountToNumber, elapsedSince, FileKey, FileManifestChunk, isFileManifest, LocalFilePath, NodeId, nowTimestamp, Sha1Hash } from './interfaces/core'
+import createDownloader, { formatByteCount } from './downloadOptimizer/createDownloader'
+import DownloadOptimizerProviderNode from './downloadOptimizer/DownloadOptimizerProviderNode'
+import SwarmScheduler from './downloadOptimizer/SwarmScheduler'
+import { KacheryStorageFileAssembler, KacheryStorageFileWriter } from './external/ExternalInterface'
+import { byteCount, ByteCount, byteCountToNumber, elapsedSince, FileKey, FileManifestChunk, isFileManifest, LocalFilePath, NodeId, nowTimestamp } from './interfaces/core'
 import KacheryP2PNode from './KacheryP2PNode'
 
 
@@ -30,7 +34,7 @@ export const loadFileAsync = async (node: KacheryP2PNode, fileKey: FileKey, opts
     })
 }
 
-async function asyncLoop<T>(list: T[], func: (item: T, index: number) => Promise<void>, opts: {numSimultaneous: number}) {
+export async function asyncLoop<T>(list: T[], func: (item: T, index: number) => Promise<void>, opts: {numSimultaneous: number | (() => number)}) {
     return new Promise<void>((resolve, reject) => {
         let i = 0
         let numComplete = 0
@@ -42,28 +46,28 @@ async function asyncLoop<T>(list: T[], func: (item: T, index: number) => Promise
                 resolve()
                 return
             }
-            if (numRunning < opts.numSimultaneous) {
-                if (i < list.length) {
-                    i ++
-                    numRunning ++
-                    func(list[i - 1], i - 1).then(() => {
-                        numComplete ++
-                        numRunning --
-                        process.nextTick(update)
-                    })
-                    .catch((err: Error) => {
-                        error = true
-                        numRunning --
-                        reject(err)
-                    })
-                }
+            const numSimultaneous = typeof(opts.numSimultaneous) === 'number' ? opts.numSimultaneous : opts.numSimultaneous()
+            // start as many items as allowed (the limit may change between updates)
+            while ((numRunning < numSimultaneous) && (i < list.length)) {
+                i ++
+                numRunning ++
+                func(list[i - 1], i - 1).then(() => {
+                    numComplete ++
+                    numRunning --
+                    process.nextTick(update)
+                })
+                .catch((err: Error) => {
+                    error = true
+                    numRunning --
+                    reject(err)
+                })
             }
         }
         update()
     })
 }
 
-export const loadFile = async (node: KacheryP2PNode, fileKey: FileKey, opts: {fromNode: NodeId | null, label: string, _numRetries?: number}): Promise<DataStreamy> => {
+export const loadFile = async (node: KacheryP2PNode, fileKey: FileKey, opts: {fromNode: NodeId | null, label: string, storeChunks?: boolean, _numRetries?: number, _storeFile?: boolean, _createWriter?: () => KacheryStorageFileWriter}): Promise<DataStreamy> => {
     const { fromNode } = opts
 
     const r = await node.kacheryStorageManager().findFile(fileKey)
@@ -115,10 +119,14 @@ export const loadFile = async (node: KacheryP2PNode, fileKey: FileKey, opts: {fr
             const bytesLoaded = _calculateTotalBytesLoaded()
             ret.producer().reportBytesLoaded(bytesLoaded)
         }
-        const _concatenateChunks = async () => {
-            const chunkSha1s: Sha1Hash[] = manifest.chunks.map(c => c.sha1)
-            await node.kacheryStorageManager().concatenateChunksAndStoreResult(manifest.sha1, chunkSha1s)
-            ret.producer().end()
+        let assembler: KacheryStorageFileAssembler
+        try {
+            // the chunks are written directly at their offsets in the (preallocated) final file as they arrive
+            assembler = await node.kacheryStorageManager().createFileAssembler(manifest)
+        }
+        catch(err) {
+            ret.producer().error(err)
+            return ret
         }
         const _cancelAllChunkDataStreams = () => {
             chunkDataStreams.forEach((ds) => {
@@ -129,61 +137,189 @@ export const loadFile = async (node: KacheryP2PNode, fileKey: FileKey, opts: {fr
         ret.onError(() => {
             // this will get called if ret is cancelled or if there is another error
             _cancelAllChunkDataStreams()
+            assembler.cancel()
         })
+        const _copyChunkFromStorage = async (chunkFileKey: FileKey, chunkIndex: number) => {
+            const ds = await node.kacheryStorageManager().getFileReadStream(chunkFileKey)
+            const writer = assembler.createChunkWriter(chunkIndex)
+            await new Promise<void>((resolve, reject) => {
+                let paused = false
+                ds.onData(buf => {
+                    if ((!writer.write(buf)) && (!paused)) {
+                        // wait for the data to be written before reading more
+                        paused = true
+                        ds.pause()
+                        writer.drained().then(() => {
+                            paused = false
+                            ds.resume()
+                        })
+                    }
+                })
+                ds.onError(err => {
+                    writer.cancel()
+                    reject(err)
+                })
+                ds.onFinished(() => {
+                    resolve()
+                })
+            })
+            await writer.end()
+        }
+        const _chunkFileKey = (chunk: FileManifestChunk): FileKey => ({
+            sha1: chunk.sha1,
+            chunkOf: {
+                fileKey: {
+                    sha1: manifest.sha1
+                },
+                startByte: chunk.start,
+                endByte: chunk.end
+            }
+        })
+        const _completeChunk = async (chunkIndex: number): Promise<boolean> => {
+            if (assembler.isChunkComplete(chunkIndex)) return true
+            // the data did not pass through our chunk writer: either the chunk was already
+            // available locally, or it was downloaded for another request
+            const chunkFileKey = _chunkFileKey(manifest.chunks[chunkIndex])
+            if ((await node.kacheryStorageManager().findFile(chunkFileKey)).found) {
+                await _copyChunkFromStorage(chunkFileKey, chunkIndex)
+                return true
+            }
+            return false
+        }
+        let errored = false
+        const _loadChunk = async (chunk: FileManifestChunk, chunkIndex: number) => {
+            const chunkFileKey = _chunkFileKey(chunk)
+            console.info(`${opts.label}: Handling chunk ${chunkIndex} of ${manifest.chunks.length}`)
+            const label0 = `${opts.label} ch ${chunkIndex}`
+            for (let attempt = 0; ; attempt++) {
+                // the limit on the chunk downloads applies to all files together
+                const concurrencyTask = await node.downloadOptimizer().chunkConcurrency().startTaskWhenAvailable()
+                if (ret.isComplete()) {
+                    // cancelled or failed while waiting
+                    concurrencyTask.finish({error: false})
+                    return
+                }
+                let ds: DataStreamy
+                try {
+                    ds = await loadFile(node, chunkFileKey, {
+                        fromNode: opts.fromNode,
+                        label: label0,
+                        _numRetries: 2,
+                        _storeFile: opts.storeChunks === true,
+                        _createWriter: () => (assembler.createChunkWriter(chunkIndex))
+                    })
+                }
+                catch(err) {
+                    concurrencyTask.finish({error: true})
+                    throw err
+                }
+                chunkDataStreams.push(ds)
+                await new Promise<void>((resolve, reject) => {
+                    ds.onError(err => {
+                        errored = true
+                        concurrencyTask.finish({error: true})
+                        reject(err)
+                    })
+                    ds.onProgress((progress: DataStreamyProgress) => {
+                        concurrencyTask.reportBytesLoaded(progress.bytesLoaded)
+                        _updateProgressForManifestLoad()
+                    })
+                    ds.onFinished(() => {
+                        concurrencyTask.finish({error: false})
+                        resolve()
+                    })
+                })
+                if (await _completeChunk(chunkIndex)) return
+                if (attempt >= 1) {
+                    throw Error(`Unable to obtain data for chunk ${chunkIndex}`)
+                }
+            }
+        }
+        const _loadChunksFromSwarm = async (): Promise<boolean> => {
+            // Download the chunks from all of the providers of the entire file, weighted by their download rates
+            // Returns false if no providers of the entire file were found
+            let numProvidersFound = 0
+            const scheduler = new SwarmScheduler(
+                manifest.chunks.map(c => ({size: byteCount(byteCountToNumber(c.end) - byteCountToNumber(c.start))})),
+                (chunkIndex: number, providerNode: DownloadOptimizerProviderNode) => {
+                    const chunk = manifest.chunks[chunkIndex]
+                    const chunkSize = byteCount(byteCountToNumber(chunk.end) - byteCountToNumber(chunk.start))
+                    // a re-issued chunk has a second writer, which the assembler keeps apart from the first
+                    // until one of them has been verified (so a losing attempt cannot corrupt the chunk)
+                    return createDownloader(node, _chunkFileKey(chunk), providerNode, chunkSize, `${opts.label} ch ${chunkIndex}`, {
+                        storeFile: opts.storeChunks === true,
+                        createWriters: [() => (assembler.createChunkWriter(chunkIndex))]
+                    })
+                },
+                async (chunkIndex: number) => {
+                    if (!(await _completeChunk(chunkIndex))) {
+                        throw Error(`Unable to obtain data for chunk ${chunkIndex}`)
+                    }
+                },
+                node.downloadOptimizer().chunkConcurrency()
+            )
+            scheduler.onProgress((bytesLoaded: ByteCount) => {
+                ret.producer().reportBytesLoaded(bytesLoaded)
+            })
+            ret.onError(() => {
+                scheduler.cancel()
+            })
+            const _addProviderNode = (nodeId: NodeId) => {
+                numProvidersFound ++
+                scheduler.addProviderNode(node.downloadOptimizer().getProviderNode(nodeId))
+            }
+            if (opts.fromNode) {
+                _addProviderNode(opts.fromNode)
+                scheduler.setFindFinished()
+            }
+            else {
+                const ff = node.findFile({fileKey, timeoutMsec: TIMEOUTS.loadFileFindFile})
+                ff.onFound(result => {
+                    if (result.nodeId !== node.nodeId()) {
+                        _addProviderNode(result.nodeId)
+                    }
+                })
+                ff.onFinished(() => {
+                    scheduler.setFindFinished()
+                })
+                ret.onError(() => {
+                    ff.cancel()
+                })
+            }
+            try {
+                await scheduler.run()
+            }
+            catch(err) {
+                // (unless cancelled)
+                if ((numProvidersFound === 0) && (!ret.isComplete())) return false
+                throw err
+            }
+            return true
+        }
         ;(async () => {
-            let timer = nowTimestamp()
             // this happens after ret is returned
             ret.producer().start(manifest.size)
-            let numComplete = 0
-            let errored = false
             try {
-                await asyncLoop<FileManifestChunk>(manifest.chunks, async (chunk: FileManifestChunk, chunkIndex: number) => {
-                    if (errored) return
-                    const chunkFileKey: FileKey = {
-                        sha1: chunk.sha1,
-                        chunkOf: {
-                            fileKey: {
-                                sha1: manifest.sha1
-                            },
-                            startByte: chunk.start,
-                            endByte: chunk.end
-                        }
-                    }
-                    console.info(`${opts.label}: Handling chunk ${chunkIndex} of ${manifest.chunks.length}`)
-                    const label0 = `${opts.label} ch ${chunkIndex}`
-                    const ds = await loadFile(node, chunkFileKey, {fromNode: opts.fromNode, label: label0, _numRetries: 2})
-                    chunkDataStreams.push(ds)
-                    return new Promise<void>((resolve, reject) => {
-                        ds.onError(err => {
-                            errored = true
-                            reject(err)
-                        })
-                        ds.onProgress((progress: DataStreamyProgress) => {
-                            _updateProgressForManifestLoad()
-                        })
-                        ds.onFinished(() => {
-                            numComplete ++
-                            if (numComplete === manifest.chunks.length) {
-                                console.info(`${opts.label}: Concatenating chunks`)
-                                _concatenateChunks().then(() => {
-                                    const bytesLoaded = _calculateTotalBytesLoaded()
-                                    const elapsedSec = elapsedSince(entireFileTimestamp) / 1000
-                                    const rate = (byteCountToNumber(bytesLoaded) / 1e6) / elapsedSec
-                                    console.info(`${opts.label}: Downloaded ${formatByteCount(bytesLoaded)} in ${elapsedSec} sec [${rate.toFixed(3)} MiB/sec]`)
-                                    ret.producer().end()
-                                }).catch((err: Error) => {
-                                    reject(err)
-                                })
-                            }
-                            resolve()
-                        })
-                    })
-                }, {numSimultaneous: 5})
+                if (!(await _loadChunksFromSwarm())) {
+                    // the chunks may still be available individually
+                    console.info(`${opts.label}: No providers of the entire file. Loading chunks individually.`)
+                    await asyncLoop<FileManifestChunk>(manifest.chunks, async (chunk: FileManifestChunk, chunkIndex: number) => {
+                        if (errored) return
+                        await _loadChunk(chunk, chunkIndex)
+                    }, {numSimultaneous: () => (node.downloadOptimizer().chunkConcurrency().limit())})
+                }
+                console.info(`${opts.label}: Verifying assembled file`)
+                await assembler.finalize()
             }
             catch(err) {
                 ret.producer().error(err)
                 return
             }
+            const bytesLoaded = byteCount(byteCountToNumber(manifest.size))
+            const elapsedSec = elapsedSince(entireFileTimestamp) / 1000
+            const rate = (byteCountToNumber(bytesLoaded) / 1e6) / elapsedSec
+            console.info(`${opts.label}: Downloaded ${formatByteCount(bytesLoaded)} in ${elapsedSec} sec [${rate.toFixed(3)} MiB/sec]`)
+            ret.producer().end()
         })()
         return ret
     }
@@ -193,7 +329,7 @@ export const loadFile = async (node: KacheryP2PNode, fileKey: FileKey, opts: {fr
         const ret = new DataStreamy()
         let fileSize = fileKey.chunkOf ? byteCount(byteCountToNumber(fileKey.chunkOf.endByte) - byteCountToNumber(fileKey.chunkOf.startByte)) : null
         const numRetries = opts._numRetries === undefined ? 0 : opts._numRetries
-        const task = node.downloadOptimizer().createTask(fileKey, fileSize, opts.label, {fromNode: opts.fromNode, numRetries})
+        const task = node.downloadOptimizer().createTask(fileKey, fileSize, opts.label, {fromNode: opts.fromNode, numRetries, storeFile: opts._storeFile, createWriter: opts._createWriter})
         task.onError(err => {
             ret.producer().error(err)
         })
@@ -211,7 +347,7 @@ export const loadFile = async (node: KacheryP2PNode, fileKey: FileKey, opts: {fr
     }
 
     if (fileKey.manifestSha1) {
-        return await loadFileWithManifest()
+        return await node.downloadOptimizer().createManifestTask(fileKey, loadFileWithManifest)
     }
     else {
         return await loadFileWithoutManifest()
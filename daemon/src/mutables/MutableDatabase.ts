@@ -1,123 +1,53 @@
-import { Database, open } from 'sqlite';
-import sqlite3 from 'sqlite3';
 import { JSONStringifyDeterministic } from '../common/crypto_util';
-import { sleepMsec } from '../common/util';
-import { JSONValue, LocalFilePath, Sha1Hash, unscaledDurationMsec } from '../interfaces/core';
-import fs from 'fs'
+import SqliteConnectionManager, { SqliteTransaction } from '../common/SqliteConnectionManager';
+import { JSONValue, LocalFilePath, Sha1Hash } from '../interfaces/core';
 
 export type MutableRecord = {
     key: JSONValue
     value: JSONValue
 }
 
+const createTables = async (tx: SqliteTransaction) => {
+    await tx.run(`
+        CREATE TABLE IF NOT EXISTS mutables (
+            sha1 TEXT PRIMARY KEY NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID;
+    `)
+}
+
 class MutableDatabase {
-    #db: Database | null = null
-    #initializing = false
-    #initialized = false
-    #databaseLocked = false
-    #onDatabaseLockReleasedCallbacks: (() => void)[] = []
+    #connections: SqliteConnectionManager
     constructor(private databasePath: LocalFilePath) {
+        this.#connections = new SqliteConnectionManager(databasePath, {createTables})
     }
-    async _initialize() {
-        if (this.#initialized) return
-        while (this.#initializing) {
-            await sleepMsec(unscaledDurationMsec(100))
-        }
-        if (this.#initialized) return
-        this.#initializing = true
-        const createTables = async (db: Database) => {
-            await db.run(`
-                CREATE TABLE IF NOT EXISTS mutables (
-                    sha1 TEXT PRIMARY KEY NOT NULL,
-                    key TEXT NOT NULL,
-                    value TEXT NOT NULL
-                ) WITHOUT ROWID;
-            `)
-        }
-        const db = await this._openDatabase()
-        try {
-            await db.run(`PRAGMA foreign_keys = ON`)
-            await createTables(db)
-        }
-        finally {
-            await this._closeDatabase()
-        }
-        fs.chmodSync(this.databasePath.toString(), fs.constants.S_IRUSR | fs.constants.S_IWUSR)
-        this.#initialized = true
-        this.#initializing = false
-    }
-    async _acquireDatabaseLock() {
-        if (!this.#databaseLocked) {
-            this.#databaseLocked = true
-            return
-        }
-        await new Promise<void>((resolve) => {
-            this.#onDatabaseLockReleasedCallbacks.push(() => {
-                this.#databaseLocked = true
-                resolve()
-            })
-        })
-    }
-    _releaseDatabaseLock() {
-        if (!this.#databaseLocked) {
-            throw Error('Unexpected: (mutable db) cannot release database lock when it is not locked')
-        }
-        this.#databaseLocked = false
-        if (this.#onDatabaseLockReleasedCallbacks.length > 0) {
-            const cb = this.#onDatabaseLockReleasedCallbacks[0]
-            this.#onDatabaseLockReleasedCallbacks = this.#onDatabaseLockReleasedCallbacks.slice(1)
-            cb()
-        }
-    }
-    async _openDatabase() {
-        await this._acquireDatabaseLock()
-        this.#db = await open({filename: this.databasePath.toString(), driver: sqlite3.Database})
-        return this.#db
-    }
-    async _closeDatabase() {
-        if (!this.#db) throw Error('Unexpected in closeDatabase: (mutable db) database is null')
-        await this.#db.close()
-        this._releaseDatabaseLock()
+    async close() {
+        await this.#connections.close()
     }
     async set(sha1: Sha1Hash, record: MutableRecord) {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            await db.run('BEGIN TRANSACTION')
-            await db.run(`
+        await this.#connections.write(async (tx) => {
+            await tx.run(`
                 INSERT OR REPLACE INTO mutables (sha1, key, value) VALUES ($sha1, $key, $value)
             `, {
                 '$sha1': sha1.toString(),
                 '$key': JSONStringifyDeterministic(record.key as Object),
                 '$value': JSONStringifyDeterministic(record.value as Object)
             })
-            await db.run('COMMIT')
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
     }
     async delete(sha1: Sha1Hash) {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            await db.run('BEGIN TRANSACTION')
-            await db.run(`
+        await this.#connections.write(async (tx) => {
+            await tx.run(`
                 DELETE FROM mutables WHERE sha1 = $sha1
             `, {
                 '$sha1': sha1.toString()
             })
-            await db.run('COMMIT')
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
     }
     async has(sha1: Sha1Hash): Promise<boolean> {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            const row = await db.get(`
+        return await this.#connections.read(async (tx) => {
+            const row = await tx.get<{sha1: string}>(`
                 SELECT sha1 FROM mutables WHERE sha1 = $sha1
             `, {
                 '$sha1': sha1.toString()
@@ -134,16 +64,11 @@ class MutableDatabase {
             else {
                 return false
             }
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
     }
     async get(sha1: Sha1Hash): Promise<MutableRecord | undefined> {
-        await this._initialize()
-        const db = await this._openDatabase()
-        try {
-            const rows: {key: string, value: string}[] = await db.all(`
+        return await this.#connections.read(async (tx) => {
+            const rows = await tx.all<{key: string, value: string}>(`
                 SELECT key, value FROM mutables WHERE sha1 = $sha1
             `, {
                 '$sha1': sha1.toString()
@@ -161,10 +86,7 @@ class MutableDatabase {
                 value: JSON.parse(row.value)
             }
             return rec
-        }
-        finally {
-            await this._closeDatabase()
-        }
+        })
     }
 }
 
@@ -1,5 +1,7 @@
 import express, { Express, NextFunction, Request, Response } from 'express';
 import cors from 'cors';
+import fs from 'fs';
+import http from 'http';
 import JsonSocket from 'json-socket';
 import { Socket } from 'net';
 import { ChannelConfig, isChannelConfig } from '../cli';
@@ -10,7 +12,7 @@ import { HttpServerInterface } from '../external/ExternalInterface';
 import { isGetStatsOpts, NodeStatsInterface } from '../getStats';
 import { Address, ChannelConfigUrl, DaemonVersion, DurationMsec, durationMsecToNumber, ErrorMessage, FeedId, FeedName, FileKey, FindFileResult, isAddress, isArrayOf, isBoolean, isChannelConfigUrl, isDaemonVersion, isDurationMsec, isEqualTo, isFeedId, isFeedName, isFileKey, isJSONObject, isMessageCount, isNodeId, isNull, isObjectOf, isOneOf, isSignedSubfeedMessage, isString, isSubfeedAccessRules, isSubfeedHash, isSubfeedMessage, isSubfeedPosition, isSubfeedWatches, isSubmittedSubfeedMessage, JSONObject, LocalFilePath, mapToObject, messageCount, MessageCount, NodeId, optional, Port, ProtocolVersion, scaledDurationMsec, Sha1Hash, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, SubfeedMessage, SubfeedPosition, SubfeedWatches, SubmittedSubfeedMessage, toSubfeedWatchesRAM, _validateObject, JSONValue, isJSONValue, byteCount, ByteCount, isByteCount, isNumber } from '../interfaces/core';
 import KacheryP2PNode from '../KacheryP2PNode';
-import { loadFile } from '../loadFile';
+import { asyncLoop, loadFile } from '../loadFile';
 import { daemonVersion, protocolVersion } from '../protocolVersion';
 import { isJoinedChannelConfig, JoinedChannelConfig } from './ConfigUpdateService';
 import { PublicApiProbeResponse } from './PublicApiServer';
@@ -117,6 +119,23 @@ const isApiLoadFileRequest = (x: any): x is ApiLoadFileRequest => {
     });
 }
 
+const isPositiveInteger = (x: any): x is number => {
+    return isNumber(x) && Number.isInteger(x) && (x >= 1)
+}
+
+export interface ApiLoadFilesRequest {
+    fileKeys: FileKey[],
+    fromNode: NodeId | null,
+    maxConcurrency: number
+}
+const isApiLoadFilesRequest = (x: any): x is ApiLoadFilesRequest => {
+    return _validateObject(x, {
+        fileKeys: isArrayOf(isFileKey),
+        fromNode: isOneOf([isNull, isNodeId]),
+        maxConcurrency: isPositiveInteger
+    });
+}
+
 export interface ApiDownloadFileDataRequest {
     fileKey: FileKey,
     startByte?: ByteCount
@@ -155,6 +174,17 @@ export const isFeedApiWatchForNewMessagesResponse = (x: any): x is FeedApiWatchF
     })
 }
 
+export interface FeedApiSubscribeToMessagesRequest {
+    subfeedWatches: SubfeedWatches,
+    signed?: boolean
+}
+const isFeedApiSubscribeToMessagesRequest = (x: any): x is FeedApiSubscribeToMessagesRequest => {
+    return _validateObject(x, {
+        subfeedWatches: isSubfeedWatches,
+        signed: optional(isBoolean)
+    })
+}
+
 export interface MutableApiSetRequest {
     key: JSONValue
     value: JSONValue
@@ -329,6 +359,29 @@ export const isFeedApiSubmitMessageResponse = (x: any): x is FeedApiSubmitMessag
     })
 }
 
+export interface FeedApiSubmitMessagesRequest {
+    feedId: FeedId,
+    subfeedHash: SubfeedHash,
+    messages: SubmittedSubfeedMessage[],
+    timeoutMsec: DurationMsec
+}
+export const isFeedApiSubmitMessagesRequest = (x: any): x is FeedApiSubmitMessagesRequest => {
+    return _validateObject(x, {
+        feedId: isFeedId,
+        subfeedHash: isSubfeedHash,
+        messages: isArrayOf(isSubmittedSubfeedMessage),
+        timeoutMsec: isDurationMsec
+    });
+}
+export interface FeedApiSubmitMessagesResponse {
+    success: boolean
+}
+export const isFeedApiSubmitMessagesResponse = (x: any): x is FeedApiSubmitMessagesResponse => {
+    return _validateObject(x, {
+        success: isBoolean
+    })
+}
+
 export interface FeedApiGetNumLocalMessagesRequest {
     feedId: FeedId,
     subfeedHash: SubfeedHash
@@ -456,6 +509,7 @@ export default class DaemonApiServer {
     #app: Express
     // #server: http.Server | https.Server | null = null
     #server: HttpServerInterface | null = null
+    #unixSocketServer: http.Server | null = null
     #simpleGetHandlers: {
         path: string,
         handler: (query: JSONObject) => Promise<JSONObject>,
@@ -549,6 +603,12 @@ export default class DaemonApiServer {
             handler: async (reqData: JSONObject) => {return await this._handleFeedApiSubmitMessage(reqData)},
             browserAccess: false
         },
+        {
+            // /feed/submitMessages - submit a batch of messages to a remote live subfeed (must have permission)
+            path: '/feed/submitMessages',
+            handler: async (reqData: JSONObject) => {return await this._handleFeedApiSubmitMessages(reqData)},
+            browserAccess: false
+        },
         {
             // /feed/getNumLocalMessages - get number of messages in a subfeed
             path: '/feed/getNumLocalMessages',
@@ -675,6 +735,30 @@ export default class DaemonApiServer {
             });
             /////////////////////////////////////////////////////////////////////////
         });
+        // /loadFiles - download a batch of files from remote node(s), reporting each one as it completes
+        this.#app.post('/loadFiles', async (req, res) => {
+            if (!this._checkAuthCode(req, res, {browserAccess: true})) return
+            /////////////////////////////////////////////////////////////////////////
+            /* istanbul ignore next */
+            await action('/loadFiles', {context: 'Daemon API'}, async () => {
+                await this._apiLoadFiles(req, res)
+            }, async (err: Error) => {
+                res.status(500).send('Error loading files.');
+            });
+            /////////////////////////////////////////////////////////////////////////
+        });
+        // /feed/subscribeToMessages - push the messages appended to a list of watched subfeeds
+        this.#app.post('/feed/subscribeToMessages', async (req, res) => {
+            if (!this._checkAuthCode(req, res, {browserAccess: true})) return
+            /////////////////////////////////////////////////////////////////////////
+            /* istanbul ignore next */
+            await action('/feed/subscribeToMessages', {context: 'Daemon API'}, async () => {
+                await this._feedApiSubscribeToMessages(req, res)
+            }, async (err: Error) => {
+                res.status(500).send('Error subscribing to messages.');
+            });
+            /////////////////////////////////////////////////////////////////////////
+        });
         // /downloadFileData - download file data - file must exist in local kachery storage
         this.#app.post('/downloadFileData', async (req, res) => {
             if (!this._checkAuthCode(req, res, {browserAccess: true})) return
@@ -705,6 +789,10 @@ export default class DaemonApiServer {
         if (this.#server) {
             this.#server.close()
         }
+        /* istanbul ignore next */
+        if (this.#unixSocketServer) {
+            this.#unixSocketServer.close()
+        }
     }
     // async mockGetJson(path: string): Promise<JSONObject> {
     //     for (let h of this.#simpleGetHandlers) {
@@ -921,6 +1009,94 @@ export default class DaemonApiServer {
             x.cancel()
         });
     }
+    // /loadFiles - load a batch of files from remote kachery node(s) and store in kachery storage
+    // Sends one message per file (in order of completion) with the index of the file key in the request
+    /* istanbul ignore next */
+    async _apiLoadFiles(req: Request, res: Response) {
+        const jsonSocket = new JsonSocket(res as any as Socket)
+        const apiLoadFilesRequest = req.body
+        if (!isApiLoadFilesRequest(apiLoadFilesRequest)) {
+            jsonSocket.sendMessage({type: 'error', error: 'Invalid api load files request'}, () => {})
+            res.end()
+            return
+        }
+        const { fileKeys, fromNode, maxConcurrency } = apiLoadFilesRequest
+        let isDone = false
+        const dataStreams = new Set<DataStreamy>()
+        req.on('close', () => {
+            // if the request socket is closed, we cancel the pending loads
+            isDone = true
+            dataStreams.forEach(ds => {ds.cancel()})
+            dataStreams.clear()
+        });
+        await asyncLoop<FileKey>(fileKeys, async (fileKey: FileKey, index: number) => {
+            if (isDone) return
+            let x: DataStreamy
+            try {
+                x = await this._loadFile({fileKey, fromNode})
+            }
+            catch(err) {
+                if (isDone) return
+                jsonSocket.sendMessage({type: 'error', index, error: err.message}, () => {})
+                return
+            }
+            if (isDone) {
+                x.cancel()
+                return
+            }
+            dataStreams.add(x)
+            const error = await new Promise<string | null>((resolve) => {
+                x.onFinished(() => {resolve(null)})
+                x.onError((err: Error) => {resolve(err.message)})
+            })
+            dataStreams.delete(x)
+            if (isDone) return
+            if (error !== null) {
+                jsonSocket.sendMessage({type: 'error', index, error}, () => {})
+                return
+            }
+            const {found, localFilePath} = await this.#node.kacheryStorageManager().findFile(fileKey)
+            if (isDone) return
+            if ((found) && (localFilePath)) {
+                jsonSocket.sendMessage({type: 'finished', index, localFilePath}, () => {})
+            }
+            else {
+                jsonSocket.sendMessage({type: 'error', index, error: 'Unexpected: did not find file in local kachery storage even after load completed'}, () => {})
+            }
+        }, {numSimultaneous: maxConcurrency})
+        if (isDone) return
+        isDone = true
+        res.end()
+    }
+    // /feed/subscribeToMessages - push the messages appended to a list of watched subfeeds
+    // Sends {type: 'messages', watchName, messages} as soon as messages are available, for as long as the request stays open
+    /* istanbul ignore next */
+    async _feedApiSubscribeToMessages(req: Request, res: Response) {
+        const jsonSocket = new JsonSocket(res as any as Socket)
+        const reqData = req.body
+        if (!isFeedApiSubscribeToMessagesRequest(reqData)) {
+            jsonSocket.sendMessage({type: 'error', error: 'Invalid subscribe to messages request'}, () => {})
+            res.end()
+            return
+        }
+        const { subfeedWatches, signed } = reqData
+        const cancel = this.#node.feedManager().subscribeToMessages({
+            subfeedWatches: toSubfeedWatchesRAM(subfeedWatches),
+            signed: signed || false,
+            onMessages: (watchName, messages) => {
+                jsonSocket.sendMessage({type: 'messages', watchName, messages}, () => {})
+            }
+        })
+        // lets the client detect a connection that has silently gone away
+        const keepAliveTimer = setInterval(() => {
+            jsonSocket.sendMessage({type: 'keepAlive'}, () => {})
+        }, durationMsecToNumber(scaledDurationMsec(20 * 1000)))
+        req.on('close', () => {
+            // if the request socket is closed, we cancel the subscription
+            clearInterval(keepAliveTimer)
+            cancel()
+        });
+    }
     // /loadFile - download data for a file - must already be on this node
     /* istanbul ignore next */
     async _apiDownloadFileData(req: Request, res: Response): Promise<void> {
@@ -1061,12 +1237,25 @@ export default class DaemonApiServer {
 
         const { feedId, subfeedHash, message, timeoutMsec } = reqData;
 
-        await this.#node.feedManager().submitMessage({feedId, subfeedHash, message, timeoutMsec});
+        await this.#node.feedManager().submitMessages({feedId, subfeedHash, messages: [message], timeoutMsec});
 
         const response: FeedApiSubmitMessageResponse = {success: true}
         if (!isJSONObject(response)) throw Error('Unexpected, not a JSON-serializable object');
         return response
     }
+    // /feed/submitMessages - submit a batch of messages to a remote live subfeed (must have permission)
+    async _handleFeedApiSubmitMessages(reqData: JSONObject) {
+        /* istanbul ignore next */
+        if (!isFeedApiSubmitMessagesRequest(reqData)) throw Error('Invalid request in _feedApiSubmitMessages');
+
+        const { feedId, subfeedHash, messages, timeoutMsec } = reqData;
+
+        await this.#node.feedManager().submitMessages({feedId, subfeedHash, messages, timeoutMsec});
+
+        const response: FeedApiSubmitMessagesResponse = {success: true}
+        if (!isJSONObject(response)) throw Error('Unexpected, not a JSON-serializable object');
+        return response
+    }
     // /feed/getNumLocalMessages - get number of messages in a subfeed
     async _handleFeedApiGetNumLocalMessages(reqData: JSONObject) {
         /* istanbul ignore next */
@@ -1198,6 +1387,30 @@ export default class DaemonApiServer {
     async listen(port: Port) {
         this.#server = await this.#node.externalInterface().startHttpServer(this.#app, port)
     }
+    // Additionally listen on a unix domain socket (optional transport for local clients)
+    // Rejects if the socket cannot be created, so that the caller can continue with tcp only
+    async listenUnixSocket(socketPath: LocalFilePath) {
+        const p = socketPath.toString()
+        if (fs.existsSync(p)) {
+            // left over from a previous run
+            fs.unlinkSync(p)
+        }
+        const server = http.createServer(this.#app as http.RequestListener)
+        await new Promise<void>((resolve, reject) => {
+            const onListening = () => {
+                server.removeListener('error', onError)
+                resolve()
+            }
+            const onError = (err: Error) => {
+                server.removeListener('listening', onListening)
+                reject(err)
+            }
+            server.once('listening', onListening)
+            server.once('error', onError)
+            server.listen(p)
+        })
+        this.#unixSocketServer = server
+    }
     _checkAuthCode(req: Request, res: Response, opts: {browserAccess: boolean}) {
         const authCode = req.header('KACHERY-CLIENT-AUTH-CODE')
         if (!authCode) {
@@ -11,6 +11,7 @@ import { FallbackUdpPacketRequestData, isNodeToNodeRequest, isNodeToNodeResponse
 import { createUdpMessageId, isUdpHeader, numParts, NumParts, partIndex, PartIndex, UdpHeader, UdpMessageMetaData, udpMessageMetaData, UdpMessagePart, UdpMessageType, UDP_MESSAGE_HEADER_SIZE, UDP_PACKET_SIZE } from "../interfaces/UdpMessage";
 import KacheryP2PNode from "../KacheryP2PNode";
 import { protocolVersion } from "../protocolVersion";
+import { advertisesBinaryUdpHeaderSupport, binaryUdpHeaderSize, binaryUdpHeaderSupportMetaData, decodeBinaryUdpHeader, encodeBinaryUdpHeader, isBinaryUdpHeaderPacket } from '../udp/BinaryUdpHeader';
 import UdpMessagePartManager from '../udp/UdpMessagePartManager';
 import UdpPacketReceiver from '../udp/UdpPacketReceiver';
 import UdpPacketSender, { FallbackAddress, PacketId } from "../udp/UdpPacketSender";
@@ -78,6 +79,7 @@ export default class PublicUdpSocketServer {
     #responseListeners = new GarbageMap<RequestId, ResponseListener>(scaledDurationMsec(30 * 60 * 1000))
     #incomingDataStreams = new GarbageMap<StreamId, DataStreamy>(scaledDurationMsec(60 * 60 * 1000))
     #receivedUdpPackets = new GarbageMap<PacketId, boolean>(scaledDurationMsec(30 * 60 * 1000))
+    #binaryUdpHeaderNodeIds = new GarbageMap<NodeId, boolean>(scaledDurationMsec(30 * 60 * 1000)) // nodes that support the binary header
     #fallbackPacketSender: FallbackPacketSender
     #stopped = false
     constructor(node: KacheryP2PNode, private firewalled: boolean) {
@@ -167,7 +169,7 @@ export default class PublicUdpSocketServer {
                 fallbackAddress,
                 "NodeToNodeRequest",
                 request as any as JSONObject,
-                udpMessageMetaData({}),
+                binaryUdpHeaderSupportMetaData(),
                 {timeoutMsec: opts.timeoutMsec, toNodeId: request.body.toNodeId}
             ).catch(err => {
                 _handleError(err)
@@ -234,18 +236,35 @@ export default class PublicUdpSocketServer {
             hostName: hostName(remoteInfo.address)
         } : null
         
-        const headerTxt = packet.slice(0, UDP_MESSAGE_HEADER_SIZE).toString().trimEnd()
-        const dataBuffer = packet.slice(UDP_MESSAGE_HEADER_SIZE);
-        const header = tryParseJsonObject(headerTxt)
-        if (header === null) {
-            return;
+        let header: UdpHeader
+        let dataBuffer: Buffer
+        const binaryHeader = isBinaryUdpHeaderPacket(packet)
+        if (binaryHeader) {
+            const x = decodeBinaryUdpHeader(packet)
+            if (x === null) {
+                /* istanbul ignore next */
+                console.warn('Problem with binary udp header')
+                /* istanbul ignore next */
+                return
+            }
+            header = x.header
+            dataBuffer = x.dataBuffer
         }
-        if (!isUdpHeader(header)) {
-            /* istanbul ignore next */
-            console.warn(header)
-            /* istanbul ignore next */
-            console.warn('Problem with udp header')
-            return
+        else {
+            const headerTxt = packet.slice(0, UDP_MESSAGE_HEADER_SIZE).toString().trimEnd()
+            dataBuffer = packet.slice(UDP_MESSAGE_HEADER_SIZE);
+            const h = tryParseJsonObject(headerTxt)
+            if (h === null) {
+                return;
+            }
+            if (!isUdpHeader(h)) {
+                /* istanbul ignore next */
+                console.warn(h)
+                /* istanbul ignore next */
+                console.warn('Problem with udp header')
+                return
+            }
+            header = h
         }
         if (checkFromNodeId) {
             if (checkFromNodeId !== header.body.fromNodeId) {
@@ -262,7 +281,7 @@ export default class PublicUdpSocketServer {
         
         /////////////////////////////////////////////////////////////////////////
         action('handleUdpMessagePart', {fromAddress, fromNodeId: header.body.fromNodeId, udpMessageType: header.body.udpMessageType}, async () => {
-            this._handleMessagePart(fromAddress, header, dataBuffer);
+            this._handleMessagePart(fromAddress, header, dataBuffer, {binaryHeader});
         }, async () => {
         })
         /////////////////////////////////////////////////////////////////////////
@@ -282,11 +301,14 @@ export default class PublicUdpSocketServer {
             payloadIsJson = true
             messageBuffer = Buffer.from(JSON.stringify(messageData))
         }
-        const parts: UdpMessagePart[] = this._createUdpMessageParts(messageType, address, messageBuffer, metaData, {payloadIsJson})
+        // use the binary header only for nodes that are known to support it
+        const binaryHeader = this.#binaryUdpHeaderNodeIds.has(opts.toNodeId)
+        const headerSize = binaryHeader ? binaryUdpHeaderSize(address, metaData) : UDP_MESSAGE_HEADER_SIZE
+        const parts: UdpMessagePart[] = this._createUdpMessageParts(messageType, address, messageBuffer, metaData, {payloadIsJson, headerSize})
         const packets: Buffer[] = []
         for (let part of parts) {
             const b = Buffer.concat([
-                Buffer.from(JSON.stringify(part.header).padEnd(UDP_MESSAGE_HEADER_SIZE, ' ')),
+                binaryHeader ? encodeBinaryUdpHeader(part.header) : Buffer.from(JSON.stringify(part.header).padEnd(UDP_MESSAGE_HEADER_SIZE, ' ')),
                 part.dataBuffer
             ])
             packets.push(b)
@@ -302,13 +324,25 @@ export default class PublicUdpSocketServer {
             throw(err)
         }
     }
-    _handleMessagePart(remoteAddress: Address | null, header: UdpHeader, dataBuffer: Buffer) {
+    _handleMessagePart(remoteAddress: Address | null, header: UdpHeader, dataBuffer: Buffer, opts: {binaryHeader: boolean}) {
         if (!verifySignature(header.body, header.signature, nodeIdToPublicKey(header.body.fromNodeId))) {
             /* istanbul ignore next */
             throw Error('Error verifying signature in udp message')
         }
+        this._updateBinaryUdpHeaderSupport(header, opts)
         this.#messagePartManager.addMessagePart(remoteAddress, header.body.udpMessageId, header.body.partIndex, header.body.numParts, header, dataBuffer)
     }
+    _updateBinaryUdpHeaderSupport(header: UdpHeader, opts: {binaryHeader: boolean}) {
+        const fromNodeId = header.body.fromNodeId
+        const mt = header.body.udpMessageType
+        if ((opts.binaryHeader) || (advertisesBinaryUdpHeaderSupport(header.body.metaData))) {
+            this.#binaryUdpHeaderNodeIds.set(fromNodeId, true)
+        }
+        else if ((mt === "NodeToNodeRequest") || (mt === "NodeToNodeResponse")) {
+            // the node no longer advertises support (e.g., it was downgraded)
+            this.#binaryUdpHeaderNodeIds.delete(fromNodeId)
+        }
+    }
     _handleCompleteMessage(header: UdpHeader, dataBuffer: Buffer) {
         const mt = header.body.udpMessageType
         if (mt === "NodeToNodeRequest") {
@@ -323,7 +357,7 @@ export default class PublicUdpSocketServer {
                 const response: NodeToNodeResponse = await this.#node.handleNodeToNodeRequest(req)
                 const fallbackAddress = nodeIdFallbackAddress(req.body.fromNodeId)
                 const remoteAddress = this.#messagePartManager.getRemoteAddressForNodeId(req.body.fromNodeId)
-                await this._sendMessage(remoteAddress, fallbackAddress, "NodeToNodeResponse", response as any as JSONObject, udpMessageMetaData({}), {timeoutMsec: TIMEOUTS.defaultResponse, toNodeId: req.body.fromNodeId})
+                await this._sendMessage(remoteAddress, fallbackAddress, "NodeToNodeResponse", response as any as JSONObject, binaryUdpHeaderSupportMetaData(), {timeoutMsec: TIMEOUTS.defaultResponse, toNodeId: req.body.fromNodeId})
             }, async () => {
             })
             /////////////////////////////////////////////////////////////////////////
@@ -398,9 +432,9 @@ export default class PublicUdpSocketServer {
             ds.producer().unorderedEnd(metaData.numDataChunks)
         }
     }
-    _createUdpMessageParts(udpMessageType: UdpMessageType, toAddress: Address | null, messageData: Buffer, metaData: UdpMessageMetaData, opts: {payloadIsJson: boolean}): UdpMessagePart[] {
+    _createUdpMessageParts(udpMessageType: UdpMessageType, toAddress: Address | null, messageData: Buffer, metaData: UdpMessageMetaData, opts: {payloadIsJson: boolean, headerSize: number}): UdpMessagePart[] {
         const parts: UdpMessagePart[] = []
-        const partSize = UDP_PACKET_SIZE - UDP_MESSAGE_HEADER_SIZE
+        const partSize = UDP_PACKET_SIZE - opts.headerSize
         const buffers: Buffer[] = []
         let i = 0
         while (i < messageData.length) {
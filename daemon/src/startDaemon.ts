@@ -24,6 +24,7 @@ export interface StartDaemonOpts {
     firewalled: boolean,
     staticConfigPathOrUrl: string | null,
     authGroup: string | null,
+    daemonApiSocketPath?: LocalFilePath | null,
     services: {
         announce?: boolean,
         discover?: boolean,
@@ -114,6 +115,16 @@ const startDaemon = async (args: {
     if (opts.services.daemonServer && (daemonApiPort !== null)) {
         await daemonApiServer.listen(daemonApiPort);
         console.info(`Daemon http server listening on port ${daemonApiPort}`)
+        if (opts.daemonApiSocketPath) {
+            try {
+                await daemonApiServer.listenUnixSocket(opts.daemonApiSocketPath);
+                console.info(`Daemon http server listening on unix socket ${opts.daemonApiSocketPath}`)
+            }
+            catch(err) {
+                // clients fall back to the tcp port when the socket is not there
+                console.warn(`Unable to listen on unix socket ${opts.daemonApiSocketPath}, continuing with tcp only: ${err.message}`)
+            }
+        }
     }
 
     // Start the websocket server
@@ -0,0 +1,107 @@
+import { Address, isNumber, JSONObject, tryParseJsonObject } from '../interfaces/core';
+import { isUdpHeader, numPartsToNumber, partIndexToNumber, UdpHeader, UdpMessageMetaData, udpMessageMetaData, UdpMessageType, UDP_MESSAGE_HEADER_SIZE } from '../interfaces/UdpMessage';
+import { protocolVersion } from '../protocolVersion';
+
+// Fixed-layout binary udp message header (integers big-endian):
+//
+//   magic (2 bytes) | version (uint8) | header length (uint16) | message type (uint8) | flags (uint8)
+//   part index (uint32) | num. parts (uint32) | udp message id (10 bytes, ascii)
+//   from node id (32 bytes) | signature (64 bytes)
+//   extension: JSON of {toAddress, metaData} (utf-8, up to the header length)
+//
+// The message payload follows the header directly. The JSON header always starts with '{',
+// so the two formats can be told apart from the first byte of the packet.
+//
+// The signature is over the same header body as for the JSON header. The body is
+// reconstructed on receipt (with the protocol version of this node) and verified as usual.
+//
+// Support is negotiated per peer: request and response messages advertise the supported
+// version in their meta data, and the binary header is only sent to nodes that advertised it.
+
+export const BINARY_UDP_HEADER_VERSION = 1
+
+const MAGIC = Buffer.from('KB')
+const FIXED_SIZE = 121
+const FLAG_PAYLOAD_IS_JSON = 1
+
+// the code of a message type is its index in this list (append only)
+const MESSAGE_TYPES: UdpMessageType[] = [
+    "NodeToNodeRequest",
+    "NodeToNodeResponse",
+    "KeepAlive",
+    "streamDataChunk",
+    "streamDataError",
+    "streamDataEnd"
+]
+
+const _extension = (toAddress: Address | null, metaData: UdpMessageMetaData): Buffer => {
+    return Buffer.from(JSON.stringify({toAddress, metaData}))
+}
+
+export const binaryUdpHeaderSize = (toAddress: Address | null, metaData: UdpMessageMetaData): number => {
+    return FIXED_SIZE + _extension(toAddress, metaData).length
+}
+
+export const encodeBinaryUdpHeader = (header: UdpHeader): Buffer => {
+    const b = header.body
+    const ext = _extension(b.toAddress, b.metaData)
+    const size = FIXED_SIZE + ext.length
+    if (size > UDP_MESSAGE_HEADER_SIZE) {
+        /* istanbul ignore next */
+        throw Error(`Binary udp header is too large: ${size}`)
+    }
+    const buf = Buffer.alloc(size)
+    MAGIC.copy(buf, 0)
+    buf.writeUInt8(BINARY_UDP_HEADER_VERSION, 2)
+    buf.writeUInt16BE(size, 3)
+    buf.writeUInt8(MESSAGE_TYPES.indexOf(b.udpMessageType), 5)
+    buf.writeUInt8(b.payloadIsJson ? FLAG_PAYLOAD_IS_JSON : 0, 6)
+    buf.writeUInt32BE(partIndexToNumber(b.partIndex), 7)
+    buf.writeUInt32BE(numPartsToNumber(b.numParts), 11)
+    buf.write(b.udpMessageId.toString(), 15, 10, 'ascii')
+    buf.write(b.fromNodeId.toString(), 25, 32, 'hex')
+    buf.write(header.signature.toString(), 57, 64, 'hex')
+    ext.copy(buf, FIXED_SIZE)
+    return buf
+}
+
+export const isBinaryUdpHeaderPacket = (packet: Buffer): boolean => {
+    return (packet.length >= MAGIC.length) && (packet[0] === MAGIC[0]) && (packet[1] === MAGIC[1])
+}
+
+export const decodeBinaryUdpHeader = (packet: Buffer): {header: UdpHeader, dataBuffer: Buffer} | null => {
+    if (packet.length < FIXED_SIZE) return null
+    if (!isBinaryUdpHeaderPacket(packet)) return null
+    if (packet.readUInt8(2) !== BINARY_UDP_HEADER_VERSION) return null
+    const size = packet.readUInt16BE(3)
+    if ((size < FIXED_SIZE) || (size > packet.length)) return null
+    const messageTypeCode = packet.readUInt8(5)
+    if (messageTypeCode >= MESSAGE_TYPES.length) return null
+    const ext = tryParseJsonObject(packet.slice(FIXED_SIZE, size).toString())
+    if (ext === null) return null
+    const header = {
+        body: {
+            udpMessageId: packet.toString('ascii', 15, 25),
+            protocolVersion: protocolVersion(),
+            fromNodeId: packet.toString('hex', 25, 57),
+            toAddress: ext.toAddress,
+            udpMessageType: MESSAGE_TYPES[messageTypeCode],
+            metaData: ext.metaData,
+            partIndex: packet.readUInt32BE(7),
+            numParts: packet.readUInt32BE(11),
+            payloadIsJson: (packet.readUInt8(6) & FLAG_PAYLOAD_IS_JSON) !== 0
+        },
+        signature: packet.toString('hex', 57, FIXED_SIZE)
+    }
+    if (!isUdpHeader(header)) return null
+    return {header, dataBuffer: packet.slice(size)}
+}
+
+export const binaryUdpHeaderSupportMetaData = (): UdpMessageMetaData => {
+    return udpMessageMetaData({binaryUdpHeaderVersion: BINARY_UDP_HEADER_VERSION})
+}
+
+export const advertisesBinaryUdpHeaderSupport = (metaData: UdpMessageMetaData): boolean => {
+    const v = (metaData as any as JSONObject).binaryUdpHeaderVersion
+    return isNumber(v) && (v === BINARY_UDP_HEADER_VERSION)
+}
@@ -1,5 +1,5 @@
 import { randomAlphaString } from "../common/util";
-import { addByteCount, byteCount, ByteCount, byteCountToNumber, DurationMsec, durationMsecToNumber, elapsedSince, isNumber, nowTimestamp, scaledDurationMsec, scaleDurationBy, unscaledDurationMsec } from "../interfaces/core";
+import { addByteCount, byteCount, ByteCount, byteCountPerSec, ByteCountPerSec, byteCountPerSecToNumber, byteCountToNumber, DurationMsec, durationMsecToNumber, elapsedSince, isNumber, nowTimestamp, scaledDurationMsec, scaleDurationBy, unscaledDurationMsec } from "../interfaces/core";
 import { PacketId } from "./UdpPacketSender";
 
 // this is the target fraction of udp packets lost
@@ -11,22 +11,6 @@ export class UdpTimeoutError extends Error {
     }
 }
 
-export interface ByteCountPerSec extends Number {
-    __byteCountPerSec__: never
-}
-export const isByteCountPerSec = (x: any) : x is ByteCountPerSec => {
-    if (!isNumber(x)) return false
-    if (x < 0) return false
-    return true
-}
-export const byteCountPerSecToNumber = (x: ByteCountPerSec): number => {
-    return x as any as number;
-}
-export const byteCountPerSec = (n: number) => {
-    return n as any as ByteCountPerSec
-}
-export const exampleByteCountPerSec = byteCountPerSec(400)
-
 export interface PacketCount extends Number {
     __packetCount__: never
 }
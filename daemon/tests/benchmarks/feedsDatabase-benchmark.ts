@@ -0,0 +1,143 @@
+// Benchmark of appends/sec and reads/sec for the local feeds database
+//
+// Compares LocalFeedsDatabase (long-lived WAL connections, cached prepared statements,
+// grouped write transactions) against the previous approach of opening the database
+// for each operation behind a JS-level lock.
+//
+// Run with: npx ts-node tests/benchmarks/feedsDatabase-benchmark.ts
+
+import fs from 'fs';
+import os from 'os';
+import { Database, open } from 'sqlite';
+import sqlite3 from 'sqlite3';
+import { createKeyPair, JSONStringifyDeterministic, publicKeyHexToFeedId, publicKeyToHex } from '../../src/common/crypto_util';
+import { randomAlphaString } from '../../src/common/util';
+import LocalFeedsDatabase from '../../src/external/real/LocalFeedsDatabase';
+import { FeedId, isSignature, localFilePath, nowTimestamp, SignedSubfeedMessage, SubfeedHash, SubfeedMessage } from '../../src/interfaces/core';
+
+const NUM_SUBFEEDS = 10
+const NUM_APPENDS_PER_SUBFEED = 200
+const NUM_READS = 2000
+
+interface FeedsDatabaseLike {
+    appendSignedMessagesToSubfeed: (feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[]) => Promise<void>
+    getSignedSubfeedMessages: (feedId: FeedId, subfeedHash: SubfeedHash) => Promise<SignedSubfeedMessage[]>
+}
+
+class OpenPerOperationFeedsDatabase {
+    // the previous approach: acquire a lock, open the database, run the statements, close it again
+    #locked = false
+    #waiting: (() => void)[] = []
+    #initialized = false
+    constructor(private databasePath: string) {
+    }
+    async _withDatabase<T>(fn: (db: Database) => Promise<T>): Promise<T> {
+        if (this.#locked) {
+            await new Promise<void>((resolve) => {this.#waiting.push(resolve)})
+        }
+        this.#locked = true
+        const db = await open({filename: this.databasePath, driver: sqlite3.Database})
+        try {
+            if (!this.#initialized) {
+                await db.run(`CREATE TABLE IF NOT EXISTS subfeedMessages (feedId TEXT NOT NULL, subfeedHash TEXT NOT NULL, position INTEGER NOT NULL, message TEXT, PRIMARY KEY(feedId, subfeedHash, position)) WITHOUT ROWID`)
+                this.#initialized = true
+            }
+            return await fn(db)
+        }
+        finally {
+            await db.close()
+            this.#locked = false
+            const next = this.#waiting.shift()
+            if (next) next()
+        }
+    }
+    async appendSignedMessagesToSubfeed(feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[]) {
+        await this._withDatabase(async (db) => {
+            await db.run('BEGIN TRANSACTION')
+            for (let m of messages) {
+                await db.run(`INSERT INTO subfeedMessages (feedId, subfeedHash, position, message) VALUES ($feedId, $subfeedHash, $position, $message)`, {
+                    '$feedId': feedId.toString(),
+                    '$subfeedHash': subfeedHash.toString(),
+                    '$position': m.body.messageNumber,
+                    '$message': JSONStringifyDeterministic(m)
+                })
+            }
+            await db.run('COMMIT')
+        })
+    }
+    async getSignedSubfeedMessages(feedId: FeedId, subfeedHash: SubfeedHash): Promise<SignedSubfeedMessage[]> {
+        return await this._withDatabase(async (db) => {
+            const rows: {message: string}[] = await db.all(`SELECT message FROM subfeedMessages WHERE feedId = $feedId AND subfeedHash = $subfeedHash ORDER BY position ASC`, {
+                '$feedId': feedId.toString(),
+                '$subfeedHash': subfeedHash.toString()
+            })
+            return rows.map(r => JSON.parse(r.message))
+        })
+    }
+}
+
+const createMessage = (messageNumber: number): SignedSubfeedMessage => {
+    const signature = new Array(129).join('1')
+    if (!isSignature(signature)) throw Error('Not valid signature')
+    return {
+        body: {
+            previousSignature: signature,
+            messageNumber,
+            message: {example: messageNumber} as any as SubfeedMessage,
+            timestamp: nowTimestamp()
+        },
+        signature
+    }
+}
+
+const runBenchmark = async (label: string, db: FeedsDatabaseLike) => {
+    const {publicKey} = createKeyPair()
+    const feedId = publicKeyHexToFeedId(publicKeyToHex(publicKey))
+    const subfeedHashes: SubfeedHash[] = []
+    for (let i = 0; i < NUM_SUBFEEDS; i++) {
+        subfeedHashes.push(randomAlphaString(40).toLowerCase() as any as SubfeedHash)
+    }
+
+    // each subfeed appends one message at a time, while the subfeeds append concurrently
+    let timer = Date.now()
+    await Promise.all(subfeedHashes.map(async (subfeedHash) => {
+        for (let i = 0; i < NUM_APPENDS_PER_SUBFEED; i++) {
+            await db.appendSignedMessagesToSubfeed(feedId, subfeedHash, [createMessage(i)])
+        }
+    }))
+    const appendsPerSec = (NUM_SUBFEEDS * NUM_APPENDS_PER_SUBFEED) / ((Date.now() - timer) / 1000)
+
+    timer = Date.now()
+    const reads: Promise<SignedSubfeedMessage[]>[] = []
+    for (let i = 0; i < NUM_READS; i++) {
+        reads.push(db.getSignedSubfeedMessages(feedId, subfeedHashes[i % NUM_SUBFEEDS]))
+    }
+    const results = await Promise.all(reads)
+    results.forEach(r => {
+        if (r.length !== NUM_APPENDS_PER_SUBFEED) throw Error(`Unexpected number of messages: ${r.length}`)
+    })
+    const readsPerSec = NUM_READS / ((Date.now() - timer) / 1000)
+
+    console.info(`${label}: ${appendsPerSec.toFixed(0)} appends/sec, ${readsPerSec.toFixed(0)} reads/sec`)
+}
+
+const main = async () => {
+    const tempPath = `${os.tmpdir()}/kachery-p2p-benchmark-${randomAlphaString(10)}.tmp`
+    fs.mkdirSync(tempPath)
+    try {
+        await runBenchmark('Open per operation', new OpenPerOperationFeedsDatabase(tempPath + '/feeds-old.db'))
+        const db = new LocalFeedsDatabase(localFilePath(tempPath + '/feeds.db'))
+        await runBenchmark('LocalFeedsDatabase', db)
+        await db.close()
+    }
+    finally {
+        fs.rmdirSync(tempPath, {recursive: true})
+    }
+}
+
+if (require.main === module) {
+    main().catch((err: Error) => {
+        console.error(err)
+        process.exit(1)
+    })
+}
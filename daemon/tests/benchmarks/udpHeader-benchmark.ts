@@ -0,0 +1,103 @@
+// Benchmark of packets/sec for the udp message header formats
+//
+// Sends full-size message packets between two mock dgram sockets and parses the header
+// of each packet on receipt, comparing the padded JSON header with the binary header.
+// Signing and verification are the same for both formats and are left out.
+//
+// Run with: npx ts-node tests/benchmarks/udpHeader-benchmark.ts
+
+import { createKeyPair, getSignature, publicKeyToHex } from '../../src/common/crypto_util';
+import { DgramRemoteInfo } from '../../src/external/ExternalInterface';
+import mockDgramCreateSocket from '../../src/external/mock/mockDgramCreateSocket';
+import { NodeId, publicKeyHexToNodeId, tryParseJsonObject } from '../../src/interfaces/core';
+import { createUdpMessageId, isUdpHeader, numParts, partIndex, UdpHeader, udpMessageMetaData, UDP_MESSAGE_HEADER_SIZE, UDP_PACKET_SIZE } from '../../src/interfaces/UdpMessage';
+import { protocolVersion } from '../../src/protocolVersion';
+import { binaryUdpHeaderSize, decodeBinaryUdpHeader, encodeBinaryUdpHeader } from '../../src/udp/BinaryUdpHeader';
+
+const NUM_PACKETS = 20000
+const RECEIVER_PORT = 21001
+
+interface HeaderFormat {
+    headerSize: number
+    encode: (header: UdpHeader) => Buffer
+    decode: (packet: Buffer) => {header: UdpHeader, dataBuffer: Buffer} | null
+}
+
+const jsonHeaderFormat: HeaderFormat = {
+    headerSize: UDP_MESSAGE_HEADER_SIZE,
+    encode: (header: UdpHeader) => (Buffer.from(JSON.stringify(header).padEnd(UDP_MESSAGE_HEADER_SIZE, ' '))),
+    decode: (packet: Buffer) => {
+        const header = tryParseJsonObject(packet.slice(0, UDP_MESSAGE_HEADER_SIZE).toString().trimEnd())
+        if (!isUdpHeader(header)) return null
+        return {header, dataBuffer: packet.slice(UDP_MESSAGE_HEADER_SIZE)}
+    }
+}
+
+const createNodeId = (): NodeId => {
+    return publicKeyHexToNodeId(publicKeyToHex(createKeyPair().publicKey))
+}
+
+const runBenchmark = async (label: string, createFormat: (header: UdpHeader) => HeaderFormat) => {
+    const keyPair = createKeyPair()
+    const fromNodeId = publicKeyHexToNodeId(publicKeyToHex(keyPair.publicKey))
+    const toNodeId = createNodeId()
+    const metaData = udpMessageMetaData({streamId: 'abcdefghij', dataChunkIndex: 0})
+    const body = {
+        udpMessageId: createUdpMessageId(),
+        protocolVersion: protocolVersion(),
+        fromNodeId,
+        toAddress: null,
+        udpMessageType: "streamDataChunk" as "streamDataChunk",
+        metaData,
+        partIndex: partIndex(0),
+        numParts: numParts(NUM_PACKETS),
+        payloadIsJson: false
+    }
+    // one signature for all of the packets, since it is not verified here
+    const signature = getSignature(body, keyPair)
+    const format = createFormat({body, signature})
+    const dataBuffer = Buffer.alloc(UDP_PACKET_SIZE - format.headerSize)
+
+    const sender = mockDgramCreateSocket({type: 'udp4', reuseAddr: false, nodeId: fromNodeId, firewalled: false})
+    const receiver = mockDgramCreateSocket({type: 'udp4', reuseAddr: false, nodeId: toNodeId, firewalled: false})
+    sender.bind(RECEIVER_PORT + 1)
+    receiver.bind(RECEIVER_PORT)
+    let numReceived = 0
+    let numPayloadBytesReceived = 0
+    receiver.on('message', (message: Buffer, remoteInfo: DgramRemoteInfo) => {
+        const x = format.decode(message)
+        if (x === null) throw Error('Unable to decode udp header')
+        numReceived ++
+        numPayloadBytesReceived += x.dataBuffer.length
+    })
+
+    const timer = Date.now()
+    for (let i = 0; i < NUM_PACKETS; i++) {
+        const header: UdpHeader = {body: {...body, partIndex: partIndex(i)}, signature}
+        const packet = Buffer.concat([format.encode(header), dataBuffer])
+        sender.send(packet, 0, packet.length, RECEIVER_PORT, toNodeId.toString())
+    }
+    const elapsedSec = (Date.now() - timer) / 1000
+    sender.close()
+    receiver.close()
+    if (numReceived !== NUM_PACKETS) throw Error(`Unexpected number of packets received: ${numReceived}`)
+
+    const overhead = format.headerSize / UDP_PACKET_SIZE
+    console.info(`${label}: ${(NUM_PACKETS / elapsedSec).toFixed(0)} packets/sec, ${(numPayloadBytesReceived / elapsedSec / 1e6).toFixed(1)} MB/sec payload, header overhead ${(overhead * 100).toFixed(2)}%`)
+}
+
+const main = async () => {
+    await runBenchmark('JSON header', () => (jsonHeaderFormat))
+    await runBenchmark('Binary header', (header: UdpHeader) => ({
+        headerSize: binaryUdpHeaderSize(header.body.toAddress, header.body.metaData),
+        encode: encodeBinaryUdpHeader,
+        decode: decodeBinaryUdpHeader
+    }))
+}
+
+if (require.main === module) {
+    main().catch((err: Error) => {
+        console.error(err)
+        process.exit(1)
+    })
+}
@@ -0,0 +1,60 @@
+import { expect } from 'chai';
+import * as mocha from 'mocha'; // import types for mocha e.g. describe
+import { sleepMsec } from '../../src/common/util';
+import AimdConcurrencyController from '../../src/downloadOptimizer/AimdConcurrencyController';
+import { byteCount, scaledDurationMsec } from '../../src/interfaces/core';
+
+const waitForNextInterval = async () => {
+    await sleepMsec(scaledDurationMsec(11000))
+}
+
+// need to explicitly use mocha prefix once or the dependency gets wrongly cleaned up
+mocha.describe('AIMD concurrency controller', () => {
+    it('increases the limit when saturated', async () => {
+        const c = new AimdConcurrencyController({initialLimit: 4, minLimit: 1, maxLimit: 10})
+        const tasks = [0, 1, 2, 3].map(() => c.startTask())
+        tasks.forEach(t => {t.reportBytesLoaded(byteCount(1000))})
+        await waitForNextInterval()
+        expect(c.limit()).equals(5)
+        tasks.forEach(t => {t.finish({error: false})})
+        expect(c.getStats().numActive).equals(0)
+        expect(c.getStats().numSucceeded).equals(4)
+    })
+    it('decreases the limit multiplicatively on errors', async () => {
+        const c = new AimdConcurrencyController({initialLimit: 8, minLimit: 1, maxLimit: 10})
+        let numLimitChanges = 0
+        c.onLimitChanged(() => {numLimitChanges ++})
+        const tasks = [0, 1, 2, 3, 4, 5, 6, 7].map(() => c.startTask())
+        tasks.slice(0, 4).forEach(t => {t.finish({error: true})})
+        await waitForNextInterval()
+        expect(c.limit()).equals(4)
+        expect(numLimitChanges).equals(1)
+        tasks.slice(4).forEach(t => {t.finish({error: false})})
+        expect(c.getStats().numFailed).equals(4)
+    })
+    it('applies the limit to the tasks of all callers', async () => {
+        const c = new AimdConcurrencyController({initialLimit: 2, minLimit: 1, maxLimit: 10})
+        // e.g., the chunk downloads of two files
+        const tasks = [c.startTask(), c.startTask()]
+        let started = false
+        const p = c.startTaskWhenAvailable().then((t) => {
+            started = true
+            return t
+        })
+        await sleepMsec(scaledDurationMsec(100))
+        expect(started).is.false
+        tasks[0].finish({error: false})
+        const t2 = await p
+        expect(started).is.true
+        expect(c.numActive()).equals(2)
+        tasks[1].finish({error: false})
+        t2.finish({error: false})
+        expect(c.numActive()).equals(0)
+    })
+    it('does not go below the minimum', async () => {
+        const c = new AimdConcurrencyController({initialLimit: 1, minLimit: 1, maxLimit: 10})
+        c.startTask().finish({error: true})
+        await waitForNextInterval()
+        expect(c.limit()).equals(1)
+    })
+})
@@ -0,0 +1,115 @@
+import { expect } from 'chai';
+import * as mocha from 'mocha'; // import types for mocha e.g. describe
+import DataStreamy from '../../src/common/DataStreamy';
+import { FileWriterOpts } from '../../src/downloadOptimizer/createDownloader';
+import { Downloader } from '../../src/downloadOptimizer/DownloadOptimizer';
+import DownloadOptimizerJob from '../../src/downloadOptimizer/DownloadOptimizerJob';
+import DownloadOptimizerProviderNode from '../../src/downloadOptimizer/DownloadOptimizerProviderNode';
+import { KacheryStorageFileWriter } from '../../src/external/ExternalInterface';
+import { byteCount, FileKey, NodeId, Sha1Hash } from '../../src/interfaces/core';
+
+interface WriterLog {
+    numCreated: number
+    data: Buffer[]
+    ended: boolean
+    cancelled: boolean
+}
+
+const createWriterLog = (): WriterLog => ({numCreated: 0, data: [], ended: false, cancelled: false})
+
+const createFakeWriter = (log: WriterLog, opts: {failEnd: boolean}) => (): KacheryStorageFileWriter => {
+    log.numCreated ++
+    return {
+        write: (buf: Buffer) => {
+            log.data.push(buf)
+            return true
+        },
+        drained: async () => {
+        },
+        end: async () => {
+            // e.g., the chunk writer of a file assembler that was cancelled
+            if (opts.failEnd) throw Error('Writer is no longer usable')
+            log.ended = true
+        },
+        cancel: () => {
+            log.cancelled = true
+        }
+    }
+}
+
+const runJob = async (job: DownloadOptimizerJob) => {
+    await new Promise<void>((resolve, reject) => {
+        job.getProgressStream().onFinished(() => {resolve()})
+        job.getProgressStream().onError((err: Error) => {reject(err)})
+        job.start()
+    })
+}
+
+const createJob = (o: {onWriterOpts: (writerOpts: FileWriterOpts) => void, beforeEnd: () => void}) => {
+    const fileKey: FileKey = {sha1: '0123456789012345678901234567890123456789' as any as Sha1Hash}
+    const providerNode = new DownloadOptimizerProviderNode('node0' as any as NodeId)
+    const createDownloader = (pn: DownloadOptimizerProviderNode, fileSize: any, label: string, writerOpts: FileWriterOpts): Downloader => {
+        o.onWriterOpts(writerOpts)
+        const ds = new DataStreamy()
+        return {
+            start: async () => {
+                const writers = writerOpts.createWriters.map(createWriter => (createWriter()))
+                setTimeout(() => {
+                    ds.producer().start(byteCount(3))
+                    writers.forEach(w => {w.write(Buffer.from('abc'))})
+                    o.beforeEnd()
+                    Promise.all(writers.map(w => (w.end()))).then(() => {
+                        ds.producer().end()
+                    }).catch((err: Error) => {
+                        ds.producer().error(err)
+                    })
+                }, 2)
+                return ds
+            },
+            stop: () => {
+                ds.cancel()
+            }
+        }
+    }
+    const findProviders = (onFound: (providerNode: DownloadOptimizerProviderNode) => void, onFinished: () => void) => {
+        onFound(providerNode)
+        onFinished()
+    }
+    return new DownloadOptimizerJob(fileKey, byteCount(3), 'test', findProviders, createDownloader, {numRetries: 0})
+}
+
+// need to explicitly use mocha prefix once or the dependency gets wrongly cleaned up
+mocha.describe('Download optimizer job', () => {
+    it('does not use the writers of removed tasks', async () => {
+        const logA = createWriterLog()
+        const logB = createWriterLog()
+        let storeFile: boolean | null = null
+        const job = createJob({
+            onWriterOpts: (writerOpts: FileWriterOpts) => {storeFile = writerOpts.storeFile},
+            beforeEnd: () => {}
+        })
+        job.addFileWriter('taskA', {storeFile: true, createWriter: createFakeWriter(logA, {failEnd: true})})
+        job.addFileWriter('taskB', {storeFile: false, createWriter: createFakeWriter(logB, {failEnd: false})})
+        job.removeFileWriter('taskA')
+        await runJob(job)
+        // storing the file was only requested by the removed task
+        expect(storeFile).is.false
+        expect(logA.numCreated).equals(0)
+        expect(logB.ended).is.true
+        expect(Buffer.concat(logB.data).toString()).equals('abc')
+    })
+    it('drops the writer of a task removed during a download', async () => {
+        const logA = createWriterLog()
+        const logB = createWriterLog()
+        const job = createJob({
+            onWriterOpts: () => {},
+            beforeEnd: () => {job.removeFileWriter('taskA')}
+        })
+        job.addFileWriter('taskA', {storeFile: false, createWriter: createFakeWriter(logA, {failEnd: true})})
+        job.addFileWriter('taskB', {storeFile: false, createWriter: createFakeWriter(logB, {failEnd: false})})
+        await runJob(job)
+        expect(logA.numCreated).equals(1)
+        expect(logA.cancelled).is.true
+        expect(logB.ended).is.true
+    })
+})
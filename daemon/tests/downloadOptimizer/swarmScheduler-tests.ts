@@ -0,0 +1,143 @@
+import { expect } from 'chai';
+import * as mocha from 'mocha'; // import types for mocha e.g. describe
+import DataStreamy from '../../src/common/DataStreamy';
+import AimdConcurrencyController from '../../src/downloadOptimizer/AimdConcurrencyController';
+import { Downloader } from '../../src/downloadOptimizer/DownloadOptimizer';
+import DownloadOptimizerProviderNode from '../../src/downloadOptimizer/DownloadOptimizerProviderNode';
+import SwarmScheduler from '../../src/downloadOptimizer/SwarmScheduler';
+import { byteCount, NodeId } from '../../src/interfaces/core';
+
+type ProviderBehavior = 'fast' | 'stalled' | 'failing'
+
+const NUM_CHUNKS = 12
+const CHUNK_SIZE = 1000
+
+const createFakeDownloader = (providerNode: DownloadOptimizerProviderNode, behavior: ProviderBehavior): Downloader => {
+    const ds = new DataStreamy()
+    let timer: NodeJS.Timeout | null = null
+    return {
+        start: async () => {
+            providerNode.reportStart()
+            ds.onError(() => {providerNode.reportStop()})
+            ds.onFinished(() => {providerNode.reportStop()})
+            ds.producer().start(byteCount(CHUNK_SIZE))
+            if (behavior === 'fast') {
+                timer = setTimeout(() => {
+                    providerNode.reportBytes(byteCount(CHUNK_SIZE))
+                    ds.producer().data(Buffer.alloc(CHUNK_SIZE))
+                    ds.producer().end()
+                }, 2)
+            }
+            else if (behavior === 'failing') {
+                timer = setTimeout(() => {
+                    ds.producer().error(Error('failing provider'))
+                }, 2)
+            }
+            return ds
+        },
+        stop: () => {
+            if (timer) clearTimeout(timer)
+            ds.cancel()
+        }
+    }
+}
+
+const runSwarm = async (behaviors: ProviderBehavior[]) => {
+    const providerNodes = behaviors.map((b, i) => (new DownloadOptimizerProviderNode(`node${i}` as any as NodeId)))
+    const behaviorByNodeId = new Map<NodeId, ProviderBehavior>()
+    providerNodes.forEach((pn, i) => {behaviorByNodeId.set(pn.nodeId(), behaviors[i])})
+    const numCompletedByNodeId = new Map<NodeId, number>()
+    const downloadedChunks = new Set<number>()
+    const chunks = []
+    for (let i = 0; i < NUM_CHUNKS; i++) chunks.push({size: byteCount(CHUNK_SIZE)})
+    const scheduler = new SwarmScheduler(chunks, (chunkIndex: number, providerNode: DownloadOptimizerProviderNode) => {
+        const d = createFakeDownloader(providerNode, behaviorByNodeId.get(providerNode.nodeId()) as ProviderBehavior)
+        return {
+            start: async () => {
+                const ds = await d.start()
+                ds.onFinished(() => {
+                    downloadedChunks.add(chunkIndex)
+                    numCompletedByNodeId.set(providerNode.nodeId(), (numCompletedByNodeId.get(providerNode.nodeId()) || 0) + 1)
+                })
+                return ds
+            },
+            stop: d.stop
+        }
+    }, async (chunkIndex: number) => {
+        if (!downloadedChunks.has(chunkIndex)) throw Error(`Chunk was not downloaded: ${chunkIndex}`)
+    })
+    providerNodes.forEach(pn => {scheduler.addProviderNode(pn)})
+    scheduler.setFindFinished()
+    await scheduler.run()
+    expect(downloadedChunks.size).equals(NUM_CHUNKS)
+    return {numCompletedByNodeId, providerNodes}
+}
+
+// need to explicitly use mocha prefix once or the dependency gets wrongly cleaned up
+mocha.describe('Swarm scheduler', () => {
+    it('downloads chunks from all providers', async () => {
+        const {numCompletedByNodeId, providerNodes} = await runSwarm(['fast', 'fast', 'fast'])
+        providerNodes.forEach(pn => {
+            expect(numCompletedByNodeId.get(pn.nodeId()) || 0).greaterThan(0)
+            expect(pn.numActiveDownloads()).equals(0)
+        })
+    })
+    it('re-issues the chunks of a stalled provider', async () => {
+        const {numCompletedByNodeId, providerNodes} = await runSwarm(['stalled', 'fast'])
+        expect(numCompletedByNodeId.get(providerNodes[0].nodeId()) || 0).equals(0)
+        expect(numCompletedByNodeId.get(providerNodes[1].nodeId()) || 0).equals(NUM_CHUNKS)
+    })
+    it('drops a failing provider', async () => {
+        const {numCompletedByNodeId, providerNodes} = await runSwarm(['failing', 'fast'])
+        expect(numCompletedByNodeId.get(providerNodes[1].nodeId()) || 0).equals(NUM_CHUNKS)
+    })
+    it('limits the chunk downloads of all files together', async () => {
+        const concurrency = new AimdConcurrencyController({initialLimit: 2, minLimit: 1, maxLimit: 2})
+        let numActive = 0
+        let maxNumActive = 0
+        const runFile = async (label: string) => {
+            const providerNodes = [0, 1, 2].map(i => (new DownloadOptimizerProviderNode(`${label}-node${i}` as any as NodeId)))
+            const downloadedChunks = new Set<number>()
+            const chunks = []
+            for (let i = 0; i < NUM_CHUNKS; i++) chunks.push({size: byteCount(CHUNK_SIZE)})
+            const scheduler = new SwarmScheduler(chunks, (chunkIndex: number, providerNode: DownloadOptimizerProviderNode) => {
+                const d = createFakeDownloader(providerNode, 'fast')
+                return {
+                    start: async () => {
+                        numActive ++
+                        maxNumActive = Math.max(maxNumActive, numActive)
+                        const ds = await d.start()
+                        ds.onFinished(() => {
+                            numActive --
+                            downloadedChunks.add(chunkIndex)
+                        })
+                        ds.onError(() => {numActive --})
+                        return ds
+                    },
+                    stop: d.stop
+                }
+            }, async (chunkIndex: number) => {
+                if (!downloadedChunks.has(chunkIndex)) throw Error(`Chunk was not downloaded: ${chunkIndex}`)
+            }, concurrency)
+            providerNodes.forEach(pn => {scheduler.addProviderNode(pn)})
+            scheduler.setFindFinished()
+            await scheduler.run()
+            expect(downloadedChunks.size).equals(NUM_CHUNKS)
+        }
+        await Promise.all([runFile('a'), runFile('b')])
+        expect(maxNumActive).lessThan(3)
+        expect(concurrency.numActive()).equals(0)
+    })
+    it('fails when there are no providers', async () => {
+        const scheduler = new SwarmScheduler([{size: byteCount(CHUNK_SIZE)}], () => {throw Error('Unexpected')}, async () => {})
+        scheduler.setFindFinished()
+        let failed = false
+        try {
+            await scheduler.run()
+        }
+        catch(err) {
+            failed = true
+        }
+        expect(failed).is.true
+    })
+})
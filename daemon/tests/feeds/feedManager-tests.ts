@@ -0,0 +1,112 @@
+import { expect } from 'chai';
+import * as mocha from 'mocha'; // import types for mocha e.g. describe
+import MockLocalFeedManager from '../../src/external/mock/MockLocalFeedManager';
+import FeedManager from '../../src/feeds/FeedManager';
+import { FeedId, SignedSubfeedMessage, SubfeedHash, SubfeedMessage } from '../../src/interfaces/core';
+import KacheryP2PNode from '../../src/KacheryP2PNode';
+
+class TestLocalFeedManager extends MockLocalFeedManager {
+    // records the size of each write, can hold a write until released,
+    // and rejects the writes that include a message marked invalid
+    appendSizes: number[] = []
+    #hold: Promise<void> | null = null
+    #releaseHold: (() => void) | null = null
+    hold() {
+        this.#hold = new Promise<void>((resolve) => {
+            this.#releaseHold = resolve
+        })
+    }
+    release() {
+        if (this.#releaseHold) this.#releaseHold()
+        this.#hold = null
+        this.#releaseHold = null
+    }
+    async appendSignedMessagesToSubfeed(feedId: FeedId, subfeedHash: SubfeedHash, messages: SignedSubfeedMessage[], opts: {verified: boolean} = {verified: false}) {
+        this.appendSizes.push(messages.length)
+        if (this.#hold) await this.#hold
+        if (messages.filter(m => ((m.body.message as any).invalid)).length > 0) {
+            throw Error('Invalid message')
+        }
+        await super.appendSignedMessagesToSubfeed(feedId, subfeedHash, messages, opts)
+    }
+}
+
+const subfeedHash = '0123456789012345678901234567890123456789' as any as SubfeedHash
+
+const testMessages = (label: string, n: number): SubfeedMessage[] => {
+    return [...Array(n).keys()].map(i => ({label, i} as any as SubfeedMessage))
+}
+
+const createFeedManager = async () => {
+    const localFeedManager = new TestLocalFeedManager()
+    // only the local feeds are used, so the node is not needed
+    const feedManager = new FeedManager(null as any as KacheryP2PNode, localFeedManager)
+    const feedId = await feedManager.createFeed({feedName: null})
+    return {localFeedManager, feedManager, feedId}
+}
+
+const waitMsec = async (msec: number) => {
+    await new Promise<void>((resolve) => {setTimeout(resolve, msec)})
+}
+
+// need to explicitly use mocha prefix once or the dependency gets wrongly cleaned up
+mocha.describe('Feed manager', () => {
+    describe('appending messages', () => {
+        it('combines concurrent appends into one batch and keeps the order', async () => {
+            const {localFeedManager, feedManager, feedId} = await createFeedManager()
+            // an append in progress, while the others are requested
+            localFeedManager.hold()
+            const first = feedManager.appendMessages({feedId, subfeedHash, messages: testMessages('first', 1)})
+            await waitMsec(10)
+            const others = [
+                feedManager.appendMessages({feedId, subfeedHash, messages: testMessages('a', 2)}),
+                feedManager.appendMessages({feedId, subfeedHash, messages: testMessages('b', 1)}),
+                feedManager.appendMessages({feedId, subfeedHash, messages: testMessages('c', 3)})
+            ]
+            await waitMsec(10)
+            localFeedManager.release()
+            await first
+            await Promise.all(others)
+            expect(localFeedManager.appendSizes).deep.equals([1, 6])
+            const messages = await localFeedManager.getSignedSubfeedMessages(feedId, subfeedHash)
+            expect(messages.map(m => (m.body.messageNumber))).deep.equals([0, 1, 2, 3, 4, 5, 6])
+            expect(messages.map(m => ((m.body.message as any).label))).deep.equals(['first', 'a', 'a', 'b', 'c', 'c', 'c'])
+            expect(messages.map(m => ((m.body.message as any).i))).deep.equals([0, 0, 1, 0, 0, 1, 2])
+        })
+        it('fails only the request with an invalid message', async () => {
+            const {localFeedManager, feedManager, feedId} = await createFeedManager()
+            localFeedManager.hold()
+            const first = feedManager.appendMessages({feedId, subfeedHash, messages: testMessages('first', 1)})
+            await waitMsec(10)
+            const results: string[] = []
+            const append = async (label: string, messages: SubfeedMessage[]) => {
+                try {
+                    await feedManager.appendMessages({feedId, subfeedHash, messages})
+                    results.push(`${label}: ok`)
+                }
+                catch(err) {
+                    results.push(`${label}: ${err.message}`)
+                }
+            }
+            const others = [
+                append('a', testMessages('a', 2)),
+                append('b', [...testMessages('b', 1), {invalid: true} as any as SubfeedMessage]),
+                append('c', testMessages('c', 1))
+            ]
+            await waitMsec(10)
+            localFeedManager.release()
+            await first
+            await Promise.all(others)
+            expect(results.sort()).deep.equals(['a: ok', 'b: Invalid message', 'c: ok'])
+            // the combined batch failed, then each request was retried on its own
+            expect(localFeedManager.appendSizes).deep.equals([1, 5, 2, 2, 1])
+            const messages = await localFeedManager.getSignedSubfeedMessages(feedId, subfeedHash)
+            expect(messages.map(m => (m.body.messageNumber))).deep.equals([0, 1, 2, 3])
+            expect(messages.map(m => ((m.body.message as any).label))).deep.equals(['first', 'a', 'a', 'c'])
+            // the signature chain continues across the failed request
+            for (let i = 1; i < messages.length; i++) {
+                expect(messages[i].body.previousSignature).equals(messages[i - 1].signature)
+            }
+        })
+    })
+})
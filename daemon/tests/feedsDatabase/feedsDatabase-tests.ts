@@ -2,10 +2,12 @@ import { expect } from 'chai';
 import fs from 'fs';
 import * as mocha from 'mocha'; // import types for mocha e.g. describe
 import os from 'os';
-import { createKeyPair, publicKeyHexToFeedId, publicKeyToHex } from '../../src/common/crypto_util';
+import { createKeyPair, getSignatureJson, publicKeyHexToFeedId, publicKeyToHex } from '../../src/common/crypto_util';
 import { randomAlphaString } from '../../src/common/util';
+import { LocalFeedManagerInterface } from '../../src/external/ExternalInterface';
 import LocalFeedsDatabase from '../../src/external/real/LocalFeedsDatabase';
-import { isSignature, localFilePath, nowTimestamp, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, SubfeedMessage } from '../../src/interfaces/core';
+import LocalSubfeedSignedMessagesManager from '../../src/feeds/LocalSubfeedSignedMessagesManager';
+import { isSignature, JSONObject, localFilePath, messageCountToNumber, nowTimestamp, publicKeyHexToNodeId, Signature, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, SubfeedMessage } from '../../src/interfaces/core';
 
 const testContext = (testFunction: (localFeedsDatabase: LocalFeedsDatabase, resolve: () => void, reject: (err: Error) => void) => Promise<void>, done: (err?: Error) => void) => {
     const tempPath = `${os.tmpdir()}/kachery-p2p-test-${randomAlphaString(10)}.tmp`
@@ -77,6 +79,21 @@ mocha.describe('Feeds database', () => {
                 const x = await db.getSignedSubfeedMessages(feedId, subfeedHash)
                 expect(x.length).equals(2)
 
+                const numMessages = await db.getNumSignedSubfeedMessages(feedId, subfeedHash)
+                expect(messageCountToNumber(numMessages)).equals(2)
+                const y = await db.getSignedSubfeedMessagesRange(feedId, subfeedHash, 1, 2)
+                expect(y.length).equals(1)
+                expect(y[0].body.messageNumber).equals(1)
+
+                expect(await db.getSubfeedVerificationCheckpoint(feedId, subfeedHash)).to.be.null
+                await db.setSubfeedVerificationCheckpoint(feedId, subfeedHash, numMessages, msg2.signature)
+                const checkpoint = await db.getSubfeedVerificationCheckpoint(feedId, subfeedHash)
+                if (!checkpoint) {
+                    throw Error('Did not get verification checkpoint')
+                }
+                expect(messageCountToNumber(checkpoint.numVerifiedMessages)).equals(2)
+                expect(checkpoint.lastSignature).equals(msg2.signature)
+
                 const accessRules: SubfeedAccessRules = {rules: []}
                 await db.setSubfeedAccessRules(feedId, subfeedHash, accessRules)
 
@@ -93,7 +110,96 @@ mocha.describe('Feeds database', () => {
                 expect(ar2).to.be.null
                 const x2 = await db.getSignedSubfeedMessages(feedId, subfeedHash)
                 expect(x2.length).equals(0)
+                expect(await db.getSubfeedVerificationCheckpoint(feedId, subfeedHash)).to.be.null
+
+                await db.close()
+                resolve()
+            }, done)
+        })
+    })
+    describe('appending messages', () => {
+        it('reads back appended messages on the pooled readers', (done) => {
+            testContext(async (db, resolve, reject) => {
+                const keyPair = createKeyPair()
+                const feedId = publicKeyHexToFeedId(publicKeyToHex(keyPair.publicKey))
+                const subfeedHash = '0123456789012345678901234567890123456789' as any as SubfeedHash
+                await db.addFeed(feedId)
+                // the database provides the parts of the local feed manager that are used for the messages
+                const localFeedManager = db as any as LocalFeedManagerInterface
+                const writer = new LocalSubfeedSignedMessagesManager(localFeedManager, feedId, subfeedHash, keyPair.publicKey)
+                writer.initializeEmptyMessageList()
+                let previousSignature: Signature | undefined = undefined
+                // more appends than there are readers, so that every reader is used after it has seen an earlier state
+                for (let i = 0; i < 10; i++) {
+                    const body = {
+                        message: {i} as any as SubfeedMessage,
+                        previousSignature,
+                        messageNumber: i,
+                        timestamp: nowTimestamp()
+                    }
+                    const signature = getSignatureJson(body as any as JSONObject, keyPair)
+                    await writer.appendSignedMessages([{body, signature}])
+                    previousSignature = signature
+
+                    const checkpoint = await db.getSubfeedVerificationCheckpoint(feedId, subfeedHash)
+                    if (!checkpoint) {
+                        throw Error('Did not get verification checkpoint')
+                    }
+                    expect(messageCountToNumber(checkpoint.numVerifiedMessages)).equals(i + 1)
+                    expect(checkpoint.lastSignature).equals(signature)
+
+                    const reader = new LocalSubfeedSignedMessagesManager(localFeedManager, feedId, subfeedHash, keyPair.publicKey)
+                    await reader.initializeFromLocal()
+                    expect(messageCountToNumber(reader.getNumMessages())).equals(i + 1)
+                    expect(reader.getLastSignature()).equals(signature)
+                    const messages = await reader.getSignedMessages(0, i + 1)
+                    expect(messages.map(m => (m.body.messageNumber))).deep.equals([...Array(i + 1).keys()])
+                }
+
+                await db.close()
+                resolve()
+            }, done)
+        })
+    })
+    describe('access rules', () => {
+        it('keeps the messages and checkpoint of a subfeed when its access rules are set', (done) => {
+            testContext(async (db, resolve, reject) => {
+                const {publicKey} = createKeyPair()
+                const feedId = publicKeyHexToFeedId(publicKeyToHex(publicKey))
+                const subfeedHash = '0123456789012345678901234567890123456789' as any as SubfeedHash
+                const validSignature = new Array(129).join('1')
+                if (!isSignature(validSignature)) {
+                    throw Error('Not valid signature')
+                }
+                const messages: SignedSubfeedMessage[] = [0, 1].map(i => ({
+                    body: {
+                        previousSignature: validSignature,
+                        messageNumber: i,
+                        message: {example: i} as any as SubfeedMessage,
+                        timestamp: nowTimestamp()
+                    },
+                    signature: validSignature
+                }))
+                await db.appendSignedMessagesToSubfeed(feedId, subfeedHash, messages, {verified: true})
+
+                // the subfeed row exists, so it is updated (twice, to also update existing access rules)
+                await db.setSubfeedAccessRules(feedId, subfeedHash, {rules: []})
+                await db.setSubfeedAccessRules(feedId, subfeedHash, {rules: [{nodeId: publicKeyHexToNodeId(publicKeyToHex(publicKey)), write: true}]})
+
+                const ar = await db.getSubfeedAccessRules(feedId, subfeedHash)
+                if (!ar) {
+                    throw Error('Did not get access rules')
+                }
+                expect(ar.rules.length).equals(1)
+                const x = await db.getSignedSubfeedMessages(feedId, subfeedHash)
+                expect(x.map(m => (m.body.messageNumber))).deep.equals([0, 1])
+                const checkpoint = await db.getSubfeedVerificationCheckpoint(feedId, subfeedHash)
+                if (!checkpoint) {
+                    throw Error('Did not get verification checkpoint')
+                }
+                expect(messageCountToNumber(checkpoint.numVerifiedMessages)).equals(2)
 
+                await db.close()
                 resolve()
             }, done)
         })
@@ -1,10 +1,13 @@
 import { expect } from 'chai';
+import fs from 'fs';
+import http from 'http';
 import * as mocha from 'mocha'; // import types for mocha e.g. describe
+import os from 'os';
 import GarbageMap from '../../src/common/GarbageMap';
 import { randomAlphaString, sleepMsec } from '../../src/common/util';
 import MockNodeDaemon, { MockNodeDaemonGroup, MockNodeDefects } from '../../src/external/mock/MockNodeDaemon';
-import { byteCount, ByteCount, byteCountToNumber, ChannelName, DurationMsec, durationMsecToNumber, FeedId, FeedName, HostName, JSONObject, MessageCount, messageCount, NodeId, scaledDurationMsec, SubfeedAccessRules, SubfeedHash, SubfeedMessage, SubfeedPosition, subfeedPosition, SubfeedWatches, SubmittedSubfeedMessage, toPort } from '../../src/interfaces/core';
-import { ApiLoadFileRequest, FeedApiAppendMessagesRequest, FeedApiCreateFeedRequest, FeedApiDeleteFeedRequest, FeedApiGetAccessRulesRequest, FeedApiGetFeedIdRequest, FeedApiGetFeedInfoRequest, FeedApiGetMessagesRequest, FeedApiGetNumMessagesRequest, FeedApiGetSignedMessagesRequest, FeedApiSetAccessRulesRequest, FeedApiSubmitMessageRequest, FeedApiWatchForNewMessagesRequest, isFeedApiAppendMessagesResponse, isFeedApiCreateFeedResponse, isFeedApiDeleteFeedResponse, isFeedApiGetAccessRulesResponse, isFeedApiGetFeedIdResponse, isFeedApiGetFeedInfoResponse, isFeedApiGetMessagesResponse, isFeedApiGetSignedMessagesResponse, isFeedApiSetAccessRulesResponse, isFeedApiSubmitMessageResponse, isFeedApiWatchForNewMessagesResponse } from '../../src/services/DaemonApiServer';
+import { byteCount, ByteCount, byteCountToNumber, ChannelName, DurationMsec, durationMsecToNumber, FeedId, FeedName, HostName, JSONObject, localFilePath, MessageCount, messageCount, NodeId, scaledDurationMsec, SubfeedAccessRules, SubfeedHash, SubfeedMessage, SubfeedPosition, subfeedPosition, SubfeedWatches, SubmittedSubfeedMessage, toPort } from '../../src/interfaces/core';
+import { ApiLoadFileRequest, FeedApiAppendMessagesRequest, FeedApiCreateFeedRequest, FeedApiDeleteFeedRequest, FeedApiGetAccessRulesRequest, FeedApiGetFeedIdRequest, FeedApiGetFeedInfoRequest, FeedApiGetMessagesRequest, FeedApiGetNumMessagesRequest, FeedApiGetSignedMessagesRequest, FeedApiSetAccessRulesRequest, FeedApiSubmitMessageRequest, FeedApiSubmitMessagesRequest, FeedApiWatchForNewMessagesRequest, isFeedApiAppendMessagesResponse, isFeedApiCreateFeedResponse, isFeedApiDeleteFeedResponse, isFeedApiGetAccessRulesResponse, isFeedApiGetFeedIdResponse, isFeedApiGetFeedInfoResponse, isFeedApiGetMessagesResponse, isFeedApiGetSignedMessagesResponse, isFeedApiSetAccessRulesResponse, isFeedApiSubmitMessageResponse, isFeedApiSubmitMessagesResponse, isFeedApiWatchForNewMessagesResponse } from '../../src/services/DaemonApiServer';
 import { StartDaemonOpts } from '../../src/startDaemon';
 
 const mockChannelName = 'mock-channel' as any as ChannelName
@@ -376,12 +379,87 @@ const testContext = (testFunction: (g: MockNodeDaemonGroup, resolve: () => void,
                     }
                 }                
 
+                resolve()
+            }, done)
+        })
+    })
+    describe('Test daemon api on unix socket', () => {
+        it('Probe the daemon over a unix socket, and fail to listen on an invalid socket path', (done) => {
+            testContext(async (g, resolve, reject) => {
+                const daemonOpts: StartDaemonOpts = {
+                    bootstrapAddresses: [],
+                    isBootstrap: false,
+                    isMessageProxy: false,
+                    isDataProxy: false,
+                    channelNames: [],
+                    trustedNodesInChannels: new GarbageMap<ChannelName, NodeId[]>(null),
+                    multicastUdpAddress: null,
+                    udpSocketPort: null,
+                    webSocketListenPort: null,
+                    firewalled: true,
+                    services: {}
+                }
+                const daemon1 = await g.createDaemon({...daemonOpts})
+                const server = daemon1.mockDaemonApiServer()
+
+                const tempDir = fs.mkdtempSync(`${os.tmpdir()}/kachery-p2p-test-socket-`)
+                const socketPath = `${tempDir}/daemon.sock`
+                try {
+                    // a left over socket file is replaced
+                    fs.writeFileSync(socketPath, '')
+                    await server.listenUnixSocket(localFilePath(socketPath))
+                    const probeResponse = await httpGetJsonOnUnixSocket(socketPath, '/probe')
+                    expect(probeResponse.success).is.true
+                    expect(probeResponse.nodeId).equals(daemon1.nodeId())
+
+                    // the error is reported to the caller, which can continue with tcp only
+                    let rejected = false
+                    try {
+                        await server.listenUnixSocket(localFilePath(`${tempDir}/nonexistent/daemon.sock`))
+                    }
+                    catch(err) {
+                        rejected = true
+                    }
+                    expect(rejected).is.true
+                }
+                finally {
+                    server.stop()
+                    await sleepMsec(scaledDurationMsec(100))
+                    fs.rmdirSync(tempDir, {recursive: true})
+                }
+
                 resolve()
             }, done)
         })
     })
  })
 
+const httpGetJsonOnUnixSocket = async (socketPath: string, path: string): Promise<JSONObject> => {
+    return await new Promise<JSONObject>((resolve, reject) => {
+        const req = http.request({socketPath, path, method: 'GET'}, (res) => {
+            const chunks: Buffer[] = []
+            res.on('data', (chunk: Buffer) => {
+                chunks.push(chunk)
+            })
+            res.on('end', () => {
+                try {
+                    resolve(JSON.parse(Buffer.concat(chunks).toString('utf-8')))
+                }
+                catch(err) {
+                    reject(err)
+                }
+            })
+            res.on('error', (err: Error) => {
+                reject(err)
+            })
+        })
+        req.on('error', (err: Error) => {
+            reject(err)
+        })
+        req.end()
+    })
+}
+
 const testFindFile = async (daemon1: MockNodeDaemon, daemon2: MockNodeDaemon) => {
     const f1Content = Buffer.from('123456')
     const f1Key = daemon1.mockKacheryStorageManager().addMockFile(f1Content, {chunkSize: byteCount(1000)})
@@ -540,6 +618,15 @@ const submitMessage = async (daemon: MockNodeDaemon, feedId: FeedId, subfeedHash
     return res.success
 }
 
+const submitMessages = async (daemon: MockNodeDaemon, feedId: FeedId, subfeedHash: SubfeedHash, messages: SubmittedSubfeedMessage[], timeoutMsec: DurationMsec) => {
+    const req: FeedApiSubmitMessagesRequest = {
+        feedId, subfeedHash, messages, timeoutMsec
+    }
+    const res = await daemon.mockDaemonApiPost('/feed/submitMessages', req as any as JSONObject)
+    if (!isFeedApiSubmitMessagesResponse(res)) throw Error('Unexpected')
+    return res.success
+}
+
 const getMessages = async (daemon: MockNodeDaemon, feedId: FeedId, subfeedHash: SubfeedHash, position: SubfeedPosition, maxNumMessages: MessageCount, waitMsec: DurationMsec) => {
     const req: FeedApiGetMessagesRequest = {
         feedId, subfeedHash, position, maxNumMessages, waitMsec
@@ -730,6 +817,11 @@ const testSubmitSubfeedMessage = async (daemon1: MockNodeDaemon, daemon2: MockNo
     expect(messages.length).equals(1)
     expect(messages[0].test).equals(42)
 
+    // a batch of messages, appended in order
+    await submitMessages(daemon2, feed1, sf1, [{test: 43}, {test: 44}] as any as SubmittedSubfeedMessage[], scaledDurationMsec(1000))
+    const messages2 = await getMessages(daemon1, feed1, sf1, subfeedPosition(0), messageCount(10), scaledDurationMsec(1000))
+    expect(messages2.map(m => (m.test))).deep.equals([42, 43, 44])
+
     const ar1 = await getAccessRules(daemon1, feed1, sf1)
     if (!ar1) {
         throw(Error('Unable to get access rules'))
@@ -8,7 +8,7 @@ import { getSignature, hexToPublicKey, JSONStringifyDeterministic } from '../../
 import { randomAlphaString } from '../../src/common/util';
 import ExternalInterface from '../../src/external/ExternalInterface';
 import realExternalInterface from '../../src/external/real/realExternalInterface';
-import { Address, byteCount, feedIdToPublicKeyHex, FeedName, FileKey, hostName, localFilePath, NodeId, nowTimestamp, Sha1Hash, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, SubfeedMessage, toPort, unscaledDurationMsec, urlPath } from '../../src/interfaces/core';
+import { Address, byteCount, byteCountToNumber, feedIdToPublicKeyHex, FeedName, FileKey, FileManifest, FileManifestChunk, hostName, localFilePath, NodeId, nowTimestamp, Sha1Hash, SignedSubfeedMessage, SubfeedAccessRules, SubfeedHash, SubfeedMessage, toPort, unscaledDurationMsec, urlPath } from '../../src/interfaces/core';
 import NodeStats from '../../src/NodeStats';
 
 const testContext = (testFunction: (externalInterface: ExternalInterface, resolve: () => void, reject: (err: Error) => void) => Promise<void>, done: (err?: Error) => void) => {
@@ -201,5 +201,158 @@ mocha.describe('Real external interface', () => {
                 })
             }, done)
         })
+        it('fileAssembler', (done) => {
+            testContext(async (ri, resolve, reject) => {
+                const ksm = ri.createKacheryStorageManager()
+
+                const computeSha1 = (b: Buffer) => (crypto.createHash('sha1').update(b).digest('hex') as any as Sha1Hash)
+                const buf = Buffer.from(randomAlphaString(1000), 'utf-8')
+                const chunkSize = 300
+                const chunks: FileManifestChunk[] = []
+                for (let i = 0; i < buf.length; i += chunkSize) {
+                    const i2 = Math.min(i + chunkSize, buf.length)
+                    chunks.push({start: byteCount(i), end: byteCount(i2), sha1: computeSha1(buf.slice(i, i2))})
+                }
+                const manifest: FileManifest = {size: byteCount(buf.length), sha1: computeSha1(buf), chunks}
+                const assembler = await ksm.createFileAssembler(manifest)
+                // write the chunks in reverse order, each in two pieces
+                for (let i = chunks.length - 1; i >= 0; i--) {
+                    const data = buf.slice(byteCountToNumber(chunks[i].start), byteCountToNumber(chunks[i].end))
+                    const w = assembler.createChunkWriter(i)
+                    w.write(data.slice(0, 100))
+                    w.write(data.slice(100))
+                    await w.end()
+                    expect(assembler.isChunkComplete(i)).is.true
+                }
+                await assembler.finalize()
+                const r = await ksm.findFile({sha1: manifest.sha1})
+                expect(r.found).is.true
+                expect(byteCountToNumber(r.size)).equals(buf.length)
+
+                // a chunk with the wrong content is rejected
+                const assembler2 = await ksm.createFileAssembler({...manifest, sha1: computeSha1(Buffer.from('other'))})
+                const w2 = assembler2.createChunkWriter(0)
+                w2.write(buf.slice(1, chunkSize + 1))
+                let failed = false
+                try {
+                    await w2.end()
+                }
+                catch(err) {
+                    failed = true
+                }
+                expect(failed).is.true
+                expect(assembler2.isChunkComplete(0)).is.false
+                assembler2.cancel()
+                resolve()
+            }, done)
+        })
+        it('fileAssembler with duplicate chunk writers', (done) => {
+            testContext(async (ri, resolve, reject) => {
+                const ksm = ri.createKacheryStorageManager()
+
+                const computeSha1 = (b: Buffer) => (crypto.createHash('sha1').update(b).digest('hex') as any as Sha1Hash)
+                const _numTemporaryFiles = () => (fs.readdirSync(ksm.storageDir().toString() + '/tmp').filter(f => f.startsWith('kachery-p2p-assemble-')).length)
+                const _expectError = async (p: Promise<void>) => {
+                    let failed = false
+                    try {
+                        await p
+                    }
+                    catch(err) {
+                        failed = true
+                    }
+                    expect(failed).is.true
+                }
+                const buf = crypto.randomBytes(900)
+                const chunkSize = 300
+                const chunks: FileManifestChunk[] = []
+                for (let i = 0; i < buf.length; i += chunkSize) {
+                    chunks.push({start: byteCount(i), end: byteCount(i + chunkSize), sha1: computeSha1(buf.slice(i, i + chunkSize))})
+                }
+                const manifest: FileManifest = {size: byteCount(buf.length), sha1: computeSha1(buf), chunks}
+                const _chunkData = (i: number) => (buf.slice(i * chunkSize, (i + 1) * chunkSize))
+                const corrupt = crypto.randomBytes(chunkSize)
+                const assembler = await ksm.createFileAssembler(manifest)
+
+                // chunk 0: the first writer has bad data, and a second writer completes the chunk first
+                const w0a = assembler.createChunkWriter(0)
+                const w0b = assembler.createChunkWriter(0)
+                w0a.write(corrupt.slice(0, 100))
+                w0b.write(_chunkData(0))
+                await w0b.end()
+                expect(assembler.isChunkComplete(0)).is.true
+                // the remaining data of the first writer does not reach the file
+                w0a.write(corrupt.slice(100))
+                await w0a.end()
+
+                // chunk 1: the second writer has bad data, which does not reach the file
+                const w1a = assembler.createChunkWriter(1)
+                const w1b = assembler.createChunkWriter(1)
+                w1b.write(corrupt)
+                w1a.write(_chunkData(1))
+                await _expectError(w1b.end())
+                expect(assembler.isChunkComplete(1)).is.false
+                await w1a.end()
+                expect(assembler.isChunkComplete(1)).is.true
+
+                // chunk 2: the first writer has bad data and fails, then a new writer takes over
+                const w2a = assembler.createChunkWriter(2)
+                w2a.write(corrupt)
+                await _expectError(w2a.end())
+                const w2b = assembler.createChunkWriter(2)
+                const w2c = assembler.createChunkWriter(2)
+                w2b.write(_chunkData(2))
+                w2c.write(_chunkData(2).slice(0, 10))
+                w2c.cancel()
+                await w2b.end()
+
+                await assembler.finalize()
+                const r = await ksm.findFile({sha1: manifest.sha1})
+                expect(r.found).is.true
+                expect(_numTemporaryFiles()).equals(0)
+                resolve()
+            }, done)
+        })
+        it('fileWriter', (done) => {
+            testContext(async (ri, resolve, reject) => {
+                const ksm = ri.createKacheryStorageManager()
+
+                const computeSha1 = (b: Buffer) => (crypto.createHash('sha1').update(b).digest('hex') as any as Sha1Hash)
+                const _numTemporaryFiles = () => (fs.readdirSync(ksm.storageDir().toString() + '/tmp').filter(f => f.startsWith('kachery-p2p-download-')).length)
+                const buf = crypto.randomBytes(1000 * 1000)
+                const w = ksm.createFileWriter(computeSha1(buf))
+                // the writer asks to wait when the data is written faster than the disk takes it
+                let numWaits = 0
+                for (let i = 0; i < buf.length; i += 64 * 1000) {
+                    if (!w.write(buf.slice(i, i + 64 * 1000))) {
+                        numWaits ++
+                        await w.drained()
+                    }
+                }
+                expect(numWaits).greaterThan(0)
+                await w.end()
+                const r = await ksm.findFile({sha1: computeSha1(buf)})
+                expect(r.found).is.true
+                expect(byteCountToNumber(r.size)).equals(buf.length)
+
+                // content that does not match the sha1 is rejected
+                const w2 = ksm.createFileWriter(computeSha1(Buffer.from('other')))
+                w2.write(buf.slice(0, 100))
+                let failed = false
+                try {
+                    await w2.end()
+                }
+                catch(err) {
+                    failed = true
+                }
+                expect(failed).is.true
+
+                // a writer cancelled before its file is opened does not leave the file behind
+                const w3 = ksm.createFileWriter(computeSha1(Buffer.from('other')))
+                w3.cancel()
+                await new Promise<void>((resolve) => {setTimeout(resolve, 200)})
+                expect(_numTemporaryFiles()).equals(0)
+                resolve()
+            }, done)
+        })
     })
 })
\ No newline at end of file
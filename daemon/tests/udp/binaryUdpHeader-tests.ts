@@ -0,0 +1,50 @@
+import { expect } from 'chai';
+import * as mocha from 'mocha'; // import types for mocha e.g. describe
+import { createKeyPair, getSignature, publicKeyToHex, verifySignature } from '../../src/common/crypto_util';
+import { hostName, nodeIdToPublicKey, publicKeyHexToNodeId, toPort } from '../../src/interfaces/core';
+import { createUdpMessageId, numParts, partIndex, UdpHeader, udpMessageMetaData, UDP_MESSAGE_HEADER_SIZE } from '../../src/interfaces/UdpMessage';
+import { protocolVersion } from '../../src/protocolVersion';
+import { advertisesBinaryUdpHeaderSupport, binaryUdpHeaderSize, binaryUdpHeaderSupportMetaData, decodeBinaryUdpHeader, encodeBinaryUdpHeader, isBinaryUdpHeaderPacket } from '../../src/udp/BinaryUdpHeader';
+
+const createHeader = (): UdpHeader => {
+    const keyPair = createKeyPair()
+    const body = {
+        udpMessageId: createUdpMessageId(),
+        protocolVersion: protocolVersion(),
+        fromNodeId: publicKeyHexToNodeId(publicKeyToHex(keyPair.publicKey)),
+        toAddress: {hostName: hostName('localhost'), port: toPort(3008)},
+        udpMessageType: "streamDataChunk" as "streamDataChunk",
+        metaData: udpMessageMetaData({streamId: 'abcdefghij', dataChunkIndex: 3}),
+        partIndex: partIndex(2),
+        numParts: numParts(5),
+        payloadIsJson: false
+    }
+    return {body, signature: getSignature(body, keyPair)}
+}
+
+// need to explicitly use mocha prefix once or the dependency gets wrongly cleaned up
+mocha.describe('Binary udp header', () => {
+    it('round trips a signed header', () => {
+        const header = createHeader()
+        const h = encodeBinaryUdpHeader(header)
+        expect(h.length).equals(binaryUdpHeaderSize(header.body.toAddress, header.body.metaData))
+        expect(h.length).lessThan(UDP_MESSAGE_HEADER_SIZE)
+        const packet = Buffer.concat([h, Buffer.from('payload')])
+        expect(isBinaryUdpHeaderPacket(packet)).is.true
+        const x = decodeBinaryUdpHeader(packet)
+        if (x === null) throw Error('Unable to decode binary udp header')
+        expect(x.header).deep.equals(header)
+        expect(x.dataBuffer.toString()).equals('payload')
+        expect(verifySignature(x.header.body, x.header.signature, nodeIdToPublicKey(x.header.body.fromNodeId))).is.true
+    })
+    it('is distinguished from the JSON header', () => {
+        const header = createHeader()
+        const packet = Buffer.from(JSON.stringify(header).padEnd(UDP_MESSAGE_HEADER_SIZE, ' '))
+        expect(isBinaryUdpHeaderPacket(packet)).is.false
+        expect(decodeBinaryUdpHeader(packet)).is.null
+    })
+    it('advertises support in the meta data', () => {
+        expect(advertisesBinaryUdpHeaderSupport(binaryUdpHeaderSupportMetaData())).is.true
+        expect(advertisesBinaryUdpHeaderSupport(udpMessageMetaData({}))).is.false
+    })
+})
@@ -3,16 +3,17 @@ from .protocol_version import __version__, __protocol_version__
 from typing import Union
 from ._start_daemon import start_daemon, stop_daemon
 from ._exceptions import LoadFileError
-from ._feeds import Feed, Subfeed
+from ._feeds import Feed, Subfeed, SubfeedWriter, FeedWatcher
 from ._testdaemon import TestDaemon
 from .cli import cli
 
 from ._experimental_config import _experimental_config
 
 from .main import find_file
-from .main import get_channels, get_node_id
-from .main import load_file, load_npy, load_pkl, load_object, load_json, load_text, load_bytes
-from .main import store_file, store_object, store_json, store_npy, store_pkl, store_text, link_file
+from .main import get_channels, get_node_id, get_http_stats
+from .main import configure_load_cache, clear_load_cache, get_load_cache_stats, get_store_stats
+from .main import load_file, load_files, iter_load_files, load_npy, load_pkl, load_object, load_json, load_text, load_bytes, write_bytes_to_fd
+from .main import store_file, store_files, store_dir, store_object, store_json, store_npy, store_pkl, store_text, link_file
 from .main import load_feed, load_subfeed
 from .main import create_feed, delete_feed, get_feed_id, watch_for_new_messages
 from .main import get, set, delete, get_string
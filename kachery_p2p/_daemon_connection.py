@@ -1,7 +1,10 @@
 import os
+import socket
+import stat
+import threading
 import time
 import tempfile
-from typing import List, Union, cast
+from typing import Any, Dict, List, Tuple, Union, cast
 from ._misc import _http_get_json
 
 def _api_port():
@@ -10,20 +13,24 @@ def _api_port():
 def _api_host():
     return os.getenv('KACHERY_P2P_API_HOST', 'localhost')
 
-_client_auth_code_info = {
-    'timestamp': 0,
-    'code': ''
-}
+def _api_socket_path() -> Union[str, None]:
+    # the daemon continues with tcp only if it cannot listen on the socket, so fall back to the port when there is no socket
+    socket_path = os.getenv('KACHERY_P2P_API_SOCKET', None)
+    if not socket_path:
+        return None
+    try:
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            return None
+    except OSError:
+        return None
+    return socket_path
 
 def _get_client_auth_code():
-    elapsed = time.time() - _client_auth_code_info['timestamp']
-    if elapsed > 60:
-        _client_auth_code_info['code'] = _read_client_auth_code()
-        _client_auth_code_info['timestamp'] = time.time()
-    return _client_auth_code_info['code']
-
-def _read_client_auth_code():
-    ksd = _kachery_storage_dir()
+    if _kachery_offline_storage_dir_env_is_set():
+        return _read_client_auth_code(_kachery_storage_dir())
+    return _daemon_connection_state().client_auth_code()
+
+def _read_client_auth_code(ksd: Union[str, None]):
     p = f'{ksd}/client-auth'
     if not os.path.isfile(p):
         raise Exception(f'Unable to find client auth file (perhaps daemon is not running): {p}')
@@ -71,18 +78,142 @@ class _probe_result:
                 raise Exception(f'Inconsistent node ID between running daemon and kachery storage directory: {node_id_from_file} <> {self.node_id} ({fname})')
         self.kachery_storage_dir = ksd
 
-class _buffered_probe_data:
-    timestamp: float=0
-    result: Union[None, _probe_result]=None
+# a failed probe is retried after this many seconds
+_FAILED_PROBE_RETRY_SEC = 10
+# the file stats are checked at most this often
+_REVALIDATE_INTERVAL_SEC = 1
+# the daemon rewrites client-auth every 3 minutes, so an older file means it is no longer running
+_CLIENT_AUTH_MAX_AGE_SEC = 60 * 5
+# timeout for checking that the api socket or port accepts connections
+_REACHABLE_TIMEOUT_SEC = 1
+
+def _file_stat_key(path: str) -> Union[Tuple[int, int, int], None]:
+    try:
+        s = os.stat(path)
+    except OSError:
+        return None
+    return (s.st_mtime_ns, s.st_ino, s.st_size)
+
+def _api_is_reachable(api_port=None) -> bool:
+    # cheap check that the daemon still accepts connections (no http request)
+    socket_path = _api_socket_path()
+    try:
+        if (socket_path is not None) and (api_port is None):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(_REACHABLE_TIMEOUT_SEC)
+                sock.connect(socket_path)
+        else:
+            port = api_port if api_port is not None else _api_port()
+            with socket.create_connection((_api_host(), int(port)), timeout=_REACHABLE_TIMEOUT_SEC):
+                pass
+    except OSError:
+        return False
+    return True
+
+class _DaemonConnectionState:
+    """The result of probing the daemon, revalidated without http requests
+
+    The daemon is probed once. Afterwards the result is revalidated by cheap checks:
+    stat checks on files that the daemon maintains in the storage directory
+    (kachery-node-id is rewritten whenever the daemon starts, and client-auth
+    is rewritten every three minutes while the daemon is running), and a check
+    that the api socket or port still accepts connections. A connection error
+    on any request to the daemon also marks the state as stale.
+    """
+    def __init__(self, api_port=None):
+        self._api_port = api_port
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        # set without the lock by mark_stale, which may be called during a probe
+        self._stale = False
+        self._probe_result: Union[_probe_result, None] = None
+        self._probe_timestamp: float = 0
+        self._validated_timestamp: float = 0
+        self._node_id_file_stat = None
+        self._client_auth_stat = None
+        self._client_auth_code: Union[str, None] = None
+    def probe_result(self) -> Union[_probe_result, None]:
+        with self._lock:
+            if not self._is_valid():
+                self._probe()
+            return self._probe_result
+    def client_auth_code(self) -> str:
+        probe_result = self.probe_result()
+        if probe_result is None:
+            # raises the appropriate exception
+            return _read_client_auth_code(None)
+        with self._lock:
+            client_auth_stat = _file_stat_key(f'{probe_result.kachery_storage_dir}/client-auth')
+            if (self._client_auth_code is None) or (client_auth_stat != self._client_auth_stat):
+                self._client_auth_code = _read_client_auth_code(probe_result.kachery_storage_dir)
+                self._client_auth_stat = client_auth_stat
+            return self._client_auth_code
+    def invalidate(self) -> None:
+        with self._lock:
+            self._probe_timestamp = 0
+            self._validated_timestamp = 0
+            self._probe_result = None
+    def mark_stale(self) -> None:
+        # the next use revalidates the state (does not acquire the lock)
+        self._stale = True
+    def _is_valid(self) -> bool:
+        now = time.time()
+        if self._probe_result is None:
+            return now - self._probe_timestamp <= _FAILED_PROBE_RETRY_SEC
+        if self._stale:
+            return False
+        if now - self._validated_timestamp <= _REVALIDATE_INTERVAL_SEC:
+            return True
+        ksd = self._probe_result.kachery_storage_dir
+        if _file_stat_key(f'{ksd}/kachery-node-id') != self._node_id_file_stat:
+            return False
+        client_auth_stat = _file_stat_key(f'{ksd}/client-auth')
+        if (client_auth_stat is None) or (now - client_auth_stat[0] / 1e9 > _CLIENT_AUTH_MAX_AGE_SEC):
+            return False
+        if not _api_is_reachable(api_port=self._api_port):
+            return False
+        self._validated_timestamp = now
+        return True
+    def _probe(self) -> None:
+        self._stale = False
+        self._probe_result = _probe_daemon(api_port=self._api_port)
+        self._probe_timestamp = time.time()
+        self._validated_timestamp = self._probe_timestamp
+        self._client_auth_code = None
+        self._client_auth_stat = None
+        if self._probe_result is not None:
+            # _probe_result has verified the content of this file
+            self._node_id_file_stat = _file_stat_key(f'{self._probe_result.kachery_storage_dir}/kachery-node-id')
+
+_daemon_connection_states: Dict[Any, _DaemonConnectionState] = {}
+_daemon_connection_states_lock = threading.Lock()
+
+def _reset_daemon_connection_states_after_fork():
+    # the lock may have been held by another thread of the parent
+    global _daemon_connection_states_lock
+    _daemon_connection_states_lock = threading.Lock()
+    _daemon_connection_states.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_daemon_connection_states_after_fork)
+
+def _daemon_connection_state(api_port=None) -> _DaemonConnectionState:
+    with _daemon_connection_states_lock:
+        x = _daemon_connection_states.get(api_port, None)
+        if (x is None) or (x._pid != os.getpid()):
+            x = _DaemonConnectionState(api_port=api_port)
+            _daemon_connection_states[api_port] = x
+        return x
+
+def _mark_daemon_connection_states_stale():
+    # called on connection errors to the daemon
+    with _daemon_connection_states_lock:
+        states = list(_daemon_connection_states.values())
+    for x in states:
+        x.mark_stale()
 
 def _buffered_probe_daemon(api_port=None):
-    elapsed_since_last = time.time() - _buffered_probe_data.timestamp
-    if elapsed_since_last <= 10:
-        return _buffered_probe_data.result
-    res = _probe_daemon(api_port=api_port)
-    _buffered_probe_data.timestamp = time.time()
-    _buffered_probe_data.result = res
-    return _buffered_probe_data.result
+    return _daemon_connection_state(api_port=api_port).probe_result()
 
 def _probe_daemon(api_port=None):
     api_url, headers = _api_url(api_port=api_port, no_client_auth=True)
@@ -0,0 +1,125 @@
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from typing import IO, Any, Dict, Iterable, List, Tuple, Union
+
+import simplejson
+
+# Binary feed snapshot format (all integers little-endian):
+#
+#   header:   magic (8 bytes) | compression (uint32) | num. subfeeds (uint32) | index offset (uint64)
+#   records:  for each message, in order of subfeed then position:
+#             record length (uint32) | JSON of message (utf-8, compressed if enabled)
+#   offsets:  for each subfeed, the offset of the record of each message (uint64 per message)
+#   index:    for each subfeed:
+#             length of subfeed hash (uint16) | subfeed hash (utf-8) | num. messages (uint64) | offset of offsets table (uint64)
+#
+# The index and the offsets tables allow reading any range of messages of any
+# subfeed without decoding the rest of the snapshot. Each record is compressed
+# separately, so the compression does not affect random access.
+
+_SNAPSHOT_MAGIC = b'KFSNAP01'
+_HEADER = struct.Struct('<8sIIQ')
+_RECORD_LENGTH = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+_INDEX_ENTRY_HASH_LENGTH = struct.Struct('<H')
+_INDEX_ENTRY = struct.Struct('<QQ')
+
+_COMPRESSION_CODES = {None: 0, 'zlib': 1}
+
+def _is_binary_feed_snapshot(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(_SNAPSHOT_MAGIC)) == _SNAPSHOT_MAGIC
+
+def _write_binary_feed_snapshot(f: IO[bytes], subfeeds: Iterable[Tuple[str, Iterable[Any]]], *, compression: Union[str, None]=None) -> None:
+    # subfeeds is a sequence of (subfeed_hash, messages), where messages may be an iterator
+    # f must be seekable, since the header is written last
+    if compression not in _COMPRESSION_CODES:
+        raise Exception(f'Unsupported snapshot compression: {compression}')
+    f.write(_HEADER.pack(_SNAPSHOT_MAGIC, _COMPRESSION_CODES[compression], 0, 0))
+    offset = _HEADER.size
+    record_offsets: Dict[str, List[int]] = dict()
+    for subfeed_hash, messages in subfeeds:
+        if subfeed_hash in record_offsets:
+            continue
+        offsets: List[int] = []
+        for message in messages:
+            record = simplejson.dumps(message, separators=(',', ':')).encode('utf-8')
+            if compression == 'zlib':
+                record = zlib.compress(record)
+            f.write(_RECORD_LENGTH.pack(len(record)))
+            f.write(record)
+            offsets.append(offset)
+            offset += _RECORD_LENGTH.size + len(record)
+        record_offsets[subfeed_hash] = offsets
+    offsets_table_offsets: Dict[str, int] = dict()
+    for subfeed_hash, offsets in record_offsets.items():
+        offsets_table_offsets[subfeed_hash] = offset
+        a = array('Q', offsets)
+        if sys.byteorder != 'little':
+            a.byteswap()
+        f.write(a.tobytes())
+        offset += _OFFSET.size * len(offsets)
+    index_offset = offset
+    for subfeed_hash, offsets in record_offsets.items():
+        h = subfeed_hash.encode('utf-8')
+        f.write(_INDEX_ENTRY_HASH_LENGTH.pack(len(h)))
+        f.write(h)
+        f.write(_INDEX_ENTRY.pack(len(offsets), offsets_table_offsets[subfeed_hash]))
+    f.seek(0)
+    f.write(_HEADER.pack(_SNAPSHOT_MAGIC, _COMPRESSION_CODES[compression], len(record_offsets), index_offset))
+    f.seek(0, 2)
+
+class _BinaryFeedSnapshot:
+    # Read access to a binary feed snapshot via a memory-mapped file.
+    # Only the index is parsed up front; messages are decoded on demand.
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, compression_code, num_subfeeds, index_offset = _HEADER.unpack_from(self._mm, 0)
+        if magic != _SNAPSHOT_MAGIC:
+            raise Exception(f'Not a binary feed snapshot: {path}')
+        compressions = {v: k for k, v in _COMPRESSION_CODES.items()}
+        if compression_code not in compressions:
+            raise Exception(f'Unsupported snapshot compression code: {compression_code}')
+        self._compression = compressions[compression_code]
+        self._index: Dict[str, Tuple[int, int]] = dict()
+        offset = index_offset
+        for _ in range(num_subfeeds):
+            hash_length, = _INDEX_ENTRY_HASH_LENGTH.unpack_from(self._mm, offset)
+            offset += _INDEX_ENTRY_HASH_LENGTH.size
+            subfeed_hash = bytes(self._mm[offset:offset + hash_length]).decode('utf-8')
+            offset += hash_length
+            num_messages, offsets_table_offset = _INDEX_ENTRY.unpack_from(self._mm, offset)
+            offset += _INDEX_ENTRY.size
+            self._index[subfeed_hash] = (num_messages, offsets_table_offset)
+    def close(self) -> None:
+        self._mm.close()
+    def __enter__(self) -> '_BinaryFeedSnapshot':
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+    def get_subfeed_hashes(self) -> List[str]:
+        return list(self._index.keys())
+    def get_num_messages(self, subfeed_hash: str) -> int:
+        if subfeed_hash not in self._index:
+            return 0
+        return self._index[subfeed_hash][0]
+    def get_messages(self, subfeed_hash: str, start: int=0, end: Union[int, None]=None) -> List[Any]:
+        if subfeed_hash not in self._index:
+            return []
+        num_messages, offsets_table_offset = self._index[subfeed_hash]
+        # same semantics as slicing a list of the messages
+        start, end, _ = slice(start, end).indices(num_messages)
+        ret = []
+        for i in range(start, end):
+            record_offset, = _OFFSET.unpack_from(self._mm, offsets_table_offset + _OFFSET.size * i)
+            record_length, = _RECORD_LENGTH.unpack_from(self._mm, record_offset)
+            a = record_offset + _RECORD_LENGTH.size
+            record = self._mm[a:a + record_length]
+            if self._compression == 'zlib':
+                record = zlib.decompress(record)
+            ret.append(simplejson.loads(record.decode('utf-8')))
+        return ret
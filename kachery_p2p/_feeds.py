@@ -1,15 +1,23 @@
+import asyncio
+import functools
 import hashlib
 import json
+import os
+import threading
 import time
 from os import wait
 from os.path import basename
-from typing import Union
+from typing import IO, Any, AsyncIterator, Callable, Dict, Iterator, List, Tuple, Union
 from urllib.parse import quote, unquote
 
-from ._load_file import _load_json
-from ._store_file import _store_json
+import simplejson
+
+from ._feed_snapshot import _BinaryFeedSnapshot, _is_binary_feed_snapshot, _write_binary_feed_snapshot
+from ._load_file import _load_file
+from ._store_file import _add_exec_permissions, _add_read_permissions, _store_file
+from ._temporarydirectory import TemporaryDirectory
 from ._daemon_connection import _api_url
-from ._misc import _http_post_json, _http_get_json
+from ._misc import _http_post_json, _http_get_json, _http_post_json_receive_json_socket
 
 
 class Feed:
@@ -33,8 +41,17 @@ class Feed:
             self._feed_node_id = None
             self._is_writeable = False
             self._is_snapshot = True
-            self._snapshot_object = _load_json(uri)
-            assert self._snapshot_object is not None, f'Unable to load snapshot: {uri}'
+            self._snapshot_object = None
+            self._binary_snapshot = None
+            path = _load_file(uri)
+            assert path is not None, f'Unable to load snapshot: {uri}'
+            if _is_binary_feed_snapshot(path):
+                # indexed snapshot: messages are read on demand from the memory-mapped file
+                self._binary_snapshot = _BinaryFeedSnapshot(path)
+            else:
+                # parse the file that was just loaded (bypassing the load cache)
+                with open(path, 'r') as f:
+                    self._snapshot_object = simplejson.load(f)
         else:
             raise Exception(f'Unexpected feed uri: {uri}')
     def _initialize(self):
@@ -48,6 +65,10 @@ class Feed:
         assert x['success'], f'Unable to initialize feed: {self._feed_id} ({x["error"]})'
         self._feed_node_id = x['nodeId']
         self._is_writeable = x['isWriteable']
+    def close(self):
+        # releases the memory map of a binary snapshot
+        if self._is_snapshot and (self._binary_snapshot is not None):
+            self._binary_snapshot.close()
     def is_writeable(self):
         return self._is_writeable
     def get_feed_id(self):
@@ -62,20 +83,46 @@ class Feed:
         return Subfeed(feed=self, subfeed_name=subfeed_name, position=position)
     def delete(self):
         _delete_feed(self.get_uri())
-    def create_snapshot(self, subfeed_names: list):
-        subfeeds = dict()
-        for subfeed_name in subfeed_names:
-            subfeed = self.get_subfeed(subfeed_name)
-            messages = subfeed.get_next_messages(wait_msec=0)
-            subfeeds[subfeed.get_subfeed_hash()] = dict(
-                subfeedHash=subfeed.get_subfeed_hash(),
-                messages=messages
-            )
-        snapshot_uri = _store_json(dict(
-            subfeeds=subfeeds
-        ), basename='feed.json')
+    def create_snapshot(self, subfeed_names: list, *, binary: bool=False, compression: Union[str, None]=None):
+        # The snapshot is written to disk incrementally, one page of messages
+        # at a time, so the history of the feed is never held in memory
+        if (compression is not None) and (not binary):
+            raise Exception('Compression is only supported for binary snapshots')
+        subfeeds = [self.get_subfeed(subfeed_name) for subfeed_name in subfeed_names]
+        with TemporaryDirectory() as tmpdir:
+            if binary:
+                fname = tmpdir + '/feed.kfsnap'
+                with open(fname, 'wb') as f:
+                    _write_binary_feed_snapshot(f, [(subfeed.get_subfeed_hash(), subfeed._iter_messages(0)) for subfeed in subfeeds], compression=compression)
+            else:
+                fname = tmpdir + '/feed.json'
+                with open(fname, 'w') as f:
+                    _write_snapshot_json(f, subfeeds)
+            _add_read_permissions(tmpdir)
+            _add_exec_permissions(tmpdir)
+            _add_read_permissions(fname)
+            snapshot_uri = _store_file(fname, basename=os.path.basename(fname))
         return Feed(snapshot_uri)
 
+def _write_snapshot_json(f: IO[str], subfeeds: List['Subfeed']) -> None:
+    # Same content as _store_json(dict(subfeeds={subfeed_hash: dict(subfeedHash=..., messages=[...])}))
+    f.write('{"subfeeds":{')
+    subfeed_hashes_written = set()
+    for subfeed in subfeeds:
+        subfeed_hash = subfeed.get_subfeed_hash()
+        if subfeed_hash in subfeed_hashes_written:
+            continue
+        if len(subfeed_hashes_written) > 0:
+            f.write(',')
+        subfeed_hashes_written.add(subfeed_hash)
+        f.write(f'{simplejson.dumps(subfeed_hash)}:{{"subfeedHash":{simplejson.dumps(subfeed_hash)},"messages":[')
+        for i, message in enumerate(subfeed._iter_messages(0)):
+            if i > 0:
+                f.write(',')
+            f.write(simplejson.dumps(message, separators=(',', ':')))
+        f.write(']}')
+    f.write('}}')
+
 def _subfeed_hash(subfeed_name):
     if isinstance(subfeed_name, str):
         if subfeed_name.startswith('~'):
@@ -94,6 +141,9 @@ def _sha1_of_object(obj: object) -> str:
     return _sha1_of_string(txt)
 
 
+# number of messages retrieved from the daemon per request in Subfeed.get_messages()
+_MESSAGES_PAGE_SIZE = 1000
+
 class Subfeed:
     def __init__(self, *, feed, subfeed_name, position):
         self._feed = feed
@@ -150,14 +200,19 @@ class Subfeed:
             assert x['success'], f'Unable to get num. messages for subfeed: {self._feed_id} {self._subfeed_name_str}'
             return x['numMessages']
         else:
+            if self._feed._binary_snapshot is not None:
+                return self._feed._binary_snapshot.get_num_messages(self._subfeed_hash)
             messages = self._get_snapshot_messages()
             return len(messages)
         
-    def _get_snapshot_messages(self):
+    def _get_snapshot_messages(self, start: int=0, end: Union[int, None]=None):
         # only applies when feed is a snapshot
+        if self._feed._binary_snapshot is not None:
+            # seek directly to the requested range
+            return self._feed._binary_snapshot.get_messages(self._subfeed_hash, start, end)
         try:
             obj = self._feed._snapshot_object['subfeeds'][self._subfeed_hash]
-            return obj['messages']
+            return obj['messages'][start:end]
         except:
             return []
 
@@ -176,16 +231,45 @@ class Subfeed:
                 self._position = self._position + len(y)
             return y
         else:
-            messages = self._get_snapshot_messages()
             position = self._position
             if max_num_messages > 0:
-                ret = messages[position:position + max_num_messages]
+                ret = self._get_snapshot_messages(position, position + max_num_messages)
             else:
-                ret = messages[position:]
+                ret = self._get_snapshot_messages(position)
             if advance_position:
                 self._position = self._position + len(ret)
             return ret
 
+    def get_messages(self, start: int, end: Union[int, None]=None, *, signed=False) -> list:
+        """Get the messages at positions start <= position < end
+
+        If end is None, all the messages available locally from start are returned.
+        This does not wait for new messages and does not change the position of the subfeed.
+        """
+        return list(self._iter_messages(start, end, signed=signed))
+
+    def _iter_messages(self, start: int, end: Union[int, None]=None, *, signed=False) -> Iterator[Any]:
+        # Retrieve the messages from the daemon in pages, so that long ranges are not held in memory at once
+        if self.is_snapshot():
+            yield from self._get_snapshot_messages(start, end)
+            return
+        position = start
+        while (end is None) or (position < end):
+            num = _MESSAGES_PAGE_SIZE if end is None else min(_MESSAGES_PAGE_SIZE, end - position)
+            subfeed_watches = {
+                'watch': {
+                    'feedId': self._feed_id,
+                    'subfeedHash': self._subfeed_hash,
+                    'position': position
+                }
+            }
+            x = _watch_for_new_messages(subfeed_watches, wait_msec=0, signed=signed, max_num_messages=num)
+            y = x.get('watch', [])
+            if len(y) == 0:
+                return
+            yield from y
+            position = position + len(y)
+
     def get_next_message(self, *, wait_msec, signed=False, advance_position=True):
         messages = self.get_next_messages(wait_msec=wait_msec, signed=signed, max_num_messages=1, advance_position=advance_position)
         if messages is None:
@@ -194,7 +278,9 @@ class Subfeed:
             return None
         return messages[0]
     
-    def message_stream(self, *, signed=False):
+    def message_stream(self, *, signed=False, push=False):
+        if push and (not self.is_snapshot()):
+            return self._push_message_stream(signed=signed)
         class custom_iterator:
             def __init__(self, parent):
                 self._parent = parent
@@ -224,6 +310,23 @@ class Subfeed:
                 return self._messages[self._relative_position - 1]
         return custom_iterator(parent=self)
     
+    def _push_message_stream(self, *, signed=False):
+        # messages are pushed by the daemon as soon as they are appended
+        subscription = _MessageSubscription({
+            'watch': {
+                'feedId': self._feed_id,
+                'subfeedHash': self._subfeed_hash,
+                'position': self._position
+            }
+        }, signed=signed)
+        try:
+            for watch_name, messages in subscription:
+                for message in messages:
+                    self._position = self._position + 1
+                    yield message
+        finally:
+            subscription.close()
+
     def is_snapshot(self):
         return self._feed.is_snapshot()
     
@@ -261,17 +364,20 @@ class Subfeed:
     def submit_messages(self, messages):
         if self.is_snapshot():
             raise Exception('Cannot submit messages to a snapshot')
+        if len(messages) == 0:
+            return
+        # a single request for all the messages; the daemon appends them in one batch
+        # if it owns the feed, and otherwise submits them in order to the node that does
         api_url, headers = _api_url()
-        for message in messages:
-            url = f'{api_url}/feed/submitMessage'
-            x = _http_post_json(url, dict(
-                feedId=self._feed_id,
-                subfeedHash=self._subfeed_hash,
-                message=message,
-                timeoutMsec=4000
-            ), headers=headers)
-            if not x['success']:
-                raise Exception(f'Unable to submit message: {x.get("error")}')
+        url = f'{api_url}/feed/submitMessages'
+        x = _http_post_json(url, dict(
+            feedId=self._feed_id,
+            subfeedHash=self._subfeed_hash,
+            messages=messages,
+            timeoutMsec=4000
+        ), headers=headers)
+        if not x['success']:
+            raise Exception(f'Unable to submit messages: {x.get("error")}')
 
     def set_access_rules(self, access_rules):
         if not self._is_writeable:
@@ -330,6 +436,270 @@ class Subfeed:
         if changed:
             self.set_access_rules(access_rules)
 
+class SubfeedWriter:
+    """Buffered writer for appending (or submitting) messages to a subfeed at a high rate
+
+    Messages are collected into batches, and each batch is sent to the daemon
+    in a single request by a background thread. A batch is sent once it holds
+    max_batch_size messages, or flush_interval_sec after its first message was
+    buffered. At most max_pending_batches full batches wait to be sent;
+    beyond that, append_message() blocks until the daemon catches up.
+
+    Batches are sent one at a time, in order, so the messages are appended in
+    the order they were given. With submit=True, each batch is also a single
+    request to the daemon; when the feed is owned by a remote node, the daemon
+    forwards the messages of a batch to that node one at a time.
+
+        with SubfeedWriter(subfeed) as writer:
+            for event in events:
+                writer.append_message(event)
+        print(writer.get_stats())
+
+    An error from the daemon is raised by the next append_message(), flush()
+    or close() call.
+    """
+    def __init__(self, subfeed: 'Subfeed', *, max_batch_size: int=1000, flush_interval_sec: float=0.1, max_pending_batches: int=4, submit: bool=False):
+        if (not submit) and (not subfeed.is_writeable()):
+            raise Exception('Cannot append messages to a readonly feed (use submit=True)')
+        self._subfeed = subfeed
+        self._max_batch_size = max_batch_size
+        self._flush_interval_sec = flush_interval_sec
+        self._max_pending_batches = max_pending_batches
+        self._submit = submit
+        self._cond = threading.Condition()
+        self._buffer: List[Any] = []
+        self._buffer_timestamp = 0.0 # when the first message in the buffer was added
+        self._batches: List[List[Any]] = []
+        self._num_in_flight = 0
+        self._error: Union[Exception, None] = None
+        self._closed = False
+        self._num_messages_sent = 0
+        self._num_batches_sent = 0
+        self._send_duration_sec = 0.0
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    def append_message(self, message: Any) -> None:
+        self.append_messages([message])
+    def append_messages(self, messages: List[Any]) -> None:
+        with self._cond:
+            for message in messages:
+                self._check_error()
+                if self._closed:
+                    raise Exception('Cannot append messages to a closed writer')
+                if len(self._buffer) == 0:
+                    self._buffer_timestamp = time.time()
+                self._buffer.append(message)
+                if len(self._buffer) >= self._max_batch_size:
+                    self._seal_buffer()
+            self._cond.notify_all()
+    def flush(self) -> None:
+        """Send all the buffered messages and wait until the daemon has appended them"""
+        with self._cond:
+            if len(self._buffer) > 0:
+                self._seal_buffer()
+            self._cond.notify_all()
+            while (len(self._batches) > 0 or self._num_in_flight > 0) and (self._error is None):
+                self._cond.wait()
+            self._check_error()
+    def close(self) -> None:
+        try:
+            if not self._closed:
+                self.flush()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._thread.join()
+    def get_stats(self) -> dict:
+        """Throughput of the writer: the number of messages and batches sent, and messages per second"""
+        with self._cond:
+            elapsed_sec = time.time() - self._start_time
+            return dict(
+                num_messages_sent=self._num_messages_sent,
+                num_batches_sent=self._num_batches_sent,
+                num_messages_buffered=len(self._buffer) + sum([len(b) for b in self._batches]),
+                elapsed_sec=elapsed_sec,
+                send_duration_sec=self._send_duration_sec,
+                messages_per_sec=self._num_messages_sent / elapsed_sec if elapsed_sec > 0 else 0
+            )
+    def __enter__(self) -> 'SubfeedWriter':
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+    def _seal_buffer(self) -> None:
+        # (called with the lock held) move the buffer to the queue of batches, waiting for room if needed
+        while (len(self._batches) >= self._max_pending_batches) and (self._error is None):
+            self._cond.notify_all()
+            self._cond.wait()
+        self._check_error()
+        self._batches.append(self._buffer)
+        self._buffer = []
+    def _check_error(self) -> None:
+        if self._error is not None:
+            raise Exception(f'Problem writing to subfeed: {self._error}')
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._error is not None:
+                        return
+                    if len(self._batches) > 0:
+                        batch = self._batches.pop(0)
+                        break
+                    if len(self._buffer) > 0:
+                        remaining = self._buffer_timestamp + self._flush_interval_sec - time.time()
+                        if remaining <= 0:
+                            batch = self._buffer
+                            self._buffer = []
+                            break
+                        self._cond.wait(timeout=remaining)
+                    elif self._closed:
+                        return
+                    else:
+                        self._cond.wait()
+                self._num_in_flight = self._num_in_flight + 1
+                self._cond.notify_all()
+            timer = time.time()
+            try:
+                if self._submit:
+                    self._subfeed.submit_messages(batch)
+                else:
+                    self._subfeed.append_messages(batch)
+                error = None
+            except Exception as e:
+                error = e
+            with self._cond:
+                self._num_in_flight = self._num_in_flight - 1
+                if error is not None:
+                    self._error = error
+                else:
+                    self._num_messages_sent = self._num_messages_sent + len(batch)
+                    self._num_batches_sent = self._num_batches_sent + 1
+                    self._send_duration_sec = self._send_duration_sec + (time.time() - timer)
+                self._cond.notify_all()
+
+class FeedWatcher:
+    """Follow many subfeeds through a single long-poll request to the daemon
+
+    Each iteration issues one /feed/watchForNewMessages request covering all
+    of the registered subfeeds. The blocking request runs in the default
+    executor of the event loop, so the watcher can be used from asyncio code:
+
+        watcher = FeedWatcher()
+        watcher.add(subfeed1)
+        watcher.add(subfeed2)
+        async for subfeed, message in watcher:
+            ...
+
+    The position of a subfeed is advanced as each of its messages is yielded.
+    Subfeeds added or removed during iteration take effect at the next request.
+
+    With push=True, a single /feed/subscribeToMessages stream is held open
+    instead and the daemon sends messages as soon as they are appended.
+    Adding or removing subfeeds then reopens the stream.
+    """
+    def __init__(self, *, wait_msec: float=5000, signed: bool=False, max_num_messages: int=0, push: bool=False):
+        self._wait_msec = wait_msec
+        self._signed = signed
+        self._max_num_messages = max_num_messages
+        self._push = push
+        self._subfeeds: Dict[str, Subfeed] = {}
+        self._last_watch_index = 0
+        self._stopped = False
+        self._interrupt: Union[Callable[[], None], None] = None
+    def add(self, subfeed: Subfeed) -> None:
+        if subfeed.is_snapshot():
+            raise Exception('Cannot watch a snapshot subfeed')
+        self._last_watch_index += 1
+        self._subfeeds[f'w{self._last_watch_index}'] = subfeed
+        self._interrupt_push_stream()
+    def remove(self, subfeed: Subfeed) -> None:
+        for key in [k for k, v in self._subfeeds.items() if v is subfeed]:
+            del self._subfeeds[key]
+        self._interrupt_push_stream()
+    def get_subfeeds(self) -> List[Subfeed]:
+        return list(self._subfeeds.values())
+    def stop(self) -> None:
+        # iteration ends after the pending request returns (or immediately in push mode)
+        self._stopped = True
+        self._interrupt_push_stream()
+    def __aiter__(self) -> AsyncIterator[Tuple[Subfeed, Any]]:
+        if self._push:
+            return self._iterate_push()
+        return self._iterate()
+    def _interrupt_push_stream(self) -> None:
+        if self._interrupt is not None:
+            self._interrupt()
+    def _subfeed_watches(self, subfeeds: Dict[str, Subfeed]) -> Dict[str, dict]:
+        return {
+            key: {
+                'feedId': subfeed._feed_id,
+                'subfeedHash': subfeed._subfeed_hash,
+                'position': subfeed._position
+            }
+            for key, subfeed in subfeeds.items()
+        }
+    async def _iterate_push(self) -> AsyncIterator[Tuple[Subfeed, Any]]:
+        loop = asyncio.get_running_loop()
+        while (not self._stopped) and (len(self._subfeeds) > 0):
+            subfeeds = dict(self._subfeeds)
+            subscription = await loop.run_in_executor(None, functools.partial(
+                _MessageSubscription, self._subfeed_watches(subfeeds), signed=self._signed
+            ))
+            # the blocking stream is read on a separate thread and handed over through the queue;
+            # None marks the end of the stream (also used to interrupt it)
+            queue: asyncio.Queue = asyncio.Queue()
+            def read_stream():
+                try:
+                    for event in subscription:
+                        loop.call_soon_threadsafe(queue.put_nowait, event)
+                except Exception as err:
+                    loop.call_soon_threadsafe(queue.put_nowait, err)
+                finally:
+                    loop.call_soon_threadsafe(queue.put_nowait, None)
+            self._interrupt = lambda: loop.call_soon_threadsafe(queue.put_nowait, None)
+            threading.Thread(target=read_stream, daemon=True).start()
+            try:
+                while True:
+                    event = await queue.get()
+                    if event is None:
+                        break
+                    if isinstance(event, Exception):
+                        raise event
+                    key, messages = event
+                    for message in messages:
+                        if (self._stopped) or (key not in self._subfeeds):
+                            break
+                        subfeed = subfeeds[key]
+                        subfeed._position = subfeed._position + 1
+                        yield subfeed, message
+                    if (self._stopped) or (self._subfeeds != subfeeds):
+                        break
+            finally:
+                self._interrupt = None
+                subscription.close()
+    async def _iterate(self) -> AsyncIterator[Tuple[Subfeed, Any]]:
+        loop = asyncio.get_running_loop()
+        while (not self._stopped) and (len(self._subfeeds) > 0):
+            subfeeds = dict(self._subfeeds)
+            subfeed_watches = self._subfeed_watches(subfeeds)
+            x = await loop.run_in_executor(None, functools.partial(
+                _watch_for_new_messages,
+                subfeed_watches,
+                wait_msec=self._wait_msec,
+                signed=self._signed,
+                max_num_messages=self._max_num_messages
+            ))
+            for key, messages in x.items():
+                subfeed = subfeeds[key]
+                for message in messages:
+                    if (self._stopped) or (key not in self._subfeeds):
+                        # removed while its messages were being yielded
+                        break
+                    subfeed._position = subfeed._position + 1
+                    yield subfeed, message
+
 def _create_feed(feed_name=None):
     api_url, headers = _api_url()
     url = f'{api_url}/feed/createFeed'
@@ -416,6 +786,39 @@ def _watch_for_new_messages(subfeed_watches, *, wait_msec, signed=False, max_num
         raise Exception(f'Unable to watch for new messages.')
     return x['messages']
 
+class _MessageSubscription:
+    # A push subscription to the daemon: iterating yields (watch_name, messages)
+    # as soon as messages are appended to the watched subfeeds. The stream stays
+    # open until close() is called.
+    def __init__(self, subfeed_watches: Dict[str, dict], *, signed=False):
+        api_url, headers = _api_url()
+        url = f'{api_url}/feed/subscribeToMessages'
+        self._frames, self._req = _http_post_json_receive_json_socket(url, dict(
+            subfeedWatches=subfeed_watches,
+            signed=signed
+        ), headers=headers)
+        self._closed = False
+    def __iter__(self) -> Iterator[Tuple[str, list]]:
+        try:
+            for r in self._frames:
+                type0 = r.get('type')
+                if type0 == 'messages':
+                    yield r['watchName'], r['messages']
+                elif type0 == 'keepAlive':
+                    pass
+                elif type0 == 'error':
+                    raise Exception(f'Error subscribing to messages: {r.get("error")}')
+                else:
+                    raise Exception(f'Unexpected message from daemon: {r}')
+        except Exception:
+            if self._closed:
+                # closing the response from another thread interrupts the stream
+                return
+            raise
+    def close(self) -> None:
+        self._closed = True
+        self._req.close()
+
 def _parse_feed_uri(uri):
     listA = uri.split('?')
     assert len(listA) >= 1
@@ -0,0 +1,147 @@
+import os
+import random
+import sqlite3
+import time
+from typing import Tuple, Union
+
+from ._daemon_connection import _kachery_storage_dir
+
+# The hash cache maps the absolute path of a local file, together with its
+# stat tuple (size, mtime_ns, inode, device), to the sha1 of the file (and the
+# sha1 of its manifest, if any). It is shared with the daemon (see
+# FileHashCache.ts), so the stat values are stored as decimal strings.
+# The cache is best-effort: any problem opening or using the database
+# simply results in a cache miss.
+
+_HASH_CACHE_FILE_NAME = 'file-hashes.db'
+# least-recently used entries are evicted beyond this number of entries
+_HASH_CACHE_MAX_NUM_ENTRIES = 200000
+# fraction of inserts that trigger the (somewhat expensive) LRU eviction
+_HASH_CACHE_EVICTION_PROBABILITY = 0.01
+
+_StatKey = Tuple[str, str, str, str]
+
+# A NULL manifest_sha1 (the file was hashed without computing a manifest) keeps
+# the manifest hash already recorded for the same content
+_UPSERT_SQL = '''
+    INSERT INTO file_hashes (path, size, mtime_ns, ino, dev, sha1, manifest_sha1, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (path) DO UPDATE SET
+        size = excluded.size,
+        mtime_ns = excluded.mtime_ns,
+        ino = excluded.ino,
+        dev = excluded.dev,
+        sha1 = excluded.sha1,
+        manifest_sha1 = COALESCE(excluded.manifest_sha1, CASE WHEN file_hashes.sha1 = excluded.sha1 THEN file_hashes.manifest_sha1 END),
+        last_access = excluded.last_access
+'''
+
+def _hash_cache_stat_key(path: str) -> _StatKey:
+    s = os.stat(path)
+    return (str(s.st_size), str(s.st_mtime_ns), str(s.st_ino), str(s.st_dev))
+
+def _hash_cache_get(path: str, *, stat_key: Union[_StatKey, None]=None) -> Union[Tuple[str, Union[str, None]], None]:
+    path = os.path.abspath(path)
+    if stat_key is None:
+        stat_key = _hash_cache_stat_key(path)
+    conn = _open_hash_cache()
+    if conn is None:
+        return None
+    try:
+        with conn:
+            row = conn.execute('SELECT size, mtime_ns, ino, dev, sha1, manifest_sha1 FROM file_hashes WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                return None
+            if tuple(row[0:4]) != stat_key:
+                # the file has changed since it was hashed
+                conn.execute('DELETE FROM file_hashes WHERE path = ?', (path,))
+                return None
+            conn.execute('UPDATE file_hashes SET last_access = ? WHERE path = ?', (time.time(), path))
+            return row[4], row[5]
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+def _hash_cache_set(path: str, *, stat_key: _StatKey, sha1: str, manifest_sha1: Union[str, None]) -> None:
+    # stat_key should be obtained before the hash was computed, so that
+    # we do not record a hash for a file that changed in the meantime
+    path = os.path.abspath(path)
+    try:
+        if _hash_cache_stat_key(path) != stat_key:
+            return
+    except OSError:
+        return
+    conn = _open_hash_cache()
+    if conn is None:
+        return
+    try:
+        with conn:
+            conn.execute(_UPSERT_SQL, (path, *stat_key, sha1, manifest_sha1, time.time()))
+            if random.random() < _HASH_CACHE_EVICTION_PROBABILITY:
+                _evict_least_recently_used(conn)
+    except sqlite3.Error:
+        pass
+    finally:
+        conn.close()
+
+def _hash_cache_prune() -> Tuple[int, int]:
+    """Remove entries for files that no longer exist or have changed, then apply the LRU limit
+
+    Returns the number of entries removed and the number remaining
+    """
+    conn = _open_hash_cache()
+    if conn is None:
+        return 0, 0
+    try:
+        with conn:
+            stale = []
+            for path, size, mtime_ns, ino, dev in conn.execute('SELECT path, size, mtime_ns, ino, dev FROM file_hashes'):
+                try:
+                    if _hash_cache_stat_key(path) != (size, mtime_ns, ino, dev):
+                        stale.append(path)
+                except OSError:
+                    stale.append(path)
+            conn.executemany('DELETE FROM file_hashes WHERE path = ?', [(p,) for p in stale])
+            num_evicted = _evict_least_recently_used(conn)
+            num_remaining = conn.execute('SELECT COUNT(*) FROM file_hashes').fetchone()[0]
+        return len(stale) + num_evicted, num_remaining
+    except sqlite3.Error as e:
+        print(f'WARNING: unable to prune the hash cache: {e}')
+        return 0, 0
+    finally:
+        conn.close()
+
+def _evict_least_recently_used(conn: sqlite3.Connection) -> int:
+    cursor = conn.execute(
+        'DELETE FROM file_hashes WHERE path IN (SELECT path FROM file_hashes ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+        (_HASH_CACHE_MAX_NUM_ENTRIES,)
+    )
+    return cursor.rowcount
+
+def _open_hash_cache() -> Union[sqlite3.Connection, None]:
+    storage_dir = _kachery_storage_dir()
+    if storage_dir is None:
+        return None
+    try:
+        conn = sqlite3.connect(f'{storage_dir}/{_HASH_CACHE_FILE_NAME}', timeout=5)
+    except sqlite3.Error:
+        return None
+    try:
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS file_hashes (
+                    path TEXT PRIMARY KEY NOT NULL,
+                    size TEXT NOT NULL,
+                    mtime_ns TEXT NOT NULL,
+                    ino TEXT NOT NULL,
+                    dev TEXT NOT NULL,
+                    sha1 TEXT NOT NULL,
+                    manifest_sha1 TEXT,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS file_hashes_last_access ON file_hashes (last_access)')
+    except sqlite3.Error:
+        conn.close()
+        return None
+    return conn
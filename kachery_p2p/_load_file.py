@@ -1,14 +1,17 @@
+import copy
 import sys
 import os
 import shutil
-from typing import Union
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, Union
 import simplejson
 import numpy as np
 from ._daemon_connection import _is_offline_mode, _is_online_mode, _api_url, _kachery_storage_dir
 from ._experimental_config import _global_config
 from ._misc import _create_file_key, _http_post_json_receive_json_socket, _parse_kachery_uri
 from ._exceptions import LoadFileError
-from ._local_kachery_storage import _local_kachery_storage_load_file, _local_kachery_storage_load_bytes
+from ._local_kachery_storage import _local_kachery_storage_load_file, _local_kachery_storage_load_bytes, _load_bytes_from_local_file, _copy_local_file_to_fd
 from ._safe_pickle import _safe_unpickle
 
 def _load_file(uri: str, dest: Union[str, None]=None, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[str, None]:
@@ -99,33 +102,220 @@ def _load_file(uri: str, dest: Union[str, None]=None, p2p: bool=True, from_node:
     finally:
         req.close()
 
-def _load_json(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[dict, None]:
-    local_path = _load_file(uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
-    if local_path is None:
+def _load_files(uris: Iterable[str], *, max_concurrency: int=20, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Dict[str, Union[str, None]]:
+    ret: Dict[str, Union[str, None]] = {}
+    for uri, local_path in _iter_load_files(uris, max_concurrency=max_concurrency, p2p=p2p, from_node=from_node, from_channel=from_channel):
+        ret[uri] = local_path
+    return ret
+
+def _iter_load_files(uris: Iterable[str], *, max_concurrency: int=20, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Iterator[Tuple[str, Union[str, None]]]:
+    # yields (uri, local_path) as each file becomes available (local_path is None if the file could not be loaded)
+    if (not isinstance(max_concurrency, int)) or (max_concurrency < 1):
+        raise Exception(f'max_concurrency must be a positive integer: {max_concurrency}')
+    uris_to_load: List[str] = []
+    for uri in dict.fromkeys(uris):
+        if not uri.startswith('sha1://'):
+            # sha1dir:// and local paths
+            yield uri, _load_file(uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
+            continue
+        # first check the local kachery storage (if kachery storage dir is known)
+        if _kachery_storage_dir():
+            protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
+            if protocol != 'sha1':
+                raise Exception(f'Protocol not supported: {protocol}')
+            local_path = _local_kachery_storage_load_file(sha1_hash=hash0)
+            if local_path is not None:
+                yield uri, local_path
+                continue
+        uris_to_load.append(uri)
+    if len(uris_to_load) == 0:
+        return
+    if _is_offline_mode():
+        for uri in uris_to_load:
+            yield uri, None
+        return
+    if not _is_online_mode():
+        raise Exception('Not connected to daemon, and KACHERY_OFFLINE_STORAGE_DIR environment variable is not set.')
+
+    try_p2p = p2p and (not _global_config['nop2p'])
+    if not try_p2p:
+        for uri in uris_to_load:
+            yield uri, None
+        return
+
+    file_keys = []
+    for uri in uris_to_load:
+        protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
+        assert algorithm == 'sha1'
+        file_keys.append(_create_file_key(sha1=hash0, query=query))
+    api_url, headers = _api_url()
+    url = f'{api_url}/loadFiles'
+    sock, req = _http_post_json_receive_json_socket(url, dict(
+        fileKeys=file_keys,
+        fromNode=from_node,
+        maxConcurrency=max_concurrency
+    ), headers=headers)
+    try:
+        pending = set(range(len(uris_to_load)))
+        for r in sock:
+            try:
+                type0 = r.get('type')
+                index = r.get('index')
+            except:
+                raise Exception(f'Unexpected response from daemon: {r}')
+            if index is None:
+                raise Exception(f'Error loading files: {r.get("error")}')
+            if index not in pending:
+                raise Exception(f'Unexpected message from daemon: {r}')
+            pending.remove(index)
+            uri = uris_to_load[index]
+            if type0 == 'finished':
+                local_file_path: str = r['localFilePath']
+                if not os.path.exists(local_file_path):
+                    raise Exception(f'Unexpected in load_files: file does not exist: {local_file_path}')
+                yield uri, local_file_path
+            elif type0 == 'error':
+                print(f'Error loading file: {r["error"]}: {uri}')
+                yield uri, None
+            else:
+                raise Exception(f'Unexpected message from daemon: {r}')
+        if len(pending) > 0:
+            raise Exception(f'Unable to download {len(pending)} of {len(uris_to_load)} files')
+    finally:
+        req.close()
+
+# Optional in-process cache of decoded json, text and pickle objects. Entries are
+# keyed by sha1 hash, so they never become stale. The cache is bounded both by the
+# number of entries and by the total size of the underlying files. Callers always
+# receive a copy, so they cannot corrupt the cached objects. The cache is disabled
+# (max_entries=0) until it is enabled with configure_load_cache.
+_DEFAULT_OBJECT_CACHE_MAX_ENTRIES = 0
+_DEFAULT_OBJECT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+class _ObjectCache:
+    def __init__(self, *, max_entries: int, max_bytes: int):
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries: 'OrderedDict[Tuple[str, str], Tuple[Any, int]]' = OrderedDict()
+        self._num_bytes = 0
+        self._stats = dict(hits=0, misses=0, evictions=0)
+    def is_enabled(self) -> bool:
+        return self._max_entries > 0
+    def get(self, key: Tuple[str, str]) -> Tuple[bool, Any]:
+        with self._lock:
+            x = self._entries.get(key, None)
+            if x is None:
+                self._stats['misses'] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return True, x[0]
+    def put(self, key: Tuple[str, str], value: Any, size: int) -> None:
+        with self._lock:
+            if (self._max_entries <= 0) or (size > self._max_bytes):
+                return
+            if key in self._entries:
+                return
+            self._entries[key] = (value, size)
+            self._num_bytes += size
+            self._evict()
+    def configure(self, *, max_entries: int, max_bytes: int) -> None:
+        with self._lock:
+            self._max_entries = max_entries
+            self._max_bytes = max_bytes
+            self._evict()
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(
+                **self._stats,
+                num_entries=len(self._entries),
+                num_bytes=self._num_bytes,
+                max_entries=self._max_entries,
+                max_bytes=self._max_bytes
+            )
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = dict(hits=0, misses=0, evictions=0)
+    def _evict(self) -> None:
+        while (len(self._entries) > self._max_entries) or (self._num_bytes > self._max_bytes):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._num_bytes -= size
+            self._stats['evictions'] += 1
+
+_object_cache = _ObjectCache(max_entries=_DEFAULT_OBJECT_CACHE_MAX_ENTRIES, max_bytes=_DEFAULT_OBJECT_CACHE_MAX_BYTES)
+
+def _object_cache_key(kind: str, uri: str) -> Union[Tuple[str, str], None]:
+    # only content-addressed uris can be cached
+    if not uri.startswith('sha1://'):
         return None
-    with open(local_path, 'r') as f:
-        return simplejson.load(f)
+    protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
+    return (kind, hash0)
 
-def _load_text(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[str, None]:
+def _copy_json(x: Any) -> Any:
+    # much faster than copy.deepcopy for decoded json
+    if isinstance(x, dict):
+        return {k: _copy_json(v) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [_copy_json(v) for v in x]
+    else:
+        return x
+
+def _load_cached_object(kind: str, uri: str, load: Callable[[str], Any], copy_value: Callable[[Any], Any], *, p2p: bool, from_node: Union[str, None], from_channel: Union[str, None]) -> Any:
+    key = _object_cache_key(kind, uri) if _object_cache.is_enabled() else None
+    if key is not None:
+        found, value = _object_cache.get(key)
+        if found:
+            return copy_value(value)
     local_path = _load_file(uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
     if local_path is None:
         return None
-    with open(local_path, 'r') as f:
-        return f.read()
+    value = load(local_path)
+    if key is None:
+        return value
+    _object_cache.put(key, value, os.path.getsize(local_path))
+    return copy_value(value)
 
-def _load_npy(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[np.ndarray, None]:
+def _load_json(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[dict, None]:
+    def load(local_path: str):
+        with open(local_path, 'r') as f:
+            return simplejson.load(f)
+    return _load_cached_object('json', uri, load, _copy_json, p2p=p2p, from_node=from_node, from_channel=from_channel)
+
+def _load_text(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[str, None]:
+    def load(local_path: str):
+        with open(local_path, 'r') as f:
+            return f.read()
+    # strings are immutable, so no copy is needed
+    return _load_cached_object('text', uri, load, lambda x: x, p2p=p2p, from_node=from_node, from_channel=from_channel)
+
+def _load_npy(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None, mmap_mode: Union[str, None]=None) -> Union[np.ndarray, None]:
+    # local_path is the content-addressed file in kachery storage (or the target of a .link file),
+    # so with mmap_mode the array is memory-mapped in place. Only read-only ('r') and
+    # copy-on-write ('c') maps are allowed, since writing would corrupt the stored file.
+    if mmap_mode not in (None, 'r', 'c'):
+        raise Exception(f"Unsupported mmap_mode for load_npy: {mmap_mode} (must be None, 'r' or 'c')")
     local_path = _load_file(uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
     if local_path is None:
         return None
-    return np.load(local_path, allow_pickle=False)
+    return np.load(local_path, mmap_mode=mmap_mode, allow_pickle=False)
 
 def _load_pkl(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[np.ndarray, None]:
-    local_path = _load_file(uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
-    if local_path is None:
-        return None
-    return _safe_unpickle(local_path)
+    return _load_cached_object('pkl', uri, _safe_unpickle, copy.deepcopy, p2p=p2p, from_node=from_node, from_channel=from_channel)
 
-def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], write_to_stdout=False, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[bytes, None]:
+def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], write_to_stdout=False, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None, mmap: bool=False) -> Union[bytes, bytearray, memoryview, None]:
+    if write_to_stdout:
+        sys.stdout.flush()
+        try:
+            _write_bytes_to_fd(uri, sys.stdout.fileno(), start=start, end=end, p2p=p2p, from_node=from_node, from_channel=from_channel)
+        except LoadFileError as e:
+            # as before, a file that cannot be loaded results in None
+            print(str(e))
+        return None
     # handle old sha1dir system
     if uri.startswith('sha1dir://'):
         uri0 = _resolve_file_uri_from_dir_uri(uri)
@@ -136,7 +326,7 @@ def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], write_
     if not uri.startswith('sha1://'):
         if os.path.isfile(uri):
             local_path = uri
-            return _load_bytes_from_local_file(local_path, start=start, end=end, write_to_stdout=write_to_stdout)
+            return _load_bytes_from_local_file(local_path, start=start, end=end, write_to_stdout=write_to_stdout, mmap=mmap)
         else:
             raise Exception(f'Local file not found: {uri}')
     
@@ -145,7 +335,7 @@ def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], write_
         protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
         if protocol != 'sha1':
             raise Exception(f'Protocol not supported: {protocol}')
-        bytes0 = _local_kachery_storage_load_bytes(sha1_hash=hash0, start=start, end=end, write_to_stdout=write_to_stdout)
+        bytes0 = _local_kachery_storage_load_bytes(sha1_hash=hash0, start=start, end=end, write_to_stdout=write_to_stdout, mmap=mmap)
         if bytes0 is not None:
             return bytes0
     
@@ -165,60 +355,111 @@ def _load_bytes(uri: str, start: Union[int, None], end: Union[int, None], write_
             print('Unable to load manifest')
             return None
         assert manifest['sha1'] == hash0, 'Manifest sha1 does not match expected.'
-        data_chunks = []
-        chunks_to_load = []
-        for ch in manifest['chunks']:
-            if start < ch['end'] and end > ch['start']:
-                chunks_to_load.append(ch)
-        for ii, ch in enumerate(chunks_to_load):
-            if len(chunks_to_load) > 4:
-                print(f'load_bytes: Loading chunk {ii + 1} of {len(chunks_to_load)}')
-            chunk_uri = f'sha1://{ch["sha1"]}?chunkOf={hash0}~{ch["start"]}~{ch["end"]}'
-            chunk_path = _load_file(chunk_uri)
+        if start is None:
+            start = 0
+        if end is None:
+            end = manifest['size']
+        chunks_to_load, chunk_uris = _get_manifest_chunks_to_load(manifest, start=start, end=end)
+        if len(chunks_to_load) > 4:
+            print(f'load_bytes: Loading {len(chunks_to_load)} chunks')
+        # the chunks are requested from the daemon all at once and downloaded concurrently
+        chunk_paths = _load_files(chunk_uris, from_node=from_node)
+        # assemble the result in place (no intermediate copies)
+        ret = bytearray(end - start)
+        ret_view = memoryview(ret)
+        for ch, chunk_uri in zip(chunks_to_load, chunk_uris):
+            chunk_path = chunk_paths.get(chunk_uri, None)
             if chunk_path is None:
                 print(f'Problem loading chunk: {chunk_uri}')
                 return None
             start_byte = max(0, start - ch['start'])
             end_byte = min(ch['end']-ch['start'], end-ch['start'])
-            a = _load_bytes(
-                uri=chunk_path,
-                start=start_byte,
-                end=end_byte
-            )
-            if a is None:
-                print(f'Unable to load bytes from chunk: {chunk_path} (start={start_byte}; end={end_byte})')
-                return None
-            data_chunks.append(a)
-        return b''.join(data_chunks)
+            offset = ch['start'] + start_byte - start
+            _read_bytes_from_local_file_into(chunk_path, start=start_byte, out=ret_view[offset:offset + end_byte - start_byte])
+        return ret
     
     path = _load_file(uri=uri, from_node=from_node, from_channel=from_channel)
     if path is None:
         print('Unable to load file.')
         return None
-    bytes0 = _local_kachery_storage_load_bytes(sha1_hash=hash0, start=start, end=end, write_to_stdout=write_to_stdout)
-
-def _load_bytes_from_local_file(local_fname: str, *, start: Union[int, None]=None, end: Union[int, None]=None, write_to_stdout: bool=False) -> Union[bytes, None]:
-    size0 = os.path.getsize(local_fname)
-    if start is None:
-        start = 0
-    if end is None:
-        end = size0
-    if start < 0 or start > size0 or end < start or end > size0:
-        raise Exception('Invalid start/end range for file of size {}: {} - {}'.format(size0, start, end))
-    if start == end:
-        return bytes()
+    return _local_kachery_storage_load_bytes(sha1_hash=hash0, start=start, end=end, write_to_stdout=write_to_stdout, mmap=mmap)
+
+def _write_bytes_to_fd(uri: str, fd: int, *, start: Union[int, None]=None, end: Union[int, None]=None, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> None:
+    # streaming counterpart of _load_bytes, used for cat-file
+    # handle old sha1dir system
+    if uri.startswith('sha1dir://'):
+        uri0 = _resolve_file_uri_from_dir_uri(uri)
+        if uri0 is None:
+            raise LoadFileError(f'Unable to resolve file: {uri}')
+        uri = uri0
+
+    if not uri.startswith('sha1://'):
+        if os.path.isfile(uri):
+            _copy_local_file_to_fd(uri, fd, start=start, end=end)
+            return
+        else:
+            raise Exception(f'Local file not found: {uri}')
+
+    protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uri)
+    if protocol != 'sha1':
+        raise Exception(f'Protocol not supported: {protocol}')
+    # first check the local kachery storage (if kachery storage dir is known)
+    if _kachery_storage_dir():
+        local_path = _local_kachery_storage_load_file(sha1_hash=hash0)
+        if local_path is not None:
+            _copy_local_file_to_fd(local_path, fd, start=start, end=end)
+            return
+
+    if query.get('manifest') and (not _is_offline_mode()) and p2p and (not _global_config['nop2p']):
+        manifest = _load_json(f'sha1://{query["manifest"][0]}', p2p=p2p, from_node=from_node)
+        if manifest is None:
+            raise LoadFileError(f'Unable to load manifest: {uri}')
+        assert manifest['sha1'] == hash0, 'Manifest sha1 does not match expected.'
+        if start is None:
+            start = 0
+        if end is None:
+            end = manifest['size']
+        chunks_to_load, chunk_uris = _get_manifest_chunks_to_load(manifest, start=start, end=end)
+        # the chunks arrive in any order, but are written out in order as soon as possible
+        chunk_paths: Dict[str, str] = {}
+        next_index = 0
+        for chunk_uri, chunk_path in _iter_load_files(chunk_uris, from_node=from_node):
+            if chunk_path is None:
+                raise LoadFileError(f'Problem loading chunk: {chunk_uri}')
+            chunk_paths[chunk_uri] = chunk_path
+            while (next_index < len(chunk_uris)) and (chunk_uris[next_index] in chunk_paths):
+                ch = chunks_to_load[next_index]
+                start_byte = max(0, start - ch['start'])
+                end_byte = min(ch['end']-ch['start'], end-ch['start'])
+                _copy_local_file_to_fd(chunk_paths[chunk_uris[next_index]], fd, start=start_byte, end=end_byte)
+                next_index = next_index + 1
+        return
+
+    local_path = _load_file(uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
+    if local_path is None:
+        raise LoadFileError(f'Unable to load file: {uri}')
+    _copy_local_file_to_fd(local_path, fd, start=start, end=end)
+
+def _get_manifest_chunks_to_load(manifest: dict, *, start: int, end: int) -> Tuple[List[dict], List[str]]:
+    chunks_to_load = []
+    for ch in manifest['chunks']:
+        if start < ch['end'] and end > ch['start']:
+            chunks_to_load.append(ch)
+    chunk_uris = [
+        f'sha1://{ch["sha1"]}?chunkOf={manifest["sha1"]}~{ch["start"]}~{ch["end"]}'
+        for ch in chunks_to_load
+    ]
+    return chunks_to_load, chunk_uris
+
+def _read_bytes_from_local_file_into(local_fname: str, *, start: int, out: memoryview) -> None:
     with open(local_fname, 'rb') as f:
         f.seek(start)
-        if write_to_stdout:
-            ii = start
-            while ii < end:
-                nn = min(end - ii, 4096)
-                data0 = f.read(nn)
-                ii = ii + nn
-                sys.stdout.buffer.write(data0)
-            return None
-        else:
-            return f.read(end-start)
+        pos = 0
+        while pos < len(out):
+            n = f.readinto(out[pos:])
+            if not n:
+                raise Exception(f'Unexpected end of file: {local_fname}')
+            pos = pos + n
 
 def _resolve_file_uri_from_dir_uri(dir_uri, p2p: bool=True):
     protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(dir_uri)
@@ -246,6 +487,8 @@ def _resolve_file_uri_from_dir_uri(dir_uri, p2p: bool=True):
                         algorithm1 = alg
                 if hash1 is None:
                     return None
+                if dd['files'][name0].get('manifestSha1', None):
+                    return algorithm1 + '://' + hash1 + '?manifest=' + dd['files'][name0]['manifestSha1']
                 return algorithm1 + '://' + hash1
             else:
                 return None
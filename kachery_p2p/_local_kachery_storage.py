@@ -1,12 +1,18 @@
 import os
 import sys
+import errno
 import hashlib
 import shutil
 import random
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from mmap import ACCESS_READ
+from mmap import mmap as _mmap
 from typing import Optional, Tuple, Union
 from ._misc import _parse_kachery_uri
 from ._daemon_connection import _kachery_storage_dir
+from ._hash_cache import _hash_cache_get, _hash_cache_set, _hash_cache_stat_key
 
 
 def _local_kachery_storage_load_file(*, sha1_hash: str):
@@ -49,26 +55,16 @@ def _stat_matches(stat: dict, path: str):
         return False
     return True
     
-def _local_kachery_storage_load_bytes(*, sha1_hash: str, start: Union[int, None]=None, end: Union[int, None]=None, write_to_stdout: bool=False):
-    sha1_directory = f'{_kachery_storage_dir()}/sha1'
-    path = _get_path_ext(hash=sha1_hash, create=False, directory=sha1_directory)
-    if os.path.exists(path):
-        return _load_bytes_from_local_file(local_fname=path, start=start, end=end, write_to_stdout=write_to_stdout)
+def _local_kachery_storage_load_bytes(*, sha1_hash: str, start: Union[int, None]=None, end: Union[int, None]=None, write_to_stdout: bool=False, mmap: bool=False):
+    # also resolves linked files
+    path = _local_kachery_storage_load_file(sha1_hash=sha1_hash)
+    if path is not None:
+        return _load_bytes_from_local_file(local_fname=path, start=start, end=end, write_to_stdout=write_to_stdout, mmap=mmap)
     else:
         return None
 
 def _local_kachery_storage_store_file(*, path: str, _no_manifest=False) -> Tuple[str, str, Union[str, None]]:
-    from ._store_file import _store_json # don't want circular dependencies
-    if (not _no_manifest) and (os.path.getsize(path) > 20000000):
-        hash0, manifest0 = _compute_local_file_sha1_and_manifest(path)
-        if manifest0 is None:
-            raise Exception(f'Unable to compute hash of file: {path}')
-        manifest_uri = _store_json(manifest0)
-        protocol, algorithm, manifest_hash, additional_path, query = _parse_kachery_uri(manifest_uri)
-    else:
-        hash0 = _get_file_hash(path)
-        manifest_hash = None
-    assert hash0 is not None
+    hash0, manifest_hash = _get_file_hash_and_manifest_hash(path, _no_manifest=_no_manifest)
     sha1_directory = f'{_kachery_storage_dir()}/sha1'
     path0 = _get_path_ext(hash=hash0, create=True, directory=sha1_directory)
     if not os.path.exists(path0):
@@ -77,18 +73,19 @@ def _local_kachery_storage_store_file(*, path: str, _no_manifest=False) -> Tuple
         _rename_file(tmp_path, path0, remove_if_exists=False)
     return path0, hash0, manifest_hash
 
+def _local_kachery_storage_store_bytes(*, data: Union[bytes, bytearray, memoryview], sha1_hash: str) -> str:
+    # sha1_hash must be the sha1 of data (computed by the caller)
+    sha1_directory = f'{_kachery_storage_dir()}/sha1'
+    path0 = _get_path_ext(hash=sha1_hash, create=True, directory=sha1_directory)
+    if not os.path.exists(path0):
+        tmp_path = path0 + '.copying.' + _random_string(6)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        _rename_file(tmp_path, path0, remove_if_exists=False)
+    return path0
+
 def _local_kachery_storage_link_file(*, path: str, _no_manifest=False) -> Tuple[str, str, Union[str, None]]:
-    from ._store_file import _store_json # don't want circular dependencies
-    if (not _no_manifest) and (os.path.getsize(path) > 20000000):
-        hash0, manifest0 = _compute_local_file_sha1_and_manifest(path)
-        if manifest0 is None:
-            raise Exception(f'Unable to compute hash of file: {path}')
-        manifest_uri = _store_json(manifest0)
-        protocol, algorithm, manifest_hash, additional_path, query = _parse_kachery_uri(manifest_uri)
-    else:
-        hash0 = _get_file_hash(path)
-        manifest_hash = None
-    assert hash0 is not None
+    hash0, manifest_hash = _get_file_hash_and_manifest_hash(path, _no_manifest=_no_manifest)
     sha1_directory = f'{_kachery_storage_dir()}/sha1'
     path0 = _get_path_ext(hash=hash0, create=True, directory=sha1_directory)
     if not os.path.exists(path0):
@@ -105,6 +102,28 @@ def _local_kachery_storage_link_file(*, path: str, _no_manifest=False) -> Tuple[
         _rename_file(tmp_path, path0 + '.link', remove_if_exists=True)
     return path0, hash0, manifest_hash
 
+def _get_file_hash_and_manifest_hash(path: str, *, _no_manifest=False) -> Tuple[str, Union[str, None]]:
+    from ._store_file import _store_json # don't want circular dependencies
+    if (not _no_manifest) and (os.path.getsize(path) > 20000000):
+        stat_key = _hash_cache_stat_key(path)
+        cached = _hash_cache_get(path, stat_key=stat_key)
+        if cached is not None:
+            hash0, manifest_hash = cached
+            # the manifest itself must still be available in the storage
+            if (manifest_hash is not None) and (_local_kachery_storage_load_file(sha1_hash=manifest_hash) is not None):
+                return hash0, manifest_hash
+        hash0, manifest0 = _compute_local_file_sha1_and_manifest(path)
+        if manifest0 is None:
+            raise Exception(f'Unable to compute hash of file: {path}')
+        manifest_uri = _store_json(manifest0)
+        protocol, algorithm, manifest_hash, additional_path, query = _parse_kachery_uri(manifest_uri)
+        _hash_cache_set(path, stat_key=stat_key, sha1=hash0, manifest_sha1=manifest_hash)
+    else:
+        hash0 = _get_file_hash(path)
+        manifest_hash = None
+    assert hash0 is not None
+    return hash0, manifest_hash
+
 def _get_file_hash(path: str, *, _cache_only=False):
     algorithm = 'sha1'
     if os.path.getsize(path) < 100000:
@@ -120,6 +139,11 @@ def _get_file_hash(path: str, *, _cache_only=False):
             # in that case we don't need to compute
             return basename
 
+    stat_key = _hash_cache_stat_key(path)
+    cached = _hash_cache_get(path, stat_key=stat_key)
+    if cached is not None:
+        return cached[0]
+
     if _cache_only:
         return None
     hash1 = _compute_file_hash(path, algorithm=algorithm)
@@ -127,6 +151,7 @@ def _get_file_hash(path: str, *, _cache_only=False):
     if not hash1:
         return None
 
+    _hash_cache_set(path, stat_key=stat_key, sha1=hash1, manifest_sha1=None)
     return hash1
 
 def _compute_file_hash(path: str, algorithm: str) -> Optional[str]:
@@ -163,7 +188,7 @@ def _get_path_ext(hash: str, *, create: bool=True, directory: str) -> str:
                     raise Exception('Unable to make directory: ' + path0)
     return os.path.join(path0, hash)
 
-def _load_bytes_from_local_file(local_fname: str, *, start: Union[int, None]=None, end: Union[int, None]=None, write_to_stdout: bool=False) -> Union[bytes, None]:
+def _load_bytes_from_local_file(local_fname: str, *, start: Union[int, None]=None, end: Union[int, None]=None, write_to_stdout: bool=False, mmap: bool=False) -> Union[bytes, memoryview, None]:
     size0 = os.path.getsize(local_fname)
     if start is None:
         start = 0
@@ -172,19 +197,55 @@ def _load_bytes_from_local_file(local_fname: str, *, start: Union[int, None]=Non
     if start < 0 or start > size0 or end < start or end > size0:
         raise Exception('Invalid start/end range for file of size {}: {} - {}'.format(size0, start, end))
     if start == end:
-        return bytes()
+        return memoryview(bytes()) if mmap else bytes()
     with open(local_fname, 'rb') as f:
-        f.seek(start)
+        if mmap and not write_to_stdout:
+            # read-only view onto the pages of the file (the mapping stays valid after the file is closed)
+            mm = _mmap(f.fileno(), 0, access=ACCESS_READ)
+            return memoryview(mm)[start:end]
         if write_to_stdout:
-            ii = start
-            while ii < end:
-                nn = min(end - ii, 4096)
-                data0 = f.read(nn)
-                ii = ii + nn
-                sys.stdout.buffer.write(data0)
+            sys.stdout.flush()
+            _copy_local_file_to_fd(local_fname, sys.stdout.fileno(), start=start, end=end)
             return None
-        else:
-            return f.read(end-start)
+        f.seek(start)
+        return f.read(end-start)
+
+# size of the buffer used when sendfile is not available for the output
+_STREAM_BUFFER_SIZE = 4 * 1024 * 1024
+
+def _copy_local_file_to_fd(local_fname: str, fd: int, *, start: Union[int, None]=None, end: Union[int, None]=None) -> None:
+    if start is None:
+        start = 0
+    if end is None:
+        end = os.path.getsize(local_fname)
+    with open(local_fname, 'rb') as f:
+        pos = start
+        if hasattr(os, 'sendfile'):
+            # let the kernel copy the data when writing to a pipe or a file
+            try:
+                while pos < end:
+                    n = os.sendfile(fd, f.fileno(), pos, min(end - pos, 0x7ffff000))
+                    if n == 0:
+                        raise Exception(f'Unexpected end of file: {local_fname}')
+                    pos = pos + n
+                return
+            except OSError as e:
+                # e.g., output is a terminal
+                if e.errno not in [errno.EINVAL, errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP]:
+                    raise
+        buf = memoryview(bytearray(min(_STREAM_BUFFER_SIZE, max(end - pos, 1))))
+        f.seek(pos)
+        while pos < end:
+            n = f.readinto(buf[:min(len(buf), end - pos)])
+            if not n:
+                raise Exception(f'Unexpected end of file: {local_fname}')
+            _write_all_to_fd(fd, buf[:n])
+            pos = pos + n
+
+def _write_all_to_fd(fd: int, data: memoryview) -> None:
+    while len(data) > 0:
+        n = os.write(fd, data)
+        data = data[n:]
 
 def _rename_file(path1: str, path2: str, remove_if_exists: bool) -> None:
     if os.path.abspath(path1) == os.path.abspath(path2):
@@ -210,7 +271,23 @@ def _rename_file(path1: str, path2: str, remove_if_exists: bool) -> None:
         else:
             raise Exception('Problem renaming file:: {} -> {}'.format(path1, path2))
 
-def _compute_local_file_sha1_and_manifest(path):
+# default number of threads used for hashing the chunks of a manifest
+_DEFAULT_NUM_HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+def _num_hash_workers() -> int:
+    # can be set with the KACHERY_NUM_HASH_WORKERS environment variable (1 means no thread pool)
+    x = os.getenv('KACHERY_NUM_HASH_WORKERS', None)
+    if not x:
+        return _DEFAULT_NUM_HASH_WORKERS
+    try:
+        num_workers = int(x)
+    except ValueError:
+        raise Exception(f'Invalid value for KACHERY_NUM_HASH_WORKERS: {x}')
+    if num_workers < 1:
+        raise Exception(f'Invalid value for KACHERY_NUM_HASH_WORKERS: {x}')
+    return num_workers
+
+def _compute_local_file_sha1_and_manifest(path, *, num_workers: Union[int, None]=None):
     algorithm = 'sha1'
     manifest = {
         'size': 0,
@@ -224,29 +301,70 @@ def _compute_local_file_sha1_and_manifest(path):
         print('Computing {} and manifest of {}'.format(algorithm, path))
 
     chunk_size = 20000000
+    if num_workers is None:
+        num_workers = _num_hash_workers()
 
+    if num_workers <= 1:
+        # hash in the calling thread, one chunk at a time
+        hashsum = getattr(hashlib, algorithm)()
+        with open(path, 'rb') as file:
+            pos = 0
+            while pos < size0:
+                this_chunk_size = min(chunk_size, size0 - pos)
+                this_chunk_hashsum = getattr(hashlib, algorithm)()
+                buf = file.read(this_chunk_size)
+                this_chunk_hashsum.update(buf)
+                hashsum.update(buf)
+                manifest['chunks'].append({
+                    'start': pos,
+                    'end': pos + this_chunk_size,
+                    'sha1': this_chunk_hashsum.hexdigest()
+                })
+                pos = pos + this_chunk_size
+        sha1 = hashsum.hexdigest()
+        manifest['sha1'] = sha1
+        manifest['size'] = size0
+        return sha1, manifest
+
+    # The chunk hashes are independent, so they are computed on a thread pool
+    # (hashlib releases the GIL for large buffers) while the whole-file hash is
+    # computed in order on a dedicated thread. The number of chunks in memory
+    # at any time is bounded.
     hashsum = getattr(hashlib, algorithm)()
-    with open(path, 'rb') as file:
-        pos = 0
-        while pos < size0:
-            
-            this_chunk_size = min(chunk_size, size0 - pos)
+    def _hash_chunk(buf: bytes) -> str:
+        h = getattr(hashlib, algorithm)()
+        h.update(buf)
+        return h.hexdigest()
+    max_chunks_in_flight = max(2, 2 * num_workers)
+    chunk_futures = []
+    with ThreadPoolExecutor(max_workers=1) as whole_file_executor, ThreadPoolExecutor(max_workers=num_workers) as chunk_executor:
+        in_flight = deque()
+        with open(path, 'rb') as file:
+            pos = 0
+            while pos < size0:
+                this_chunk_size = min(chunk_size, size0 - pos)
+                buf = file.read(this_chunk_size)
+                if len(buf) != this_chunk_size:
+                    raise Exception(f'Unexpected end of file: {path}')
+                while len(in_flight) >= max_chunks_in_flight:
+                    for f in in_flight.popleft():
+                        f.result()
+                # submitted in order to a single thread, so the whole-file hash is updated in order
+                f_whole = whole_file_executor.submit(hashsum.update, buf)
+                f_chunk = chunk_executor.submit(_hash_chunk, buf)
+                in_flight.append((f_whole, f_chunk))
+                chunk_futures.append((pos, pos + this_chunk_size, f_chunk))
+                pos = pos + this_chunk_size
+        while len(in_flight) > 0:
+            for f in in_flight.popleft():
+                f.result()
+        for start, end, f in chunk_futures:
+            manifest['chunks'].append({
+                'start': start,
+                'end': end,
+                'sha1': f.result()
+            })
 
-            this_chunk_hashsum = getattr(hashlib, algorithm)()
-            buf = file.read(this_chunk_size)
-            this_chunk_hashsum.update(buf)
-            
-            hashsum.update(buf)
-            
-            chunk = {
-                'start': pos,
-                'end': pos + this_chunk_size,
-                'sha1': this_chunk_hashsum.hexdigest()
-            }
-            manifest['chunks'].append(chunk)
-            
-            pos = pos + this_chunk_size
-            
     sha1 = hashsum.hexdigest()
     manifest['sha1'] = sha1
     manifest['size'] = size0
@@ -1,10 +1,16 @@
 import os
 import time
 import json
-from typing import Dict, Iterable, Optional, Tuple, Union
-from urllib.parse import parse_qs
+import socket
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlparse
 
+import requests
+from requests.adapters import HTTPAdapter
 from requests.models import Response
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
 
 def _parse_kachery_uri(uri: str) -> Tuple[str, str, str, str, dict]:
     listA = uri.split('?')
@@ -26,17 +32,125 @@ def _parse_kachery_uri(uri: str) -> Tuple[str, str, str, str, dict]:
         raise Exception('Unexpected protocol: {}'.format(protocol))
     return protocol, algorithm, hash0, additional_path, query
 
+# Number of keep-alive connections to the daemon kept open per process
+_HTTP_POOL_MAXSIZE = 16
+
+class _UnixSocketHTTPConnection(HTTPConnection):
+    def __init__(self, *args, socket_path: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self._socket_path)
+        return sock
+
+class _UnixSocketHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _UnixSocketHTTPConnection
+
+class _UnixSocketAdapter(HTTPAdapter):
+    # routes all requests through a single pool of connections to a unix domain socket
+    def __init__(self, socket_path: str, pool_maxsize: int):
+        super().__init__(pool_connections=1, pool_maxsize=pool_maxsize)
+        self._unix_pool = _UnixSocketHTTPConnectionPool('localhost', maxsize=pool_maxsize, socket_path=socket_path)
+
+    def get_connection(self, url, proxies=None):
+        return self._unix_pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self._unix_pool
+
+    def close(self):
+        self._unix_pool.close()
+        super().close()
+
+class _http_session_data:
+    lock = threading.Lock()
+    pid: Union[int, None] = None
+    key: Union[tuple, None] = None
+    session: Union[requests.Session, None] = None
+
+def _reset_http_session_after_fork():
+    # connections inherited from the parent must not be shared with the child
+    _http_session_data.lock = threading.Lock()
+    _http_session_data.pid = None
+    _http_session_data.key = None
+    _http_session_data.session = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_http_session_after_fork)
+
+def _http_session() -> requests.Session:
+    # process-wide keep-alive session for talking to the daemon
+    from ._daemon_connection import _api_host, _api_port, _api_socket_path # don't want circular dependencies
+    socket_path = _api_socket_path()
+    key = (socket_path, _api_host(), str(_api_port()))
+    with _http_session_data.lock:
+        session = _http_session_data.session
+        if (session is not None) and (_http_session_data.pid == os.getpid()) and (_http_session_data.key == key):
+            return session
+        if (session is not None) and (_http_session_data.pid == os.getpid()):
+            session.close()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_HTTP_POOL_MAXSIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if socket_path:
+            session.mount(f'http://{key[1]}:{key[2]}', _UnixSocketAdapter(socket_path, pool_maxsize=_HTTP_POOL_MAXSIZE))
+        _http_session_data.pid = os.getpid()
+        _http_session_data.key = key
+        _http_session_data.session = session
+        return session
+
+def _http_request(method: str, url: str, **kwargs) -> Response:
+    try:
+        return _http_session().request(method, url, **kwargs)
+    except requests.exceptions.ConnectionError:
+        # the daemon may have stopped, so the connection state must be revalidated
+        from ._daemon_connection import _mark_daemon_connection_states_stale # don't want circular dependencies
+        _mark_daemon_connection_states_stale()
+        raise
+
+_http_stats_lock = threading.Lock()
+_http_stats: Dict[str, dict] = {}
+
+def _record_http_call(url: str, elapsed_sec: float):
+    path = urlparse(url).path
+    with _http_stats_lock:
+        x = _http_stats.get(path, None)
+        if x is None:
+            x = dict(num_calls=0, total_elapsed_sec=0, max_elapsed_sec=0)
+            _http_stats[path] = x
+        x['num_calls'] += 1
+        x['total_elapsed_sec'] += elapsed_sec
+        x['max_elapsed_sec'] = max(x['max_elapsed_sec'], elapsed_sec)
+
+def _get_http_stats() -> Dict[str, dict]:
+    with _http_stats_lock:
+        ret = {}
+        for path, x in _http_stats.items():
+            ret[path] = dict(
+                num_calls=x['num_calls'],
+                total_elapsed_sec=x['total_elapsed_sec'],
+                mean_elapsed_sec=x['total_elapsed_sec'] / x['num_calls'],
+                max_elapsed_sec=x['max_elapsed_sec']
+            )
+        return ret
+
+def _reset_http_stats():
+    with _http_stats_lock:
+        _http_stats.clear()
+
 def _http_post_json(url: str, data: dict, verbose: Optional[bool] = None, headers: dict = {}) -> dict:
     timer = time.time()
     if verbose is None:
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
         print('_http_post_json::: ' + url)
-    try:
-        import requests
-    except:
-        raise Exception('Error importing requests *')
-    req = requests.post(url, json=data, headers=headers)
+    req = _http_request('POST', url, json=data, headers=headers)
+    _record_http_call(url, time.time() - timer)
     try:
         if req.status_code != 200:
             return dict(
@@ -56,34 +170,51 @@ def _http_post_json_receive_json_socket(url: str, data: dict, verbose: Optional[
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
         print('_http_post_json::: ' + url)
-    try:
-        import requests
-    except:
-        raise Exception('Error importing requests *')
-    req = requests.post(url, json=data, stream=True, headers=headers)
+    req = _http_request('POST', url, json=data, stream=True, headers=headers)
+    _record_http_call(url, time.time() - timer)
     if req.status_code != 200:
         raise Exception('Error posting json: {} {}'.format(req.status_code, req.content.decode('utf-8')))
-    class custom_iterator:
-        def __init__(self):
-            pass
-
-        def __iter__(self):
-            return self
-
-        def __next__(self):
-            buf = bytearray(b'')
-            while True:
-                c = req.raw.read(1)
-                if len(c) == 0:
-                    raise StopIteration
-                if c == b'#':
-                    size = int(buf)
-                    x = req.raw.read(size)
-                    obj = json.loads(x)
-                    return obj
-                else:
-                    buf.append(c[0])
-    return custom_iterator(), req
+    # for chunked responses this yields each block of data as soon as it arrives
+    return _iter_json_frames(req.iter_content(chunk_size=None)), req
+
+class _JsonFrameDecoder:
+    # Incremental decoder for the <size>#<json> framing used by json-socket on the daemon side.
+    # Incoming blocks are appended to a single buffer and complete frames are split out of it
+    # using bytearray.find, so there is no per-byte Python work
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    def feed(self, data: bytes) -> List[dict]:
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = self._pos
+        while True:
+            i = buf.find(b'#', pos)
+            if i < 0:
+                break
+            size = int(buf[pos:i])
+            end = i + 1 + size
+            if end > len(buf):
+                break
+            frames.append(json.loads(buf[i + 1:end]))
+            pos = end
+        if pos >= len(buf):
+            buf.clear()
+            pos = 0
+        elif pos > 65536:
+            # reclaim the consumed part of the buffer
+            del buf[:pos]
+            pos = 0
+        self._pos = pos
+        return frames
+
+def _iter_json_frames(blocks: Iterable[bytes]) -> Iterator[dict]:
+    decoder = _JsonFrameDecoder()
+    for block in blocks:
+        for frame in decoder.feed(block):
+            yield frame
 
 def _http_get_json(url: str, verbose: Optional[bool] = None, headers: dict = {}) -> dict:
     timer = time.time()
@@ -91,11 +222,8 @@ def _http_get_json(url: str, verbose: Optional[bool] = None, headers: dict = {})
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
         print('_http_get_json::: ' + url)
-    try:
-        import requests
-    except:
-        raise Exception('Error importing requests *')
-    req = requests.get(url, headers=headers)
+    req = _http_request('GET', url, headers=headers)
+    _record_http_call(url, time.time() - timer)
     try:
         if req.status_code != 200:
             return dict(
@@ -110,12 +238,10 @@ def _http_get_json(url: str, verbose: Optional[bool] = None, headers: dict = {})
         req.close()
 
 def _http_post_file(url: str, file_path: str, headers: dict = {}) -> dict:
-    try:
-        import requests
-    except:
-        raise Exception('Error importing requests *')
+    timer = time.time()
     with open(file_path, 'rb') as f:
-        req = requests.post(url, data=f, headers=headers)
+        req = _http_request('POST', url, data=f, headers=headers)
+    _record_http_call(url, time.time() - timer)
     try:
         if req.status_code != 200:
             raise Exception(f'Error posting file: {url} {file_path}')
@@ -123,6 +249,18 @@ def _http_post_file(url: str, file_path: str, headers: dict = {}) -> dict:
     finally:
         req.close()
 
+def _http_post_bytes(url: str, data: Union[bytes, bytearray, memoryview], headers: dict = {}) -> dict:
+    # the body is sent directly from memory
+    timer = time.time()
+    req = _http_request('POST', url, data=data, headers=headers)
+    _record_http_call(url, time.time() - timer)
+    try:
+        if req.status_code != 200:
+            raise Exception(f'Error posting data: {url}')
+        return json.loads(req.content)
+    finally:
+        req.close()
+
 def _create_file_key(*, sha1, query):
     file_key: Dict[str, Union[str, dict]] = dict(
         sha1=sha1
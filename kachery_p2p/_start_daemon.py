@@ -40,6 +40,7 @@ def start_daemon(*,
 
     api_port = _api_port()
     api_host = _api_host()
+    api_socket = os.getenv('KACHERY_P2P_API_SOCKET', '')
     config_dir = os.getenv('KACHERY_P2P_CONFIG_DIR', f'{pathlib.Path.home()}/.kachery-p2p')
 
     start_args = []
@@ -88,6 +89,7 @@ def start_daemon(*,
 
         export KACHERY_P2P_API_PORT="{api_port}"
         export KACHERY_P2P_API_HOST="{api_host}"
+        export KACHERY_P2P_API_SOCKET="{api_socket}"
         export KACHERY_P2P_CONFIG_DIR="{config_dir}"
         npm install -g -y {npm_package}
         '''
@@ -111,6 +113,7 @@ def start_daemon(*,
 
         export KACHERY_P2P_API_PORT="{api_port}"
         export KACHERY_P2P_API_HOST="{api_host}"
+        export KACHERY_P2P_API_SOCKET="{api_socket}"
         export KACHERY_P2P_CONFIG_DIR="{config_dir}"
         cd {thisdir}/../daemon
         # exec node_modules/ts-node/dist/bin.js {' '.join(node_arg)} ./src/cli.ts start {' '.join(start_args)}
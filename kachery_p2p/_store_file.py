@@ -1,18 +1,64 @@
+import hashlib
+import io
 import os
-from typing import Any, Union
-import subprocess
+import pickle
+from typing import Any, Dict, List, Tuple, Union
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import simplejson
 import numpy as np
 import stat
 import json
 from ._daemon_connection import _is_offline_mode, _is_online_mode, _kachery_storage_dir, _api_url
-from ._local_kachery_storage import _local_kachery_storage_store_file, _local_kachery_storage_link_file
-from ._misc import _http_post_json, _http_post_file
+from ._local_kachery_storage import _local_kachery_storage_load_file, _local_kachery_storage_store_bytes, _local_kachery_storage_store_file, _local_kachery_storage_link_file
+from ._misc import _http_post_bytes, _http_post_json, _http_post_file, _parse_kachery_uri
 from ._temporarydirectory import TemporaryDirectory
-from ._safe_pickle import _safe_pickle, _safe_unpickle
-from ._local_kachery_storage import _get_path_ext
+from ._safe_pickle import _check_safe_for_pickling, _safe_unpickle
+from ._local_kachery_storage import _get_path_ext, _get_file_hash_and_manifest_hash
+from ._hash_cache import _hash_cache_get, _hash_cache_set, _hash_cache_stat_key
 
-def _store_file(path: str, basename: Union[str, None]=None) -> str:
+# content up to this size is stored directly from memory by _store_bytes
+# (beyond this, a manifest is computed, which is done from a file)
+_STORE_FROM_MEMORY_MAX_SIZE = 20000000
+
+# files smaller than this are always hashed before uploading (cheaper than the upload)
+_PREFLIGHT_DIRECT_HASH_MAX_SIZE = 100000
+_PREFLIGHT_MODES = ('cache', 'hash', 'off')
+
+_store_stats_lock = threading.Lock()
+_store_stats = dict(num_uploads=0, num_bytes_uploaded=0, num_deduplicated=0, num_bytes_avoided=0, num_bulk_files=0, num_bulk_bytes=0, bulk_elapsed_sec=0.0)
+
+def _record_store(*, uploaded: bool, num_bytes: int) -> None:
+    with _store_stats_lock:
+        if uploaded:
+            _store_stats['num_uploads'] += 1
+            _store_stats['num_bytes_uploaded'] += num_bytes
+        else:
+            _store_stats['num_deduplicated'] += 1
+            _store_stats['num_bytes_avoided'] += num_bytes
+
+def _record_bulk_store(*, num_files: int, num_bytes: int, elapsed_sec: float) -> None:
+    with _store_stats_lock:
+        _store_stats['num_bulk_files'] += num_files
+        _store_stats['num_bulk_bytes'] += num_bytes
+        _store_stats['bulk_elapsed_sec'] += elapsed_sec
+
+def _get_store_stats() -> dict:
+    with _store_stats_lock:
+        ret = dict(_store_stats)
+    # aggregate throughput of _store_files
+    ret['bulk_bytes_per_sec'] = ret['num_bulk_bytes'] / ret['bulk_elapsed_sec'] if ret['bulk_elapsed_sec'] > 0 else 0
+    return ret
+
+def _reset_store_stats() -> None:
+    with _store_stats_lock:
+        for k in _store_stats.keys():
+            _store_stats[k] = 0
+
+def _store_file(path: str, basename: Union[str, None]=None, preflight: str='cache') -> str:
+    if preflight not in _PREFLIGHT_MODES:
+        raise Exception(f'Unexpected preflight mode: {preflight} (must be one of {", ".join(_PREFLIGHT_MODES)})')
     if basename is None:
         basename = os.path.basename(path)
     if _is_offline_mode():
@@ -23,12 +69,17 @@ def _store_file(path: str, basename: Union[str, None]=None) -> str:
             return f'sha1://{hash0}/{basename}?manifest={manifest_hash}'
     if not _is_online_mode():
         raise Exception('Not connected to daemon and not in offline mode.')
+    uri = _preflight_store_file(path, basename=basename, preflight=preflight)
+    if uri is not None:
+        return uri
     file_size = os.path.getsize(path)
+    stat_key = _hash_cache_stat_key(path)
     api_url, headers = _api_url()
     # url = f'{api_url}/storeFile'
     url = f'{api_url}/store'
     headers['Content-Length'] = f'{file_size}'
     resp = _http_post_file(url, os.path.abspath(path), headers=headers)
+    _record_store(uploaded=True, num_bytes=file_size)
 
     # resp = _http_post_json(url, {'localFilePath': os.path.abspath(path)}, headers=headers)
     if not resp['success']:
@@ -36,22 +87,92 @@ def _store_file(path: str, basename: Union[str, None]=None) -> str:
     sha1 = resp['sha1']
     manifest_sha1 = resp['manifestSha1']
 
-    # important to verify that we can access the file
-    # this is crucial for systems where the daemon is running on a different computer
-    # in frank lab there was an issue where we needed to stat the file before proceeding
-    sha1_directory = f'{_kachery_storage_dir()}/sha1'
-    path0 = _get_path_ext(hash=sha1, create=False, directory=sha1_directory)
-    if not os.path.exists(path0):
-        raise Exception(f'Unexpected, could not find stored file after storing with daemon: {path0}')
+    _check_stored_file(sha1=sha1, size=file_size, source=path)
+    if file_size >= _PREFLIGHT_DIRECT_HASH_MAX_SIZE:
+        # so that storing the unchanged file again does not transfer it
+        _hash_cache_set(path, stat_key=stat_key, sha1=sha1, manifest_sha1=manifest_sha1)
 
-    size0 = _get_file_size_using_system_call(path0)
-    if size0 != file_size:
-        if size0 == 0:
-            # perhaps the file has not synced across devices
-            raise Exception(f'Inconsistent size between stored file and original file for: {path} {path0} {file_size} {size0}')
-        else:
-            raise Exception(f'Unexpected size discrepancy between stored file and original file for: {path} {path0} {file_size} {size0}')
+    if manifest_sha1:
+        return f'sha1://{sha1}/{basename}?manifest={manifest_sha1}'
+    else:
+        return f'sha1://{sha1}/{basename}'
 
+def _store_files(paths: List[str], *, workers: int=4, preflight: str='hash') -> Dict[str, str]:
+    # The files are hashed and uploaded concurrently: hashlib releases the GIL,
+    # and the uploads share the pooled keep-alive connections to the daemon
+    if preflight not in _PREFLIGHT_MODES:
+        raise Exception(f'Unexpected preflight mode: {preflight} (must be one of {", ".join(_PREFLIGHT_MODES)})')
+    paths = list(dict.fromkeys(paths))
+    timer = time.time()
+    num_bytes = sum([os.stat(path).st_size for path in paths])
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [(path, executor.submit(_store_file, path, None, preflight)) for path in paths]
+        ret = {path: f.result() for path, f in futures}
+    _record_bulk_store(num_files=len(paths), num_bytes=num_bytes, elapsed_sec=time.time() - timer)
+    return ret
+
+def _store_dir(path: str, *, workers: int=4, preflight: str='hash') -> str:
+    # Store all files in a directory tree, and return a sha1dir:// URI of the index
+    # (the format understood by _resolve_file_uri_from_dir_uri)
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        raise Exception(f'Not a directory: {path}')
+    file_paths: List[str] = []
+    # symlinked subdirectories are followed, except for links back to a directory
+    # that is being walked (which would recurse forever)
+    real_ancestors: Dict[str, Tuple[str, ...]] = {path: ()}
+    for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+        chain = real_ancestors.pop(dirpath) + (os.path.realpath(dirpath),)
+        dirnames[:] = sorted([d for d in dirnames if os.path.realpath(os.path.join(dirpath, d)) not in chain])
+        for d in dirnames:
+            real_ancestors[os.path.join(dirpath, d)] = chain
+        for filename in sorted(filenames):
+            file_paths.append(os.path.join(dirpath, filename))
+    uris = _store_files(file_paths, workers=workers, preflight=preflight)
+    index: dict = dict(files=dict(), dirs=dict())
+    for file_path in file_paths:
+        relpath = os.path.relpath(file_path, path)
+        parts = relpath.split(os.sep)
+        dd = index
+        for part in parts[:-1]:
+            if part not in dd['dirs']:
+                dd['dirs'][part] = dict(files=dict(), dirs=dict())
+            dd = dd['dirs'][part]
+        protocol, algorithm, hash0, additional_path, query = _parse_kachery_uri(uris[file_path])
+        entry = dict(size=os.stat(file_path).st_size, sha1=hash0)
+        if 'manifest' in query:
+            entry['manifestSha1'] = query['manifest'][0]
+        dd['files'][parts[-1]] = entry
+    index_uri = _store_json(index, basename='dir.json')
+    protocol, algorithm, index_hash, additional_path, query = _parse_kachery_uri(index_uri)
+    return f'sha1dir://{index_hash}.{os.path.basename(path)}'
+
+def _preflight_store_file(path: str, *, basename: str, preflight: str) -> Union[str, None]:
+    # Returns the URI if the content of the file is already in the local storage, in which case nothing needs to be transferred
+    # preflight='cache': only use a hash that is cached for the (unchanged) file
+    # preflight='hash': compute the hash (and manifest) if it is not cached
+    # preflight='off': always transfer the file
+    if preflight == 'off':
+        return None
+    file_size = os.path.getsize(path)
+    if (preflight == 'hash') or (file_size < _PREFLIGHT_DIRECT_HASH_MAX_SIZE):
+        sha1, manifest_sha1 = _get_file_hash_and_manifest_hash(path)
+    elif preflight == 'cache':
+        cached = _hash_cache_get(path)
+        if cached is None:
+            return None
+        sha1, manifest_sha1 = cached
+    else:
+        raise Exception(f'Unexpected preflight mode: {preflight}')
+    if (file_size > _STORE_FROM_MEMORY_MAX_SIZE) and (manifest_sha1 is None):
+        return None
+    if (manifest_sha1 is not None) and (_local_kachery_storage_load_file(sha1_hash=manifest_sha1) is None):
+        return None
+    # a linked file does not count, since it may change or disappear
+    path0 = _get_path_ext(hash=sha1, create=False, directory=f'{_kachery_storage_dir()}/sha1')
+    if (not os.path.exists(path0)) or (os.path.getsize(path0) != file_size):
+        return None
+    _record_store(uploaded=False, num_bytes=file_size)
     if manifest_sha1:
         return f'sha1://{sha1}/{basename}?manifest={manifest_sha1}'
     else:
@@ -107,8 +228,63 @@ def _link_file(path: str, basename: Union[str, None]=None) -> str:
     else:
         return f'sha1://{sha1}/{basename}'
 
+def _check_stored_file(*, sha1: str, size: int, source: str) -> None:
+    # important to verify that we can access the file
+    # this is crucial for systems where the daemon is running on a different computer
+    # in frank lab there was an issue where we needed to stat the file before proceeding
+    sha1_directory = f'{_kachery_storage_dir()}/sha1'
+    path0 = _get_path_ext(hash=sha1, create=False, directory=sha1_directory)
+    if not os.path.exists(path0):
+        raise Exception(f'Unexpected, could not find stored file after storing with daemon: {path0}')
+
+    size0 = _get_file_size_using_system_call(path0)
+    if size0 != size:
+        if size0 == 0:
+            # perhaps the file has not synced across devices
+            raise Exception(f'Inconsistent size between stored file and original file for: {source} {path0} {size} {size0}')
+        else:
+            raise Exception(f'Unexpected size discrepancy between stored file and original file for: {source} {path0} {size} {size0}')
+
+def _store_bytes(data: Union[bytes, bytearray, memoryview], basename: str) -> str:
+    # Store data that is already in memory, without the round trip through a temporary file.
+    # The sha1 is computed here, and nothing is uploaded if the content is already in the local storage.
+    data = memoryview(data)
+    if data.nbytes > _STORE_FROM_MEMORY_MAX_SIZE:
+        # large content gets a manifest, which is computed from a file
+        with TemporaryDirectory() as tmpdir:
+            fname = tmpdir + '/data.dat'
+            with open(fname, 'wb') as f:
+                f.write(data)
+            _add_read_permissions(tmpdir)
+            _add_exec_permissions(tmpdir)
+            _add_read_permissions(fname)
+            return _store_file(fname, basename=basename)
+    sha1 = hashlib.sha1(data).hexdigest()
+    if _is_offline_mode():
+        _local_kachery_storage_store_bytes(data=data, sha1_hash=sha1)
+        return f'sha1://{sha1}/{basename}'
+    if not _is_online_mode():
+        raise Exception('Not connected to daemon and not in offline mode.')
+    # a linked file does not count, since it may change or disappear
+    path0 = _get_path_ext(hash=sha1, create=False, directory=f'{_kachery_storage_dir()}/sha1')
+    if os.path.exists(path0) and (os.path.getsize(path0) == data.nbytes):
+        _record_store(uploaded=False, num_bytes=data.nbytes)
+    else:
+        api_url, headers = _api_url()
+        url = f'{api_url}/store'
+        headers['Content-Length'] = f'{data.nbytes}'
+        resp = _http_post_bytes(url, data, headers=headers)
+        _record_store(uploaded=True, num_bytes=data.nbytes)
+        if not resp['success']:
+            raise Exception(f'Problem storing data: {resp["error"]}')
+        if resp['sha1'] != sha1:
+            raise Exception(f'Unexpected sha1 of stored data: {resp["sha1"]} <> {sha1}')
+        _check_stored_file(sha1=sha1, size=data.nbytes, source=basename)
+    return f'sha1://{sha1}/{basename}'
+
 def _get_file_size_using_system_call(path: str):
-    return int(subprocess.check_output(['stat', '-c%s', path]))
+    # a fresh stat of the file (not a cached size), without spawning a process
+    return os.stat(path).st_size
 
 def _add_read_permissions(fname: str):
     st = os.stat(fname)
@@ -121,14 +297,7 @@ def _add_exec_permissions(fname: str):
 def _store_text(text: str, basename: Union[str, None]=None) -> str:
     if basename is None:
         basename = 'file.txt'
-    with TemporaryDirectory() as tmpdir:
-        fname = tmpdir + '/text.txt'
-        with open(fname, 'w') as f:
-            f.write(text)
-        _add_read_permissions(tmpdir)
-        _add_exec_permissions(tmpdir)
-        _add_read_permissions(fname)
-        return _store_file(fname, basename=basename)
+    return _store_bytes(text.encode('utf-8'), basename=basename)
 
 def _store_json(object: dict, basename: Union[str, None]=None, separators=(',', ':'), indent=None) -> str:
     if basename is None:
@@ -139,21 +308,22 @@ def _store_json(object: dict, basename: Union[str, None]=None, separators=(',',
 def _store_npy(array: np.ndarray, basename: Union[str, None]=None) -> str:
     if basename is None:
         basename = 'file.npy'
-    with TemporaryDirectory() as tmpdir:
-        fname = tmpdir + '/array.npy'
-        np.save(fname, array, allow_pickle=False)
-        _add_read_permissions(tmpdir)
-        _add_exec_permissions(tmpdir)
-        _add_read_permissions(fname)
-        return _store_file(fname, basename=basename)
+    if array.nbytes > _STORE_FROM_MEMORY_MAX_SIZE:
+        # avoid an in-memory copy of a large array
+        with TemporaryDirectory() as tmpdir:
+            fname = tmpdir + '/array.npy'
+            np.save(fname, array, allow_pickle=False)
+            _add_read_permissions(tmpdir)
+            _add_exec_permissions(tmpdir)
+            _add_read_permissions(fname)
+            return _store_file(fname, basename=basename)
+    buf = io.BytesIO()
+    np.save(buf, array, allow_pickle=False)
+    return _store_bytes(buf.getbuffer(), basename=basename)
 
 def _store_pkl(x: Any, basename: Union[str, None]=None) -> str:
     if basename is None:
         basename = 'file.pkl'
-    with TemporaryDirectory() as tmpdir:
-        fname = tmpdir + '/array.pkl'
-        _safe_pickle(fname, x)
-        _add_read_permissions(tmpdir)
-        _add_exec_permissions(tmpdir)
-        _add_read_permissions(fname)
-        return _store_file(fname, basename=basename)
\ No newline at end of file
+    # same as _safe_pickle, but into memory
+    _check_safe_for_pickling(x)
+    return _store_bytes(pickle.dumps(x), basename=basename)
@@ -1,10 +1,10 @@
 import json
-import os
 import sys
 from typing import Any, List, Union, cast
 
 import click
 import kachery_p2p as kp
+from ._hash_cache import _hash_cache_prune
 
 
 @click.group(help="Kachery peer-to-peer command-line client")
@@ -137,6 +137,11 @@ def link_file(path: str):
     x = kp.link_file(path)
     print(x)
 
+@click.command(help="Remove stale entries from the local file hash cache.")
+def prune_hash_cache():
+    num_removed, num_remaining = _hash_cache_prune()
+    print(f'Removed {num_removed} entries; {num_remaining} entries remain in the hash cache')
+
 @click.command(help="Download a file and write the content to stdout.")
 @click.argument('uri')
 @click.option('--start', help='The start byte (optional)', default=None)
@@ -149,26 +154,16 @@ def cat_file(uri, start, end, exp_nop2p, exp_file_server_url):
 
     kp._experimental_config(nop2p=exp_nop2p, file_server_urls=list(exp_file_server_url))
 
-    if start is None and end is None:
-        path1 = kp.load_file(uri)
-        if not path1:
-            raise Exception('Error loading file for cat.')
-        sys.stdout = old_stdout
-        with open(path1, 'rb') as f:
-            while True:
-                data = os.read(f.fileno(), 4096)
-                if len(data) == 0:
-                    break
-                os.write(sys.stdout.fileno(), data)
-    else:
+    if start is not None or end is not None:
         assert start is not None and end is not None
         start = int(start)
         end = int(end)
         assert start <= end
         if start == end:
             return
-        sys.stdout = old_stdout
-        kp.load_bytes(uri=uri, start=start, end=end, write_to_stdout=True)
+    # progress messages continue to go to stderr while the data is streamed to stdout
+    old_stdout.flush()
+    kp.write_bytes_to_fd(uri, old_stdout.fileno(), start=start, end=end)
 
 @click.command(help="Print messages in a subfeed.")
 @click.argument('uri')
@@ -235,6 +230,7 @@ cli.add_command(store_file)
 cli.add_command(link_file)
 cli.add_command(node_info)
 cli.add_command(print_messages)
+cli.add_command(prune_hash_cache)
 cli.add_command(start_daemon)
 cli.add_command(stop_daemon)
 cli.add_command(version)
\ No newline at end of file
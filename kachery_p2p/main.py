@@ -1,4 +1,4 @@
-from typing import Any, Dict, Iterable, List, Union
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
 
 import numpy as np
 
@@ -6,9 +6,10 @@ from ._core2 import (_find_file, _get_channels, _get_node_id)
 from ._feeds import (_create_feed, _delete_feed, _get_feed_id, _load_feed,
                      _load_subfeed, _watch_for_new_messages)
 from ._mutables import (_get, _set, _delete)
+from ._misc import _get_http_stats, _reset_http_stats
 
-from ._load_file import _load_file, _load_bytes, _load_text, _load_json, _load_npy, _load_pkl
-from ._store_file import _store_file, _store_text, _store_json, _store_npy, _store_pkl, _link_file
+from ._load_file import _load_file, _load_files, _iter_load_files, _load_bytes, _write_bytes_to_fd, _load_text, _load_json, _load_npy, _load_pkl, _object_cache
+from ._store_file import _store_file, _store_files, _store_dir, _store_text, _store_json, _store_npy, _store_pkl, _link_file, _get_store_stats, _reset_store_stats
 
 def load_file(
     uri: str,
@@ -31,7 +32,55 @@ def load_file(
     """
     return _load_file(uri=uri, dest=dest, p2p=p2p, from_node=from_node, from_channel=from_channel)
 
-def load_bytes(uri: str, start: int, end: int, write_to_stdout=False, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[bytes, None]:
+def load_files(
+    uris: Iterable[str],
+    max_concurrency: int=20,
+    p2p: bool=True,
+    from_node: Union[str, None]=None,
+    from_channel: Union[str, None]=None
+) -> Dict[str, Union[str, None]]:
+    """Load a batch of files either from local kachery storage or from remote kachery nodes
+
+    All files that are not found locally are requested from the daemon at once
+    and the daemon downloads up to max_concurrency of them simultaneously.
+    See iter_load_files for receiving each result as soon as it is available.
+
+    Args:
+        uris (Iterable[str]): The kachery URIs for the files to load: sha1://...
+        max_concurrency (int, optional): Maximum number of files loaded simultaneously by the daemon. Defaults to 20.
+        p2p (bool, optional): Whether to search remote nodes. Defaults to True.
+        from_node (Union[str, None], optional): Optionally specify which remote node to load from. Defaults to None.
+        from_channel (Union[str, None], optional): Optionally specify which channel to load from. Defaults to None.
+
+    Returns:
+        Dict[str, Union[str, None]]: Mapping from each URI to the local path of the loaded file (None if not found)
+    """
+    return _load_files(uris=uris, max_concurrency=max_concurrency, p2p=p2p, from_node=from_node, from_channel=from_channel)
+
+def iter_load_files(
+    uris: Iterable[str],
+    max_concurrency: int=20,
+    p2p: bool=True,
+    from_node: Union[str, None]=None,
+    from_channel: Union[str, None]=None
+) -> Iterator[Tuple[str, Union[str, None]]]:
+    """Load a batch of files, yielding the result for each file as soon as it is available
+
+    Same as load_files, except that the results are yielded in order of completion.
+
+    Args:
+        uris (Iterable[str]): The kachery URIs for the files to load: sha1://...
+        max_concurrency (int, optional): Maximum number of files loaded simultaneously by the daemon. Defaults to 20.
+        p2p (bool, optional): Whether to search remote nodes. Defaults to True.
+        from_node (Union[str, None], optional): Optionally specify which remote node to load from. Defaults to None.
+        from_channel (Union[str, None], optional): Optionally specify which channel to load from. Defaults to None.
+
+    Yields:
+        Tuple[str, Union[str, None]]: The URI and the local path of the loaded file (None if not found)
+    """
+    return _iter_load_files(uris=uris, max_concurrency=max_concurrency, p2p=p2p, from_node=from_node, from_channel=from_channel)
+
+def load_bytes(uri: str, start: int, end: int, write_to_stdout=False, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None, mmap: bool=False) -> Union[bytes, bytearray, memoryview, None]:
     """Load a subset of bytes from a file in local storage or from remote nodes in the kachery network
 
     Args:
@@ -41,11 +90,12 @@ def load_bytes(uri: str, start: int, end: int, write_to_stdout=False, p2p: bool=
         p2p (bool, optional): Whether to search remote nodes. Defaults to True.
         from_node (Union[str, None], optional): Optionally specify which remote node to load from. Defaults to None.
         from_channel (Union[str, None], optional): Optionally specify which kachery channel to search. Defaults to None.
+        mmap (bool, optional): Return a read-only memoryview onto a memory map of the stored file instead of reading the bytes into memory. Defaults to False.
 
     Returns:
-        Union[bytes, None]: The bytes if found, else None
+        Union[bytes, bytearray, memoryview, None]: The bytes if found, else None
     """
-    return _load_bytes(uri=uri, start=start, end=end, write_to_stdout=write_to_stdout, p2p=p2p, from_node=from_node, from_channel=from_channel)
+    return _load_bytes(uri=uri, start=start, end=end, write_to_stdout=write_to_stdout, p2p=p2p, from_node=from_node, from_channel=from_channel, mmap=mmap)
 
 def find_file(uri: str, timeout_sec: float=5) -> Iterable[dict]:
     """Find a file on the kachery-p2p network
@@ -85,6 +135,26 @@ def load_json(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_c
     """
     return _load_json(uri=uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
 
+def write_bytes_to_fd(uri: str, fd: int, start: Union[int, None]=None, end: Union[int, None]=None, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> None:
+    """Write the content of a file (or a subset of its bytes) to a file descriptor, e.g., the fileno() of stdout
+
+    The data is streamed without loading the whole file into memory. For a file with a
+    manifest, each chunk is written as soon as it and all of the preceding chunks are loaded.
+
+    Args:
+        uri (str): The URI of the file
+        fd (int): The file descriptor to write to
+        start (Union[int, None], optional): The start byte. Defaults to None (start of the file).
+        end (Union[int, None], optional): The end byte (non-inclusive). Defaults to None (end of the file).
+        p2p (bool, optional): Whether to search remote nodes. Defaults to True.
+        from_node (Union[str, None], optional): Optionally specify which remote node to load from. Defaults to None.
+        from_channel (Union[str, None], optional): Optionally specify which channel to load from. Defaults to None.
+
+    Raises:
+        LoadFileError: If the file could not be loaded
+    """
+    _write_bytes_to_fd(uri=uri, fd=fd, start=start, end=end, p2p=p2p, from_node=from_node, from_channel=from_channel)
+
 def load_object(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[dict, None]:
     """Load an object (Python dict) either from local kachery storage or from a remote kachery node
 
@@ -114,7 +184,7 @@ def load_text(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_c
     """
     return _load_text(uri=uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
 
-def load_npy(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[np.ndarray, None]:
+def load_npy(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None, mmap_mode: Union[str, None]=None) -> Union[np.ndarray, None]:
     """Load a Numpy array either from local kachery storage or from a remote kachery node
 
     Args:
@@ -122,11 +192,12 @@ def load_npy(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_ch
         p2p (bool, optional): Whether to search remote nodes. Defaults to True.
         from_node (Union[str, None], optional): Optionally specify which remote node to load from. Defaults to None.
         from_channel (Union[str, None], optional): Optionally specify which kachery channel to search. Defaults to None.
+        mmap_mode (Union[str, None], optional): If 'r' (read-only) or 'c' (copy-on-write), memory-map the stored file in place rather than reading it into RAM (see numpy.load). Writable modes are not allowed. Defaults to None.
 
     Returns:
         Union[str, None]: If found, the Numpy array, else None
     """
-    return _load_npy(uri=uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
+    return _load_npy(uri=uri, p2p=p2p, from_node=from_node, from_channel=from_channel, mmap_mode=mmap_mode)
 
 def load_pkl(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_channel: Union[str, None]=None) -> Union[Any, None]:
     """Load a Python item from a restricted pickle format either from local kachery storage or from a remote kachery node
@@ -142,17 +213,53 @@ def load_pkl(uri: str, p2p: bool=True, from_node: Union[str, None]=None, from_ch
     """
     return _load_pkl(uri=uri, p2p=p2p, from_node=from_node, from_channel=from_channel)
 
-def store_file(path: str, basename: Union[str, None]=None) -> str:
+def store_file(path: str, basename: Union[str, None]=None, preflight: str='cache') -> str:
     """Store file in the local kachery storage (will therefore be available on the kachery network) and return a kachery URI
 
+    Before transferring the file to the daemon, checks whether its content is already in the local storage.
+
     Args:
         path (str): Path of the file to store
         basename (Union[str, None], optional): Optional base file name to append to the sha1:// URI. Defaults to None.
+        preflight (str, optional): How to check for existing content: 'cache' (use the cached hash of the unchanged file, if any), 'hash' (compute the hash if not cached), or 'off'. Defaults to 'cache'.
 
     Returns:
         str: The kachery URI: sha1://...
     """
-    return _store_file(path=path, basename=basename)
+    return _store_file(path=path, basename=basename, preflight=preflight)
+
+def store_files(paths: List[str], workers: int=4, preflight: str='hash') -> Dict[str, str]:
+    """Store many files in the local kachery storage, hashing and uploading them concurrently
+
+    Args:
+        paths (List[str]): Paths of the files to store
+        workers (int, optional): Number of files processed at the same time. Defaults to 4.
+        preflight (str, optional): How to check for content that is already stored (see store_file). Defaults to 'hash'.
+
+    Returns:
+        Dict[str, str]: The kachery URI (sha1://...) for each path
+    """
+    return _store_files(paths, workers=workers, preflight=preflight)
+
+def store_dir(path: str, workers: int=4, preflight: str='hash') -> str:
+    """Store all the files of a directory tree in the local kachery storage and return a kachery URI of the directory
+
+    The files of the directory can be loaded using URIs of the form sha1dir://.../subdir/file.txt
+    Symbolic links to files and directories are followed, except for links to a directory
+    that contains the link (which would recurse forever).
+
+    Args:
+        path (str): Path of the directory to store
+        workers (int, optional): Number of files processed at the same time. Defaults to 4.
+        preflight (str, optional): How to check for content that is already stored (see store_file). Defaults to 'hash'.
+
+    Returns:
+        str: The kachery URI: sha1dir://...
+
+    Raises:
+        Exception: If path is not a directory
+    """
+    return _store_dir(path, workers=workers, preflight=preflight)
 
 def link_file(path: str, basename: Union[str, None]=None) -> str:
     """Link a local file in the local kachery storage (will therefore be available on the kachery network) and return a kachery URI
@@ -238,6 +345,67 @@ def get_node_id(api_port=None) -> str:
     """
     return _get_node_id(api_port=api_port)
 
+def get_http_stats(reset: bool=False) -> Dict[str, dict]:
+    """Return per-endpoint latency counters for the calls made to the daemon API from this process
+
+    Args:
+        reset (bool, optional): Whether to reset the counters after reading them. Defaults to False.
+
+    Returns:
+        Dict[str, dict]: For each API path, the num_calls, total_elapsed_sec, mean_elapsed_sec and max_elapsed_sec
+    """
+    ret = _get_http_stats()
+    if reset:
+        _reset_http_stats()
+    return ret
+
+def configure_load_cache(max_entries: int, max_bytes: int) -> None:
+    """Set the bounds of the in-process cache used by load_json, load_text and load_pkl
+
+    The cache is disabled by default. Only sha1:// URIs are cached. Callers always receive
+    a copy of the cached object, so mutating a loaded object never affects later loads, but
+    the cached objects are kept in memory (up to max_bytes) for the life of the process.
+
+    Args:
+        max_entries (int): Maximum number of cached objects. Use 0 to disable the cache (the default).
+        max_bytes (int): Maximum total size (of the underlying files) of the cached objects
+    """
+    _object_cache.configure(max_entries=max_entries, max_bytes=max_bytes)
+
+def clear_load_cache() -> None:
+    """Remove all objects from the in-process cache used by load_json, load_text and load_pkl
+    """
+    _object_cache.clear()
+
+def get_load_cache_stats(reset: bool=False) -> dict:
+    """Return the statistics of the in-process cache used by load_json, load_text and load_pkl
+
+    Args:
+        reset (bool, optional): Whether to reset the hit/miss/eviction counters after reading them. Defaults to False.
+
+    Returns:
+        dict: hits, misses, evictions, num_entries, num_bytes, max_entries and max_bytes
+    """
+    ret = _object_cache.get_stats()
+    if reset:
+        _object_cache.reset_stats()
+    return ret
+
+def get_store_stats(reset: bool=False) -> dict:
+    """Return counters for the content stored from this process, including transfers avoided because the content was already stored
+
+    Args:
+        reset (bool, optional): Whether to reset the counters after reading them. Defaults to False.
+
+    Returns:
+        dict: num_uploads, num_bytes_uploaded, num_deduplicated and num_bytes_avoided, and for store_files/store_dir,
+            num_bulk_files, num_bulk_bytes, bulk_elapsed_sec and bulk_bytes_per_sec
+    """
+    ret = _get_store_stats()
+    if reset:
+        _reset_store_stats()
+    return ret
+
 ################################################
 
 def create_feed(feed_name: Union[str, None]=None):
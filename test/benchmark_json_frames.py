@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# Compare frames/sec of the buffered json-socket frame decoder against
+# the previous iterator that read the <size># header one byte at a time
+
+import json
+import time
+
+from kachery_p2p._misc import _iter_json_frames
+from kachery_p2p._temporarydirectory import TemporaryDirectory
+
+
+def main():
+    num_frames = 200000
+    data = _create_stream(num_frames)
+    print(f'Stream of {num_frames} frames ({len(data)} bytes)')
+
+    with TemporaryDirectory() as tmpdir:
+        fname = tmpdir + '/stream.dat'
+        with open(fname, 'wb') as f:
+            f.write(data)
+
+        # unbuffered reads, so that each read is a system call (as with the response socket)
+        timer = time.time()
+        with open(fname, 'rb', buffering=0) as raw:
+            n = sum(1 for _ in _legacy_iter_json_frames(raw))
+        assert n == num_frames
+        elapsed_legacy = time.time() - timer
+        print(f'Per-byte iterator: {num_frames / elapsed_legacy:.0f} frames/sec')
+
+        timer = time.time()
+        with open(fname, 'rb', buffering=0) as raw:
+            n = sum(1 for _ in _iter_json_frames(_blocks(raw, 65536)))
+        assert n == num_frames
+        elapsed = time.time() - timer
+    print(f'Buffered decoder:  {num_frames / elapsed:.0f} frames/sec')
+    print(f'Speedup: {elapsed_legacy / elapsed:.1f}x')
+
+def _create_stream(num_frames: int) -> bytes:
+    parts = []
+    for ii in range(num_frames):
+        x = json.dumps({'type': 'progress', 'bytesLoaded': ii * 1000, 'bytesTotal': num_frames * 1000, 'nodeId': None}).encode('utf-8')
+        parts.append(f'{len(x)}#'.encode('utf-8') + x)
+    return b''.join(parts)
+
+def _blocks(raw, block_size: int):
+    while True:
+        x = raw.read(block_size)
+        if len(x) == 0:
+            return
+        yield x
+
+def _legacy_iter_json_frames(raw):
+    while True:
+        buf = bytearray(b'')
+        while True:
+            c = raw.read(1)
+            if len(c) == 0:
+                return
+            if c == b'#':
+                size = int(buf)
+                x = raw.read(size)
+                yield json.loads(x)
+                break
+            else:
+                buf.append(c[0])
+
+if __name__ == '__main__':
+    main()
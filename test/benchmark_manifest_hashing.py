@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Throughput of computing the sha1 and manifest of a large file
+# with the original sequential loop vs. the parallel chunk hashing
+
+import hashlib
+import os
+import sys
+import time
+
+from kachery_p2p._local_kachery_storage import _compute_local_file_sha1_and_manifest, _DEFAULT_NUM_HASH_WORKERS
+from kachery_p2p._temporarydirectory import TemporaryDirectory
+
+
+def _compute_sha1_and_manifest_sequential(path):
+    # the implementation before the chunks were hashed on a thread pool
+    chunk_size = 20000000
+    size0 = os.path.getsize(path)
+    manifest = {
+        'size': size0,
+        'sha1': '',
+        'chunks': []
+    }
+    hashsum = hashlib.sha1()
+    with open(path, 'rb') as file:
+        pos = 0
+        while pos < size0:
+            this_chunk_size = min(chunk_size, size0 - pos)
+            this_chunk_hashsum = hashlib.sha1()
+            buf = file.read(this_chunk_size)
+            this_chunk_hashsum.update(buf)
+            hashsum.update(buf)
+            manifest['chunks'].append({
+                'start': pos,
+                'end': pos + this_chunk_size,
+                'sha1': this_chunk_hashsum.hexdigest()
+            })
+            pos = pos + this_chunk_size
+    sha1 = hashsum.hexdigest()
+    manifest['sha1'] = sha1
+    return sha1, manifest
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with TemporaryDirectory() as tmpdir:
+        fname = tmpdir + '/file.dat'
+        with open(fname, 'wb') as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1000000))
+        print(f'File size: {size_mb} MB')
+
+        timer = time.time()
+        expected = _compute_sha1_and_manifest_sequential(fname)
+        elapsed = time.time() - timer
+        print(f'sequential (original): {size_mb / elapsed:.1f} MB/sec')
+
+        for num_workers in sorted(set([1, 2, _DEFAULT_NUM_HASH_WORKERS])):
+            timer = time.time()
+            result = _compute_local_file_sha1_and_manifest(fname, num_workers=num_workers)
+            elapsed = time.time() - timer
+            print(f'num_workers={num_workers}: {size_mb / elapsed:.1f} MB/sec')
+            # must give the same result as the original implementation
+            assert result == expected
+
+if __name__ == '__main__':
+    main()
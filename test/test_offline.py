@@ -0,0 +1,380 @@
+import os
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def storage_dir(tmp_path, monkeypatch):
+    # offline mode: no daemon, files are stored directly in this directory
+    d = tmp_path / 'storage'
+    d.mkdir()
+    monkeypatch.setenv('KACHERY_OFFLINE_STORAGE_DIR', str(d))
+    return str(d)
+
+def test_load_npy_mmap_mode(storage_dir):
+    import kachery_p2p as kp
+    uri = kp.store_npy(np.arange(5))
+    with pytest.raises(Exception):
+        kp.load_npy(uri, mmap_mode='r+')
+    with pytest.raises(Exception):
+        kp.load_npy(uri, mmap_mode='w+')
+    x = kp.load_npy(uri, mmap_mode='c')
+    x[0] = 999
+    assert kp.load_npy(uri, mmap_mode='r').tolist() == [0, 1, 2, 3, 4]
+    assert kp.load_npy(uri).tolist() == [0, 1, 2, 3, 4]
+
+def test_hash_cache_invalidation(storage_dir, tmp_path):
+    from kachery_p2p._hash_cache import _hash_cache_get, _hash_cache_set, _hash_cache_stat_key
+    path = str(tmp_path / 'file.dat')
+    with open(path, 'wb') as f:
+        f.write(b'abc')
+    _hash_cache_set(path, stat_key=_hash_cache_stat_key(path), sha1='sha1-a', manifest_sha1='manifest-a')
+    assert _hash_cache_get(path) == ('sha1-a', 'manifest-a')
+    # recording the hash without a manifest keeps the manifest of the same content
+    _hash_cache_set(path, stat_key=_hash_cache_stat_key(path), sha1='sha1-a', manifest_sha1=None)
+    assert _hash_cache_get(path) == ('sha1-a', 'manifest-a')
+    # a change of mtime invalidates the entry
+    s = os.stat(path)
+    os.utime(path, ns=(s.st_atime_ns, s.st_mtime_ns + 1000000000))
+    assert _hash_cache_get(path) is None
+    _hash_cache_set(path, stat_key=_hash_cache_stat_key(path), sha1='sha1-a', manifest_sha1=None)
+    assert _hash_cache_get(path) == ('sha1-a', None)
+    # so does a change of size
+    with open(path, 'ab') as f:
+        f.write(b'def')
+    assert _hash_cache_get(path) is None
+
+def test_hash_cache_used_for_file_hash(storage_dir, tmp_path):
+    from kachery_p2p._hash_cache import _hash_cache_get
+    import kachery_p2p as kp
+    path = str(tmp_path / 'file.dat')
+    with open(path, 'wb') as f:
+        f.write(b'x' * 200000)
+    uri = kp.store_file(path)
+    assert _hash_cache_get(path)[0] == uri.split('/')[2]
+
+def test_iter_load_files(storage_dir):
+    import kachery_p2p as kp
+    uris = [kp.store_text(f'text {i}') for i in range(3)]
+    missing_uri = 'sha1://' + '0' * 40
+    results = list(kp.iter_load_files(uris + [missing_uri]))
+    assert sorted(uri for uri, _ in results) == sorted(uris + [missing_uri])
+    paths = dict(results)
+    assert paths[missing_uri] is None
+    with open(paths[uris[1]], 'r') as f:
+        assert f.read() == 'text 1'
+    assert kp.load_files(uris) == {uri: paths[uri] for uri in uris}
+    with pytest.raises(Exception):
+        kp.load_files(uris, max_concurrency=0)
+
+def test_write_bytes_to_fd(storage_dir, tmp_path):
+    import kachery_p2p as kp
+    uri = kp.store_text('0123456789')
+    out_path = str(tmp_path / 'out.txt')
+    with open(out_path, 'wb') as f:
+        kp.write_bytes_to_fd(uri, f.fileno(), start=2, end=5)
+    with open(out_path, 'rb') as f:
+        assert f.read() == b'234'
+    with pytest.raises(kp.LoadFileError):
+        kp.write_bytes_to_fd('sha1://' + '0' * 40, 1)
+    assert kp.load_bytes('sha1://' + '0' * 40, start=0, end=1, write_to_stdout=True) is None
+
+@pytest.fixture
+def load_cache():
+    import kachery_p2p as kp
+    kp.configure_load_cache(max_entries=100, max_bytes=1024 * 1024)
+    kp.clear_load_cache()
+    kp.get_load_cache_stats(reset=True)
+    yield
+    kp.configure_load_cache(max_entries=0, max_bytes=1024 * 1024)
+    kp.clear_load_cache()
+
+def test_load_cache_disabled_by_default(storage_dir):
+    import kachery_p2p as kp
+    uri = kp.store_json({'a': [1, 2]})
+    kp.load_json(uri)
+    kp.load_json(uri)
+    stats = kp.get_load_cache_stats()
+    assert stats['num_entries'] == 0
+    assert stats['hits'] == 0
+
+def test_load_cache_copy_isolation(storage_dir, load_cache):
+    import kachery_p2p as kp
+    uri = kp.store_json({'a': [1, 2], 'b': {'c': 3}})
+    x = kp.load_json(uri)
+    x['a'].append(3)
+    x['b']['c'] = 4
+    y = kp.load_json(uri)
+    assert y == {'a': [1, 2], 'b': {'c': 3}}
+    y['a'].append(5)
+    uri_pkl = kp.store_pkl({'d': [1]})
+    z = kp.load_pkl(uri_pkl)
+    z['d'].append(2)
+    assert kp.load_pkl(uri_pkl) == {'d': [1]}
+    assert kp.load_json(uri) == {'a': [1, 2], 'b': {'c': 3}}
+    assert kp.get_load_cache_stats()['hits'] == 3
+
+def test_daemon_connection_state_detects_stopped_daemon(tmp_path, monkeypatch):
+    import http.server
+    import json
+    import threading
+    import time
+    from kachery_p2p import _daemon_connection as dc
+    ksd = str(tmp_path)
+    node_id = 'a' * 64
+    with open(f'{ksd}/kachery-node-id', 'w') as f:
+        f.write(node_id)
+    with open(f'{ksd}/client-auth', 'w') as f:
+        f.write('auth')
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(dict(nodeId=node_id, joinedChannels=[], kacheryStorageDir=ksd)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = http.server.HTTPServer(('localhost', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.delenv('KACHERY_OFFLINE_STORAGE_DIR', raising=False)
+    monkeypatch.delenv('KACHERY_STORAGE_DIR', raising=False)
+    monkeypatch.delenv('KACHERY_P2P_API_SOCKET', raising=False)
+    api_port = server.server_address[1]
+    state = dc._DaemonConnectionState(api_port=api_port)
+    try:
+        assert state.probe_result().node_id == node_id
+    finally:
+        server.shutdown()
+        server.server_close()
+    # the files in the storage directory are still fresh, but the port no longer accepts connections
+    time.sleep(dc._REVALIDATE_INTERVAL_SEC + 0.1)
+    assert state.probe_result() is None
+
+def test_api_socket_falls_back_to_tcp(tmp_path, monkeypatch):
+    import socket
+    from kachery_p2p import _daemon_connection as dc
+    from kachery_p2p._misc import _http_session, _UnixSocketAdapter
+    socket_path = str(tmp_path / 'daemon.sock')
+    monkeypatch.setenv('KACHERY_P2P_API_SOCKET', socket_path)
+    # the daemon was unable to listen on the socket
+    assert dc._api_socket_path() is None
+    assert not isinstance(_http_session().get_adapter(f'http://{dc._api_host()}:{dc._api_port()}/probe'), _UnixSocketAdapter)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(socket_path)
+        sock.listen(1)
+        assert dc._api_socket_path() == socket_path
+        assert isinstance(_http_session().get_adapter(f'http://{dc._api_host()}:{dc._api_port()}/probe'), _UnixSocketAdapter)
+        assert dc._api_is_reachable()
+
+def test_binary_feed_snapshot_round_trip(tmp_path):
+    from kachery_p2p._feed_snapshot import _BinaryFeedSnapshot, _is_binary_feed_snapshot, _write_binary_feed_snapshot
+    messages_a = [{'n': i, 'text': f'message {i}'} for i in range(10)]
+    for compression in [None, 'zlib']:
+        path = str(tmp_path / f'snapshot-{compression}.kfsnap')
+        with open(path, 'wb') as f:
+            # the messages may be given by an iterator
+            _write_binary_feed_snapshot(f, [('a' * 40, messages_a), ('b' * 40, iter([{'x': [1, 2, 3]}])), ('c' * 40, [])], compression=compression)
+        assert _is_binary_feed_snapshot(path)
+        with _BinaryFeedSnapshot(path) as s:
+            assert sorted(s.get_subfeed_hashes()) == ['a' * 40, 'b' * 40, 'c' * 40]
+            assert s.get_num_messages('a' * 40) == 10
+            assert s.get_messages('a' * 40) == messages_a
+            assert s.get_messages('a' * 40, 3, 5) == messages_a[3:5]
+            assert s.get_messages('a' * 40, -2) == messages_a[-2:]
+            assert s.get_messages('b' * 40) == [{'x': [1, 2, 3]}]
+            assert s.get_num_messages('c' * 40) == 0
+            assert s.get_messages('d' * 40) == []
+
+def test_json_feed_snapshot(storage_dir):
+    import kachery_p2p as kp
+    uri = kp.store_json({'subfeeds': {'a' * 40: {'subfeedHash': 'a' * 40, 'messages': [{'n': 1}, {'n': 2}]}}})
+    feed = kp.load_feed(uri)
+    assert feed.is_snapshot()
+    assert feed.get_subfeed('~' + 'a' * 40).get_next_messages(wait_msec=0) == [{'n': 1}, {'n': 2}]
+    # the snapshot is parsed directly, not through the load cache
+    assert kp.get_load_cache_stats()['num_entries'] == 0
+
+def test_store_from_memory_offline(storage_dir):
+    import kachery_p2p as kp
+    x = np.arange(12, dtype=np.float32).reshape(3, 4)
+    uri = kp.store_npy(x)
+    assert uri.endswith('/file.npy')
+    np.testing.assert_array_equal(kp.load_npy(uri), x)
+    uri = kp.store_text('abc')
+    assert uri == 'sha1://a9993e364706816aba3e25717850c26c9cd0d89d/file.txt'
+    assert kp.load_text(uri) == 'abc'
+    uri = kp.store_json({'a': 1})
+    assert kp.load_json(uri) == {'a': 1}
+    uri = kp.store_pkl({'b': [1, 2]})
+    assert kp.load_pkl(uri) == {'b': [1, 2]}
+    # nothing is left in the temporary directory
+    assert not os.path.exists(f'{storage_dir}/kachery-tmp') or os.listdir(f'{storage_dir}/kachery-tmp') == []
+
+def test_store_file_preflight(storage_dir, tmp_path):
+    import kachery_p2p as kp
+    from kachery_p2p._store_file import _preflight_store_file
+    path = str(tmp_path / 'file.dat')
+    with open(path, 'wb') as f:
+        f.write(b'y' * 150000)
+    with pytest.raises(Exception):
+        kp.store_file(path, preflight='always')
+    with pytest.raises(Exception):
+        kp.store_files([path], preflight='always')
+    uri = kp.store_file(path)
+    kp.get_store_stats(reset=True)
+    # the content is already stored, so nothing would be transferred
+    assert _preflight_store_file(path, basename='file.dat', preflight='hash') == uri
+    assert _preflight_store_file(path, basename='file.dat', preflight='cache') == uri
+    assert _preflight_store_file(path, basename='file.dat', preflight='off') is None
+    stats = kp.get_store_stats()
+    assert stats['num_deduplicated'] == 2
+    assert stats['num_bytes_avoided'] == 2 * 150000
+    assert stats['num_uploads'] == 0
+
+def test_store_dir(storage_dir, tmp_path):
+    import kachery_p2p as kp
+    d = tmp_path / 'dir'
+    (d / 'sub' / 'subsub').mkdir(parents=True)
+    (d / 'a.txt').write_text('a')
+    (d / 'sub' / 'b.txt').write_text('b')
+    (d / 'sub' / 'subsub' / 'c.txt').write_text('c')
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'd.txt').write_text('d')
+    os.symlink(str(other), str(d / 'linked'))
+    # a link back to an ancestor is not followed
+    os.symlink(str(d), str(d / 'sub' / 'loop'))
+    uri = kp.store_dir(str(d))
+    assert uri.startswith('sha1dir://')
+    assert kp.load_text(f'{uri}/a.txt') == 'a'
+    assert kp.load_text(f'{uri}/sub/b.txt') == 'b'
+    assert kp.load_text(f'{uri}/sub/subsub/c.txt') == 'c'
+    assert kp.load_text(f'{uri}/linked/d.txt') == 'd'
+    assert kp.load_file(f'{uri}/sub/loop/a.txt') is None
+    assert kp.load_file(f'{uri}/missing.txt') is None
+    with pytest.raises(Exception):
+        kp.store_dir(str(d / 'a.txt'))
+    with pytest.raises(Exception):
+        kp.store_dir(str(tmp_path / 'missing'))
+
+class _StubSubfeed:
+    # records the batches given to append_messages; can block the appends, or fail them
+    def __init__(self):
+        import threading
+        self.batches = []
+        self.unblocked = threading.Event()
+        self.unblocked.set()
+        self.error = None
+    def is_writeable(self):
+        return True
+    def append_messages(self, messages):
+        self.unblocked.wait()
+        if self.error is not None:
+            raise self.error
+        self.batches.append(list(messages))
+
+def test_subfeed_writer_flush():
+    import time
+    import kachery_p2p as kp
+    subfeed = _StubSubfeed()
+    writer = kp.SubfeedWriter(subfeed, max_batch_size=3, flush_interval_sec=0.2)
+    # a full batch is sent right away
+    writer.append_messages([1, 2, 3, 4])
+    timer = time.time()
+    while len(subfeed.batches) == 0:
+        assert time.time() - timer < 5
+        time.sleep(0.01)
+    assert subfeed.batches == [[1, 2, 3]]
+    # the rest is sent once the flush interval has passed
+    while len(subfeed.batches) == 1:
+        assert time.time() - timer < 5
+        time.sleep(0.01)
+    assert time.time() - timer >= 0.15
+    assert subfeed.batches == [[1, 2, 3], [4]]
+    writer.append_message(5)
+    writer.close()
+    assert subfeed.batches == [[1, 2, 3], [4], [5]]
+    stats = writer.get_stats()
+    assert stats['num_messages_sent'] == 5
+    assert stats['num_batches_sent'] == 3
+
+def test_subfeed_writer_backpressure():
+    import threading
+    import time
+    import kachery_p2p as kp
+    subfeed = _StubSubfeed()
+    subfeed.unblocked.clear()
+    writer = kp.SubfeedWriter(subfeed, max_batch_size=1, flush_interval_sec=10, max_pending_batches=2)
+    # one batch in flight (blocked) and two pending
+    writer.append_messages([1, 2, 3])
+    done = threading.Event()
+    def append_more():
+        writer.append_message(4)
+        done.set()
+    thread = threading.Thread(target=append_more)
+    thread.start()
+    time.sleep(0.2)
+    assert not done.is_set()
+    subfeed.unblocked.set()
+    thread.join(timeout=5)
+    assert done.is_set()
+    writer.close()
+    assert subfeed.batches == [[1], [2], [3], [4]]
+
+def test_subfeed_writer_error():
+    import kachery_p2p as kp
+    subfeed = _StubSubfeed()
+    subfeed.error = Exception('append failed')
+    writer = kp.SubfeedWriter(subfeed, max_batch_size=10, flush_interval_sec=10)
+    writer.append_messages([1, 2])
+    with pytest.raises(Exception, match='append failed'):
+        writer.close()
+    with pytest.raises(Exception):
+        writer.append_message(3)
+
+def test_store_bytes_does_not_count_linked_file(storage_dir, tmp_path, monkeypatch):
+    import kachery_p2p as kp
+    from kachery_p2p import _store_file
+    from kachery_p2p._local_kachery_storage import _local_kachery_storage_store_bytes
+    path = str(tmp_path / 'user-file.txt')
+    with open(path, 'w') as f:
+        f.write('linked content')
+    uri = kp.link_file(path)
+    sha1 = uri.split('/')[2]
+    # online mode, with a daemon that stores the uploaded data in the storage directory
+    uploads = []
+    def http_post_bytes(url, data, headers):
+        uploads.append(bytes(data))
+        _local_kachery_storage_store_bytes(data=data, sha1_hash=sha1)
+        return dict(success=True, sha1=sha1)
+    monkeypatch.setattr(_store_file, '_is_offline_mode', lambda: False)
+    monkeypatch.setattr(_store_file, '_is_online_mode', lambda: True)
+    monkeypatch.setattr(_store_file, '_api_url', lambda: ('http://localhost', {}))
+    monkeypatch.setattr(_store_file, '_http_post_bytes', http_post_bytes)
+    # the content is only available as a linked file, so it is uploaded
+    assert kp.store_text('linked content') == f'sha1://{sha1}/file.txt'
+    assert uploads == [b'linked content']
+    # now it is stored, so it is not uploaded again
+    kp.store_text('linked content')
+    assert len(uploads) == 1
+    os.remove(path)
+    assert kp.load_text(uri) == 'linked content'
+
+def test_manifest_hash_workers(tmp_path, monkeypatch):
+    from kachery_p2p._local_kachery_storage import _compute_local_file_sha1_and_manifest, _num_hash_workers
+    monkeypatch.setenv('KACHERY_NUM_HASH_WORKERS', '3')
+    assert _num_hash_workers() == 3
+    monkeypatch.setenv('KACHERY_NUM_HASH_WORKERS', '0')
+    with pytest.raises(Exception):
+        _num_hash_workers()
+    monkeypatch.delenv('KACHERY_NUM_HASH_WORKERS')
+    path = str(tmp_path / 'file.dat')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(45000000))
+    # three chunks, the same manifest with and without the thread pool
+    sha1, manifest = _compute_local_file_sha1_and_manifest(path, num_workers=1)
+    assert [c['end'] for c in manifest['chunks']] == [20000000, 40000000, 45000000]
+    assert _compute_local_file_sha1_and_manifest(path, num_workers=4) == (sha1, manifest)